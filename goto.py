@@ -1,7 +1,22 @@
 #!/usr/bin/env python3
+import argparse
+import array
+import ast
+import bisect
+import collections
+import concurrent.futures
 import dis
+import hashlib
+import importlib.machinery
+import importlib.util
+import inspect
+import marshal
+import os
+import re
 import sys
+import time
 import types
+import weakref
 
 
 class MissingLabelError(Exception):
@@ -22,8 +37,20 @@ class GotoNotWithinLabelBlock(Exception):
     pass
 
 
+class UnsupportedVersion(RuntimeError):
+    '''The running Python is too old for the feature used'''
+    pass
+
+
+def _require_3_11(feature):
+    if sys.version_info < (3, 11):
+        raise UnsupportedVersion('{} needs Python 3.11 or later, not {}'.format(
+            feature, sys.version.split()[0]))
+
+
 class JumpTooFar(Exception):
-    # TODO Should fix this with extended args
+    # No longer raised: jumps of any distance are given EXTENDED_ARG prefixes.
+    # Kept so that code importing it keeps working.
     pass
 
 
@@ -31,9 +58,64 @@ class GotoNestedTooDeeply(Exception):
     pass
 
 
+def _cache_table():
+    entries = getattr(dis, '_inline_cache_entries', None)
+    if entries is None:
+        return (0,) * 256
+    if isinstance(entries, dict):  # 3.13+ keys it by name
+        return tuple(entries.get(dis.opname[op], 0) for op in range(256))
+    return tuple(entries) + (0,) * (256 - len(entries))
+
+
+_CACHE_ENTRIES = _cache_table()  # inline CACHE code units after each opcode
+
+_EXTENDED_ARG = dis.opmap['EXTENDED_ARG']
+_FOR_ITER = dis.opmap['FOR_ITER']
+_LOAD_GLOBAL = dis.opmap['LOAD_GLOBAL']
+_LOAD_ATTR = dis.opmap['LOAD_ATTR']
+
+_SCAN3_11 = frozenset((_LOAD_GLOBAL, _LOAD_ATTR))
+_SCAN_PRE311 = frozenset(dis.opmap[name] for name in (
+    'SETUP_LOOP', 'SETUP_WITH', 'SETUP_FINALLY', 'SETUP_EXCEPT', 'POP_BLOCK', 'POP_EXCEPT',
+    'LOAD_GLOBAL', 'LOAD_ATTR') if name in dis.opmap)
+
+_scan_patterns = {}
+
+
+def scan_code(code, wanted):
+    """
+    Yield (offset, opcode, arg) for each instruction in code whose opcode is in
+    the set wanted, in order, with any EXTENDED_ARG prefix folded into arg.
+    Offsets are those dis.get_instructions() reports.
+
+    This walks co_code directly instead of building a dis.Instruction for every
+    instruction: the opcode bytes are searched with a regular expression and the
+    args read through a memoryview. Inline CACHE entries are opcode 0 in
+    co_code, so they never match.
+    """
+    pattern = _scan_patterns.get(wanted)
+    if pattern is None:
+        pattern = re.compile(b'[' + b''.join(re.escape(bytes((op,))) for op in sorted(wanted)) + b']')
+        _scan_patterns[wanted] = pattern
+    raw = code.co_code
+    ops = raw[::2]
+    args = memoryview(raw)[1::2]
+    for m in pattern.finditer(ops):
+        i = m.start()
+        arg = args[i]
+        shift = 8
+        j = i - 1
+        while j >= 0 and ops[j] == _EXTENDED_ARG:
+            arg |= args[j] << shift
+            shift += 8
+            j -= 1
+        yield i * 2, ops[i], arg
+
+
 def goto_pre311(fn):
     """
-    A function decorator to add the goto command for a function.
+    A function decorator to add the goto command for a function (Python 3.6
+    and 3.7).
 
     Specify labels like so:
 
@@ -49,12 +131,16 @@ def goto_pre311(fn):
     Only jump within a loop, or to an outer loop, or to function level.
     No local variables called 'label' or 'goto'
     """
-    c = fn.__code__
+    fn.__code__ = _rewrite(fn.__code__, rewrite_code_pre311)
+    return fn
 
+
+def rewrite_code_pre311(c):
+    """Return a copy of code object c with its labels and gotos compiled to jumps."""
     labels, gotos = find_labels_and_gotos_pre311(c)
 
     # make list from bytestring so we can modify the bytes
-    ilist = list(c.co_code)
+    ilist = bytearray(c.co_code)
 
     # no-op the labels
     for label, (index, _) in labels.items():
@@ -97,7 +183,7 @@ def goto_pre311(fn):
                              c.co_stacksize,
                              c.co_flags,
                              bytes(ilist),
-                             c.co_consts,
+                             c.co_consts + (REWRITTEN_MARKER,),
                              c.co_names,
                              c.co_varnames,
                              c.co_filename,
@@ -106,8 +192,7 @@ def goto_pre311(fn):
                              c.co_lnotab,
                              c.co_freevars,
                              c.co_cellvars)
-    fn.__code__ = newcode
-    return fn
+    return newcode
 
 
 def find_labels_and_gotos_pre311(code):
@@ -126,24 +211,24 @@ def find_labels_and_gotos_pre311(code):
 
     block_stack = []
 
-    for ins in dis.get_instructions(c):
-        offset = ins.offset
-        if ins.opname in ('SETUP_LOOP', 'SETUP_WITH', 'SETUP_FINALLY'):
-            block_stack.append((ins.opname, offset + 1))
+    for offset, op, arg in scan_code(c, _SCAN_PRE311):
+        opname = dis.opname[op]
+        if opname in ('SETUP_LOOP', 'SETUP_WITH', 'SETUP_FINALLY'):
+            block_stack.append((opname, offset + 1))
             continue
-        if ins.opname == 'SETUP_EXCEPT':
-            block_stack.append((ins.opname, offset + 1))
+        if opname == 'SETUP_EXCEPT':
+            block_stack.append((opname, offset + 1))
             block_stack.append(('BLOCK', offset + 1))
             continue
-        if ins.opname in ('POP_BLOCK', 'POP_EXCEPT'):
+        if opname in ('POP_BLOCK', 'POP_EXCEPT'):
             block_stack.pop()
             continue
-        if ins.opname == 'LOAD_GLOBAL':
-            global_name = ins.argval
+        if opname == 'LOAD_GLOBAL':
+            global_name = c.co_names[arg]
             index = offset
             continue
-        if ins.opname == 'LOAD_ATTR':
-            label = ins.argval
+        if opname == 'LOAD_ATTR':
+            label = c.co_names[arg]
             if global_name == 'label':
                 if label in labels:
                     raise DuplicateLabelError('Label "{}" appears more than once'.format(label))
@@ -157,52 +242,92 @@ def find_labels_and_gotos_pre311(code):
 
 class Label:
 
-    def __init__(self, name, load_global_idx, load_attr_idx, stack):
+    def __init__(self, name, load_global_idx, load_attr_idx, stack=None):
         self.name = name
         self.load_global_idx = load_global_idx
         self.load_attr_idx = load_attr_idx
-        self.stack = stack
+        self.stack = stack  # what is on the value stack at the label, filled in by patch_code3_11
+        self.chain = None  # the handlers around the label, filled in by patch_code3_11
         self.gotos = []
-        self.target_idx = None  # fill this in when we NOP the instructions. Should point to the last NOP
+        self.copies = []  # (load_global, load_attr) of the compiler's copies of the label statement
+        self.target = None  # the Instr that gotos jump to, filled in by patch_code3_11
 
-    def add_goto(self, load_global_idx, load_attr_idx, stack):
-        # label stack must be prefix of goto stack
-        if len(stack) < len(self.stack):
-            raise GotoNotWithinLabelBlock()
-        if not all(x[0] == x[1] for x in zip(self.stack, stack)):
-            raise GotoNotWithinLabelBlock()
-        pops_needed = len(stack) - len(self.stack)
-        self.gotos.append((load_global_idx, load_attr_idx, pops_needed))
+    def add_goto(self, load_global_idx, load_attr_idx):
+        self.gotos.append((load_global_idx, load_attr_idx))
 
 
-def find_labels_and_gotos3_11(code) -> dict[Label]:
+def find_labels_and_gotos3_11(code, scan=None, computed=None, attr_shift=0) -> 'dict[Label]':
+    '''
+    Return a Label for every label in code, with its gotos added. If computed
+    is a list, the load_global offset of every computed goto, goto[expr], is
+    appended to it. Whether each goto can reach its label is only known once
+    the stack contents are (see patch_code3_11). LOAD_ATTR's arg is taken
+    to be the name index shifted left attr_shift bits.
+    '''
     labels = {}
     gotos = {}
+    copies = {}
+    names = code.co_names
+    raw = code.co_code
+    global_name = None
 
-    for_iter_stack = []  # instruction number of the FOR_ITERs that we have seen. pop when we se a corresponding JUMP_BACKWARD
-
-    for ins in dis.get_instructions(code):
-        if ins.opname == 'FOR_ITER':
-            for_iter_stack.append(ins.offset)
-        elif ins.opname == 'JUMP_BACKWARD' and for_iter_stack and ins.argval == for_iter_stack[-1]:
-            for_iter_stack.pop()
-        elif ins.opname == 'LOAD_GLOBAL':
-            global_name = ins.argval
-            index = ins.offset
-            continue
-        elif ins.opname == 'LOAD_ATTR':
-            label = ins.argval
+    for offset, op, arg in (scan or scan_code)(code, _SCAN3_11):
+        if op == _LOAD_GLOBAL:
+            global_name = names[arg >> 1]  # low bit of the arg is the push-NULL flag
+            index = offset
+            attr_index = offset + 2 + _CACHE_ENTRIES[op] * 2
+            if computed is not None and global_name.lower() == 'goto':
+                following = attr_index
+                while raw[following] == _EXTENDED_ARG:
+                    following += 2
+                if raw[following] != _LOAD_ATTR:
+                    computed.append(offset)
+        elif op == _LOAD_ATTR and global_name is not None:
+            # only 'label.x' / 'goto.x' themselves, not a later attribute load
+            start = offset
+            while start > attr_index and raw[start - 2] == _EXTENDED_ARG:
+                start -= 2
+            if start != attr_index:
+                global_name = None
+                continue
+            label = names[arg >> attr_shift]
             if global_name.lower() == 'label':
-                if label in labels:
+                if label not in labels:
+                    labels[label] = index, offset
+                elif _is_copy(code, labels[label][0], index):
+                    copies.setdefault(label, []).append((index, offset))
+                else:
                     raise DuplicateLabelError('Label "{}" appears more than once'.format(label))
-                labels[label] = index, ins.offset, tuple(
-                    for_iter_stack)
             elif global_name.lower() == 'goto':
-                if label not in gotos:
-                    gotos[label] = []
-                gotos[label].append(
-                    (index, ins.offset, tuple(for_iter_stack)))  # XXX (load_global, load_attr, stack of get_attr)
+                gotos.setdefault(label, []).append((index, offset))  # (load_global, load_attr)
 
+    return _label_objects(labels, gotos, copies)
+
+
+def find_labels_and_gotos3_12(code, scan=None, computed=None) -> 'dict[Label]':
+    '''
+    As find_labels_and_gotos3_11, for 3.12+, where the low bit of LOAD_ATTR's
+    arg is the method flag.
+    '''
+    return find_labels_and_gotos3_11(code, scan, computed, attr_shift=1)
+
+
+def _is_copy(code, load_global, other):
+    '''
+    Return True if the label statements at the two offsets are one statement
+    that the compiler laid out twice. 3.12+ duplicates short blocks that end
+    the function (such as a label followed by a return), and both copies keep
+    the statement's position.
+    '''
+    positions = list(code.co_positions())
+    return positions[load_global // 2] == positions[other // 2]
+
+
+def _label_objects(labels, gotos, copies):
+    '''
+    Build the Labels from {name: (load_global, load_attr)} and add the gotos,
+    {name: [(load_global, load_attr)]}, and the copies, of the same form.
+    '''
     hanging_goto = gotos.keys() - labels.keys()
     if len(hanging_goto) != 0:
         raise MissingLabelError(
@@ -213,86 +338,2823 @@ def find_labels_and_gotos3_11(code) -> dict[Label]:
         label_objs[label] = Label(label, *labels[label])
 
     for goto_label in gotos:
-        for load_global, load_attr, stack in gotos[goto_label]:
-            label_objs[goto_label].add_goto(load_global, load_attr, stack)
+        for load_global, load_attr in gotos[goto_label]:
+            label_objs[goto_label].add_goto(load_global, load_attr)
+
+    for label, offsets in copies.items():
+        label_objs[label].copies.extend(offsets)
 
     return label_objs
 
 
+# Relocating assembler (3.11+). A code object is decoded into a list of
+# Instr, with jumps and exception handlers pointing at Instr objects rather
+# than offsets. Passes can then insert and delete instructions freely, and
+# assemble() lays the code out again, recomputing jump args, EXTENDED_ARGs,
+# co_exceptiontable and co_linetable.
+
+_NOP = dis.opmap['NOP']
+_POP_TOP = dis.opmap['POP_TOP']
+_JUMP_FORWARD = dis.opmap['JUMP_FORWARD']
+_POP_JUMP_IF_FALSE = dis.opmap.get('POP_JUMP_FORWARD_IF_FALSE') or dis.opmap.get('POP_JUMP_IF_FALSE')
+_LOAD_CONST = dis.opmap['LOAD_CONST']
+_COMPARE_OP = dis.opmap['COMPARE_OP']
+_BINARY_SUBSCR = dis.opmap['BINARY_SUBSCR']
+_BUILD_MAP = dis.opmap['BUILD_MAP']
+_RAISE_VARARGS = dis.opmap['RAISE_VARARGS']
+_COPY = dis.opmap.get('COPY')
+_SWAP = dis.opmap.get('SWAP')
+_LOAD_FAST = dis.opmap['LOAD_FAST']
+_STORE_FAST = dis.opmap['STORE_FAST']
+_DELETE_FAST = dis.opmap['DELETE_FAST']
+_LOAD_FAST_CHECK = dis.opmap.get('LOAD_FAST_CHECK')  # 3.12+, where LOAD_FAST trusts the compiler
+_LOAD_FAST_AND_CLEAR = dis.opmap.get('LOAD_FAST_AND_CLEAR')
+_LOAD_FAST_LOAD_FAST = dis.opmap.get('LOAD_FAST_LOAD_FAST')  # 3.13 superinstructions
+_STORE_FAST_LOAD_FAST = dis.opmap.get('STORE_FAST_LOAD_FAST')
+_STORE_FAST_STORE_FAST = dis.opmap.get('STORE_FAST_STORE_FAST')
+_MAKE_CELL = dis.opmap.get('MAKE_CELL')
+_COPY_FREE_VARS = dis.opmap.get('COPY_FREE_VARS')
+_GET_ITER = dis.opmap['GET_ITER']
+_CONTAINS_OP = dis.opmap.get('CONTAINS_OP')
+_RETURN_VALUE = dis.opmap['RETURN_VALUE']
+_POP_JUMP_IF_TRUE = dis.opmap.get('POP_JUMP_FORWARD_IF_TRUE') or dis.opmap.get('POP_JUMP_IF_TRUE')
+_GET_ANEXT = dis.opmap.get('GET_ANEXT')
+_BEFORE_WITH = dis.opmap.get('BEFORE_WITH')
+_BEFORE_ASYNC_WITH = dis.opmap.get('BEFORE_ASYNC_WITH')
+_PUSH_EXC_INFO = dis.opmap.get('PUSH_EXC_INFO')
+_POP_EXCEPT = dis.opmap['POP_EXCEPT']
+_WITH_EXCEPT_START = dis.opmap.get('WITH_EXCEPT_START')
+_EXC_MATCHES = frozenset(dis.opmap[name] for name in ('CHECK_EXC_MATCH', 'CHECK_EG_MATCH')
+                         if name in dis.opmap)
+_PRECALL = dis.opmap.get('PRECALL')  # 3.11 only
+_PUSH_NULL = dis.opmap.get('PUSH_NULL')
+_CALL = dis.opmap.get('CALL')
+_NO_POSITION = (None, None, None, None)
+# what an exhausted FOR_ITER jumps over at its target: 3.12 skips the END_FOR
+# and 3.13 the POP_TOP after it too, landing on the next instruction
+_FOR_ITER_SKIPS = tuple(dis.opmap[name] for name in (
+    ('END_FOR', 'POP_TOP') if sys.version_info >= (3, 13) else ('END_FOR',)) if name in dis.opmap)
+# 3.12+ writes one line table entry per run of instructions at the same position
+_MERGE_LOCATIONS = sys.version_info >= (3, 12)
+_JUMPS = frozenset(op for op in dis.hasjrel if op < 256)
+
+# (forward, backward) versions of the same jump
+_JUMP_PAIRS = [(dis.opmap[f], dis.opmap[b]) for f, b in (
+    ('JUMP_FORWARD', 'JUMP_BACKWARD'),
+    ('POP_JUMP_FORWARD_IF_FALSE', 'POP_JUMP_BACKWARD_IF_FALSE'),
+    ('POP_JUMP_FORWARD_IF_TRUE', 'POP_JUMP_BACKWARD_IF_TRUE'),
+    ('POP_JUMP_FORWARD_IF_NONE', 'POP_JUMP_BACKWARD_IF_NONE'),
+    ('POP_JUMP_FORWARD_IF_NOT_NONE', 'POP_JUMP_BACKWARD_IF_NOT_NONE'),
+) if f in dis.opmap and b in dis.opmap]
+_FORWARD_JUMP = {op: f for f, b in _JUMP_PAIRS for op in (f, b)}
+_BACKWARD_JUMP = {op: b for f, b in _JUMP_PAIRS for op in (f, b)}
+_BACKWARD_JUMPS = frozenset(op for op in _JUMPS if 'BACKWARD' in dis.opname[op])
+_UNCONDITIONAL_JUMPS = frozenset(dis.opmap[name] for name in (
+    'JUMP_FORWARD', 'JUMP_BACKWARD', 'JUMP_BACKWARD_NO_INTERRUPT') if name in dis.opmap)
+_SCOPE_EXITS = frozenset(dis.opmap[name] for name in (
+    'RETURN_VALUE', 'RETURN_CONST', 'RAISE_VARARGS', 'RERAISE') if name in dis.opmap)
+# plain jumps that can be threaded through: the assembler picks their direction
+_THREADABLE = frozenset(op for op in _UNCONDITIONAL_JUMPS if op in _FORWARD_JUMP)
+
+
+class Instr:
+    '''
+    One instruction of an Assembler. arg is the full argument, without
+    EXTENDED_ARG prefixes. Jumps have target set to the Instr they jump to,
+    handler is the ExceptHandler covering the instruction (or None), and
+    positions is its (lineno, end_lineno, col_offset, end_col_offset).
+    '''
+    __slots__ = ('opcode', 'arg', 'target', 'handler', 'positions')
+
+    def __init__(self, opcode, arg=0, target=None, handler=None, positions=None):
+        self.opcode = opcode
+        self.arg = arg
+        self.target = target
+        self.handler = handler
+        self.positions = positions
+
+    @property
+    def opname(self):
+        return dis.opname[self.opcode]
+
+    def __repr__(self):
+        return '<Instr {} {}>'.format(self.opname, self.arg)
+
+
+class ExceptHandler:
+    '''A co_exceptiontable entry's handler, shared by the Instrs it covers.'''
+    __slots__ = ('target', 'depth', 'lasti')
+
+    def __init__(self, target, depth, lasti):
+        self.target = target
+        self.depth = depth
+        self.lasti = lasti
+
+    def key(self):
+        return self.target, self.depth, self.lasti
+
+
+class Assembler:
+    '''
+    Decodes a code object into a list of Instr (self.instrs). After editing,
+    assemble() returns a new code object.
+    '''
+
+    def __init__(self, code):
+        self.code = code
+        self.consts = code.co_consts
+        self.instrs = []
+        self.by_offset = {}  # dis offset -> Instr, as reported by scan_code
+        raw = code.co_code
+        positions = list(code.co_positions())
+        starts = {}  # offset of the instruction including any EXTENDED_ARGs -> Instr
+        jumps = []
+        i = 0
+        start = 0
+        arg = 0
+        while i < len(raw):
+            op = raw[i]
+            arg |= raw[i + 1]
+            if op == _EXTENDED_ARG:
+                arg <<= 8
+                i += 2
+                continue
+            ins = Instr(op, arg if op >= dis.HAVE_ARGUMENT else 0, positions=positions[i // 2])
+            self.instrs.append(ins)
+            self.by_offset[i] = starts[start] = ins
+            end = i + 2 + 2 * _CACHE_ENTRIES[op]
+            if op in _JUMPS:
+                jumps.append((ins, end - 2 * arg if op in _BACKWARD_JUMPS else end + 2 * arg))
+            i = start = end
+            arg = 0
+        for ins, target in jumps:
+            ins.target = starts[target]
+        # table entries are sorted and disjoint, as are the instructions
+        # entries with the same handler (split by a nested block) share an ExceptHandler
+        shared = {}
+        entries = iter([(e.start, e.end, shared.setdefault(
+            (e.target, e.depth, e.lasti), ExceptHandler(starts[e.target], e.depth, e.lasti)))
+                        for e in dis._parse_exception_table(code)])
+        entry = next(entries, None)
+        for offset, ins in self.by_offset.items():
+            while entry is not None and entry[1] <= offset:
+                entry = next(entries, None)
+            if entry is None:
+                break
+            if entry[0] <= offset:
+                ins.handler = entry[2]
+
+    def const(self, value):
+        '''Return the index of value in self.consts, adding it if need be.'''
+        for n, const in enumerate(self.consts):
+            if type(const) is type(value) and const == value:
+                return n
+        self.consts += (value,)
+        return len(self.consts) - 1
+
+    def substitute(self, replacements):
+        '''
+        Replace instructions in one pass. replacements maps an Instr to the list
+        of Instrs that takes its place (empty to delete it). New Instrs without
+        positions or a handler inherit those of the instruction they replace.
+        Jumps and handlers aimed at a replaced instruction are aimed at the
+        first of its replacements, or for a deletion the next instruction kept.
+        Returns that mapping of replaced Instr to the Instr now aimed at.
+        '''
+        redirect = {}
+        pending = []
+        instrs = []
+        for ins in self.instrs:
+            new = replacements.get(ins)
+            if new is None:
+                new = [ins]
+            for n in new:
+                if n.positions is None:
+                    n.positions = ins.positions
+                if n.handler is None:
+                    n.handler = ins.handler
+            if not new:
+                pending.append(ins)
+                continue
+            if new[0] is not ins:
+                redirect[ins] = new[0]
+            for gone in pending:
+                redirect[gone] = new[0]
+            pending = []
+            instrs.extend(new)
+        self.instrs = instrs
+        if not redirect:
+            return redirect
+        for ins in redirect:
+            target = redirect[ins]
+            while target in redirect:
+                target = redirect[target]
+            redirect[ins] = target
+        handlers = set()
+        for ins in instrs:
+            if ins.target in redirect:
+                ins.target = redirect[ins.target]
+            if ins.handler is not None:
+                handlers.add(ins.handler)
+        for handler in handlers:
+            if handler.target in redirect:
+                handler.target = redirect[handler.target]
+        return redirect
+
+    def assemble(self, **changes):
+        '''Lay the instructions out and return the new code object.'''
+        instrs = self.instrs
+        index = {ins: n for n, ins in enumerate(instrs)}
+        for ins in instrs:
+            if ins.target is not None and ins.target not in index:
+                raise ValueError('{!r} jumps to an instruction that was removed'.format(ins))
+        # Jump args depend on the layout and the layout on the args (through
+        # EXTENDED_ARG), so iterate until stable. Sizes only ever grow.
+        sizes = [_instr_size(ins.opcode, 0 if ins.opcode in _JUMPS else ins.arg) for ins in instrs]
+        while True:
+            offsets = []
+            offset = 0
+            for size in sizes:
+                offsets.append(offset)
+                offset += size
+            changed = False
+            for n, ins in enumerate(instrs):
+                if ins.opcode not in _JUMPS:
+                    continue
+                end = offsets[n] + sizes[n]
+                target = offsets[index[ins.target]]
+                if target >= end:
+                    opcode = _FORWARD_JUMP.get(ins.opcode, ins.opcode)
+                    arg = target - end
+                else:
+                    opcode = _BACKWARD_JUMP.get(ins.opcode, ins.opcode)
+                    arg = end - target
+                if (opcode in _BACKWARD_JUMPS) != (target < end):
+                    raise ValueError('{!r} cannot jump {}'.format(
+                        ins, 'backwards' if target < end else 'forwards'))
+                ins.opcode = opcode
+                ins.arg = arg
+                size = _instr_size(opcode, arg)
+                if size > sizes[n]:
+                    sizes[n] = size
+                    changed = True
+            if not changed:
+                break
+
+        code = bytearray()
+        for ins, size in zip(instrs, sizes):
+            caches = _CACHE_ENTRIES[ins.opcode]
+            arg = ins.arg
+            for shift in range(8 * (size - caches - 1), 0, -8):
+                code += bytes((_EXTENDED_ARG, (arg >> shift) & 0xFF))
+            code += bytes((ins.opcode, arg & 0xFF))
+            code += bytes(2 * caches)
+
+        changes.setdefault('co_consts', self.consts)
+        firstlineno = changes.get('co_firstlineno', self.code.co_firstlineno)
+        changes.setdefault('co_linetable', _encode_linetable(
+            [(ins.positions, size) for ins, size in zip(instrs, sizes)], firstlineno))
+        changes.setdefault('co_exceptiontable', _encode_exceptiontable(
+            [(ins.handler, size) for ins, size in zip(instrs, sizes)],
+            lambda target: offsets[index[target]]))
+        return self.code.replace(co_code=bytes(code), **changes)
+
+
+def _instr_size(opcode, arg):
+    '''Size in code units, with EXTENDED_ARGs and inline caches.'''
+    ext = 0 if arg < 1 << 8 else 1 if arg < 1 << 16 else 2 if arg < 1 << 24 else 3
+    return ext + 1 + _CACHE_ENTRIES[opcode]
+
+
+def _write_varint(out, value):
+    while value >= 64:
+        out.append(64 | (value & 63))
+        value >>= 6
+    out.append(value)
+
+
+def _write_signed_varint(out, value):
+    _write_varint(out, (-value << 1) | 1 if value < 0 else value << 1)
+
+
+def _encode_linetable(sized_positions, firstlineno):
+    '''Encode [(positions, code units)] as a PEP 626 co_linetable, as the compiler does.'''
+    if _MERGE_LOCATIONS:
+        merged = []
+        for positions, size in sized_positions:
+            if merged and merged[-1][0] == positions:
+                merged[-1][1] += size
+            else:
+                merged.append([positions, size])
+        sized_positions = merged
+    out = bytearray()
+    prev_line = firstlineno
+    for (line, end_line, col, end_col), size in sized_positions:
+        while size > 0:
+            length = min(size, 8)
+            size -= length
+            first = 0x80 | (length - 1)
+            if line is None:
+                out.append(first | 15 << 3)  # no location
+                continue
+            delta = line - prev_line
+            if col is None or end_col is None:
+                if end_line in (line, None):
+                    out.append(first | 13 << 3)  # no columns
+                    _write_signed_varint(out, delta)
+                    prev_line = line
+                    continue
+            elif end_line == line:
+                if delta == 0 and col < 80 and 0 <= end_col - col < 16:
+                    out.append(first | (col >> 3) << 3)  # short form
+                    out.append((col & 7) << 4 | (end_col - col))
+                    continue
+                if 0 <= delta < 3 and col < 128 and end_col < 128:
+                    out.append(first | (10 + delta) << 3)  # one line form
+                    out.append(col)
+                    out.append(end_col)
+                    prev_line = line
+                    continue
+            out.append(first | 14 << 3)  # long form
+            _write_signed_varint(out, delta)
+            _write_varint(out, (line if end_line is None else end_line) - line)
+            _write_varint(out, 0 if col is None else col + 1)
+            _write_varint(out, 0 if end_col is None else end_col + 1)
+            prev_line = line
+    return bytes(out)
+
+
+def _write_except_varint(out, value, msb=0):
+    for shift in (24, 18, 12, 6):
+        if value >= 1 << shift:
+            out.append((value >> shift) & 63 | 64 | msb)
+            msb = 0
+    out.append(value & 63 | msb)
+
+
+def _encode_exceptiontable(sized_handlers, target_offset):
+    '''Encode [(handler or None, code units)] as a co_exceptiontable.'''
+    out = bytearray()
+    ranges = []
+    offset = 0
+    for handler, size in sized_handlers:
+        key = handler and handler.key()
+        if ranges and ranges[-1][0] == key:
+            ranges[-1][2] += size
+        else:
+            ranges.append([key, offset, size])
+        offset += size
+    for key, start, size in ranges:
+        if key is None:
+            continue
+        target, depth, lasti = key
+        _write_except_varint(out, start, 128)
+        _write_except_varint(out, size)
+        _write_except_varint(out, target_offset(target))
+        _write_except_varint(out, depth << 1 | int(lasti))
+    return bytes(out)
+
+
 def goto3_11(fn):
     '''
+    A function decorator to add the goto command for a function (Python 3.11).
+    '''
+    fn.__code__ = _rewrite(fn.__code__, rewrite_code3_11)
+    return fn
+
 
+def goto3_12(fn):
     '''
-    c = fn.__code__
+    A function decorator to add the goto command for a function (Python 3.12+).
+    '''
+    fn.__code__ = _rewrite(fn.__code__, rewrite_code3_12)
+    return fn
 
-    labels: dict[Label] = find_labels_and_gotos3_11(c)
 
-    # make list from bytestring so we can modify the bytes
-    ilist = list(c.co_code)
+def rewrite_code3_11(c, compact=True, probe=None):
+    '''
+    Return a copy of code object c with its labels and gotos compiled to jumps.
+    With compact=False each label is left behind as a NOP and the jumps are
+    not optimised. probe is as for patch_code3_11.
+    '''
+    computed = []
+    labels: dict[Label] = find_labels_and_gotos3_11(c, computed=computed)
+    return patch_code3_11(c, labels, computed, compact, probe)
+
+
+def rewrite_code3_12(c, compact=True, probe=None):
+    '''As rewrite_code3_11, for 3.12+. Only finding the labels differs.'''
+    computed = []
+    labels: dict[Label] = find_labels_and_gotos3_12(c, computed=computed)
+    return patch_code3_11(c, labels, computed, compact, probe)
+
 
-    globals_to_nop = []
-    attrs_to_nop = []
+def patch_code3_11(c, labels, computed=(), compact=True, probe=None, entries=()):
+    '''
+    The second half of rewrite_code3_11: compile the labels, gotos and computed
+    gotos that find_labels_and_gotos3_11 found in c into jumps. entries are
+    the offsets of any code that only gotos reach, each the first instruction
+    of a statement outside every block.
 
-    load_global_cache_count = dis._inline_cache_entries[dis.opmap['LOAD_GLOBAL']]
-    load_attr_cache_count = dis._inline_cache_entries[dis.opmap['LOAD_ATTR']]
+    probe, if given, instruments the result. It is called as
+    probe(asm, kind, name, ins) for each label (kind 'label') and each goto
+    (kind 'goto', with name None for a computed goto), where ins is the
+    label's or goto's first Instr, and returns the Instrs to run there: as
+    control passes the label, or before the goto leaves any block. It is
+    also called once with kind 'entry', name None and ins the RESUME that
+    starts the function, for Instrs to run on every call. They must leave
+    the value stack as they found it.
+    '''
+    asm = Assembler(c)
+    at = asm.by_offset
+    following = dict(zip(asm.instrs, asm.instrs[1:]))
+    stacks = CFG(asm).stacks([at[offset] for offset in entries])
+    finals = finally_handlers(asm)
+    replacements = {}
+    handlers = {}  # Instr -> the handler it must have, which substitute() would not keep if None
 
-    # no-op the labels (and the CACHEs too otherwise it won't work)
+    # Each label becomes a NOP, which is the jump target, and each goto becomes
+    # the clean up for the blocks it leaves plus a jump. The LOAD_ATTR and
+    # POP_TOP after the LOAD_GLOBAL go in both cases.
     for label in labels.values():
-        globals_to_nop.append(label.load_global_idx)
-        attrs_to_nop.append(label.load_attr_idx)
-        label.target_idx = label.load_attr_idx + load_attr_cache_count * 2 + 2 # 2 bytes per instruction
-        for lglobal, lattr, _ in label.gotos:
-            globals_to_nop.append(lglobal)
-            attrs_to_nop.append(lattr)
+        load_attr = at[label.load_attr_idx]
+        label.target = at[label.load_global_idx]
+        label.stack = stacks.get(label.target, ())
+        label.chain = frozenset(_handler_chain(label.target))
+        probed = probe(asm, 'label', label.name, label.target) if probe else []
+        replacements[label.target] = [label.target] + probed
+        replacements[load_attr] = replacements[following[load_attr]] = []
+        for load_global, load_attr in label.copies:
+            load_global, load_attr = at[load_global], at[load_attr]
+            replacements[load_global] = [Instr(ins.opcode, ins.arg) for ins in probed]
+            replacements[load_attr] = replacements[following[load_attr]] = []
 
-    for index in globals_to_nop:
-        for nopi in range(load_global_cache_count + 1):  # + 1 for the instruction itself
-            ilist[index + nopi * 2] = 9
+    # A goto no path reaches, such as in the copy of a finally body the
+    # compiler keeps for exceptions a bare try can never raise, has no stack
+    # to clean up and never runs, so it stays as it is.
+    for label in labels.values():
+        for load_global, load_attr in label.gotos:
+            load_global, load_attr = at[load_global], at[load_attr]
+            if load_global not in stacks:
+                continue
+            replacements[load_global] = jump_out(asm, load_global, stacks[load_global], label, handlers, finals)
+            replacements[load_attr] = replacements[following[load_attr]] = []
+            if probe:
+                replacements[load_global][:0] = probe(asm, 'goto', label.name, load_global)
 
-    for index in attrs_to_nop:
-        for nopi in range(load_attr_cache_count + 1 + 1):  # + 1 for the instruction itself +1 for POP_TOP
-            ilist[index + nopi * 2] = 9
+    for load_global in computed:
+        if at[load_global] not in stacks:
+            continue
+        add_computed_goto(asm, at[load_global], stacks, labels, replacements, handlers, finals)
+        if probe:
+            replacements[at[load_global]] = probe(asm, 'goto', None, at[load_global])
 
-    # add in the JUMPs
+    if probe:
+        resume = next(ins for ins in asm.instrs if ins.opname == 'RESUME')
+        replacements[resume] = [resume] + probe(asm, 'entry', None, resume)
 
     for label in labels.values():
-        for goto_index, _, pops_needed in label.gotos:
-            index = goto_index
-            # Check that we can fit enough POP_TOPs
-            # NOTE: The +2 means we always assume we have to add a single EXTENDED_ARG
-            if ilist[index + pops_needed * 2 + 2] != dis.opmap['NOP']:  # TODO: This should check for consecutive NOPs
-                raise GotoNestedTooDeeply()
-            for i in range(pops_needed):
-                ilist[index] = dis.opmap['POP_TOP']
-                ilist[index + 1] = 0
-                index += 2
-            # diff = (index - label.load_global_idx) // 2  # bytecodes are 2 bytes each.
-            diff = (index - label.target_idx) // 2  # bytecodes are 2 bytes each.
-
-            if diff > 0:
-                diff += 1  # + 1 because it counts from the instruction after the JUMP
-                if diff > 255:
-                    diff += 1  # we now have to jump over the EXTENDED_ARG instruction too
-                    ilist[index] = dis.opmap['EXTENDED_ARG']
-                    ilist[index + 1] = diff >> 8  # ignore the lower 8 bits
-                    diff &= 255  # only the lower 8 bits
-                    index += 2
-                ilist[index] = dis.opmap['JUMP_BACKWARD']
-                ilist[index + 1] = diff
+        label.target.opcode = _NOP
+        label.target.arg = 0
+    asm.substitute(replacements)
+    for ins, handler in handlers.items():
+        ins.handler = handler
+    if compact:
+        remove_label_nops(asm, labels)
+        optimize_jumps(asm)
+    if _LOAD_FAST_CHECK is not None:
+        check_unbound_locals(asm)
+    stacksize = c.co_stacksize + (2 if computed else 0)  # the dispatch compares need two slots
+    if probe:
+        stacksize = max(stacksize, max_stack_depth(CFG(asm)))
+    return asm.assemble(co_consts=asm.consts + (REWRITTEN_MARKER,), co_stacksize=stacksize)
+
+
+class Stack:
+    '''
+    A value stack as CFG.stacks follows it: the entry top over the stack
+    below, shared with every other stack pushed on it, or empty if below is
+    None, so pushing and popping cost the same at any depth. It compares,
+    indexes and iterates (bottom first) as the tuple of its entries.
+    '''
+    __slots__ = ('below', 'top', 'depth')
+
+    def __init__(self, below=None, top=None):
+        self.below = below
+        self.top = top
+        self.depth = 0 if below is None else below.depth + 1
+
+    def push(self, *values):
+        stack = self
+        for value in values:
+            stack = Stack(stack, value)
+        return stack
+
+    def pop(self, n=1):
+        '''The stack with n fewer entries, or none left.'''
+        stack = self
+        while n > 0 and stack.below is not None:
+            stack = stack.below
+            n -= 1
+        return stack
+
+    def __len__(self):
+        return self.depth
+
+    def __iter__(self):
+        return reversed(list(reversed(self)))
+
+    def __reversed__(self):
+        stack = self
+        while stack.below is not None:
+            yield stack.top
+            stack = stack.below
+
+    def __getitem__(self, index):
+        return tuple(self)[index]
+
+    def __eq__(self, other):
+        if isinstance(other, (Stack, tuple)):
+            return len(self) == len(other) and tuple(self) == tuple(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Stack{!r}'.format(tuple(self))
+
+
+_EMPTY_STACK = Stack()
+
+
+class Block:
+    '''
+    A basic block of a CFG: Instrs that run straight through, entered only
+    at the first. next is the block control falls into (None after a jump,
+    return or raise), jump the block the last Instr may jump to, handler the
+    ExceptHandler covering all of them, and stack the value stack on entry
+    (see CFG.stacks), or None if no path reaches the block.
+    '''
+    __slots__ = ('instrs', 'next', 'jump', 'handler', 'stack')
+
+    def __init__(self, handler):
+        self.instrs = []
+        self.next = None
+        self.jump = None
+        self.handler = handler
+        self.stack = None
+
+    def __repr__(self):
+        return '<Block {!r}..{!r}>'.format(self.instrs[0], self.instrs[-1])
+
+
+class CFG:
+    '''
+    The control flow graph of an Assembler's instructions: self.blocks in
+    layout order, and self.block_of mapping each Instr to its Block. It
+    describes asm as it was built from, so passes that edit asm build a new
+    one afterwards.
+    '''
+
+    def __init__(self, asm):
+        instrs = asm.instrs
+        leaders = {instrs[0]}
+        for ins in instrs:
+            if ins.target is not None:
+                leaders.add(ins.target)
+            if ins.handler is not None:
+                leaders.add(ins.handler.target)
+        self.blocks = []
+        self.block_of = {}
+        block = None
+        for ins in instrs:
+            if block is None or ins in leaders or ins.handler is not block.handler:
+                block = Block(ins.handler)
+                self.blocks.append(block)
+            block.instrs.append(ins)
+            self.block_of[ins] = block
+            if ins.target is not None or ins.opcode in _SCOPE_EXITS:
+                block = None
+        for block, after in zip(self.blocks, self.blocks[1:] + [None]):
+            last = block.instrs[-1]
+            if last.target is not None:
+                block.jump = self.block_of[last.target]
+            if last.opcode not in _UNCONDITIONAL_JUMPS and last.opcode not in _SCOPE_EXITS:
+                block.next = after
+
+    def successors(self, block):
+        '''Yield the blocks control can pass to from block, its handler's included.'''
+        if block.next is not None:
+            yield block.next
+        if block.jump is not None:
+            yield block.jump
+        if block.handler is not None:
+            yield self.block_of[block.handler.target]
+
+    def reachable(self):
+        '''Return the set of blocks some path from the entry point reaches.'''
+        seen = {self.blocks[0]}
+        todo = [self.blocks[0]]
+        while todo:
+            for block in self.successors(todo.pop()):
+                if block not in seen:
+                    seen.add(block)
+                    todo.append(block)
+        return seen
+
+    def stacks(self, entries=()):
+        '''
+        Follow every path through the graph, exception handlers included, from
+        the first block and from the blocks starting with one of the Instrs
+        entries, all with an empty value stack. Set each reachable block's
+        stack, and return {Instr: stack} for each instruction reached, where
+        stack is a Stack standing for the value stack as the instruction
+        starts; the stacks share their lower entries, so this costs the same
+        per instruction however deep the stack is. Values a goto leaving their
+        block must clean up are the Instr that put them there: a FOR_ITER or
+        GET_ANEXT for a loop's iterator, BEFORE_WITH or BEFORE_ASYNC_WITH for
+        a with block's __exit__, and PUSH_EXC_INFO for the exception an except
+        clause replaced. Any other value is None.
+        '''
+        stacks = {}
+        for block in self.blocks:
+            block.stack = None
+        todo = []
+        for first in [self.blocks[0]] + [self.block_of[ins] for ins in entries]:
+            first.stack = _EMPTY_STACK
+            todo.append(first)
+
+        def visit(block, stack):
+            if block.stack is None:  # the compiler keeps depths consistent where paths meet
+                block.stack = stack
+                todo.append(block)
+
+        def effect(stack, ins, jump):
+            arg = ins.arg if ins.opcode >= dis.HAVE_ARGUMENT else None
+            n = dis.stack_effect(ins.opcode, arg, jump=jump)
+            return stack.pop(-n) if n < 0 else stack.push(*(None,) * n)
+
+        while todo:
+            block = todo.pop()
+            stack = block.stack
+            handler = block.handler
+            if handler is not None:
+                visit(self.block_of[handler.target],
+                      stack.pop(len(stack) - handler.depth).push(*(None,) * (2 if handler.lasti else 1)))
+            for ins in block.instrs:
+                stacks[ins] = stack
+                op = ins.opcode
+                if op == _FOR_ITER or op == _GET_ANEXT:
+                    stack = stack.pop().push(ins)
+                if ins.target is not None:
+                    visit(block.jump, effect(stack, ins, True))
+                if op in _UNCONDITIONAL_JUMPS or op in _SCOPE_EXITS:
+                    break
+                after = effect(stack, ins, False)
+                if op in (_BEFORE_WITH, _BEFORE_ASYNC_WITH, _PUSH_EXC_INFO):
+                    after = after.pop(2).push(ins, None)
+                stack = after
             else:
-                diff = -diff
-                diff -= 2  # -1 for EXTENDED_ARG and -1 because it counts from the instruction after the JUMP
-                ilist[index] = dis.opmap['EXTENDED_ARG']
-                ilist[index + 1] = diff >> 8  # ignore the lower 8 bits
+                if block.next is not None:
+                    visit(block.next, stack)
+        return stacks
+
+
+def max_stack_depth(cfg):
+    '''The most values the code of cfg ever has on its stack: its co_stacksize.'''
+    depth = 0
+    for ins, stack in cfg.stacks().items():
+        arg = ins.arg if ins.opcode >= dis.HAVE_ARGUMENT else None
+        grows = max(dis.stack_effect(ins.opcode, arg, jump=False), dis.stack_effect(ins.opcode, arg, jump=True))
+        depth = max(depth, len(stack) + max(grows, 0))
+    return depth
+
+
+def _handler_chain(ins):
+    '''
+    Yield the handler covering ins, then the handler covering that handler's
+    code, and so on out: every try, with and except clause ins is inside,
+    interleaved with their clean up handlers.
+    '''
+    handler = ins.handler
+    seen = set()
+    while handler is not None and handler not in seen:
+        seen.add(handler)
+        yield handler
+        handler = handler.target.handler
+
+
+def finally_handlers(asm):
+    '''
+    Return the set of handlers in asm that run a finally clause: those whose
+    code is neither a with block's __exit__ call nor an except clause testing
+    the exception.
+    '''
+    instrs = asm.instrs
+    position = {ins: n for n, ins in enumerate(instrs)}
+    finals = set()
+    for handler in {ins.handler for ins in instrs if ins.handler is not None}:
+        if handler.target.opcode != _PUSH_EXC_INFO:
+            continue  # a clean up handler, or the one that ends 'async for'
+        n = position[handler.target] + 1
+        if instrs[n].opcode in (_WITH_EXCEPT_START, _POP_TOP):  # with, or a bare except
+            continue
+        # an except clause evaluates its exception type and matches it before
+        # the first statement of a finally clause could end
+        for ins in instrs[n:]:
+            if ins.opcode in _EXC_MATCHES:
+                break
+            if (ins.opcode in _JUMPS or ins.opcode in _SCOPE_EXITS
+                    or ins.opname.startswith(('STORE_', 'DELETE_', 'POP_', 'BEFORE_', 'IMPORT_'))):
+                finals.add(handler)
+                break
+    return finals
+
+
+def jump_out(asm, ins, stack, label, handlers, finals):
+    '''
+    Return the instructions for a goto at ins, with the value stack stack, to
+    label: the clean up for each block it leaves, innermost first, then the
+    jump. Leaving a loop pops its iterator, a with block calls its
+    __exit__(None, None, None) and an except clause restores the exception it
+    replaced (and deletes its 'as' name). handlers gets the handler each new
+    instruction must have, that of the code around the blocks left so far.
+    finals is the finally_handlers(asm).
+    '''
+    depth = len(label.stack)
+    if stack[:depth] != label.stack:
+        raise GotoNotWithinLabelBlock('goto .{} is not within the block of its label'.format(label.name))
+    chain = list(_handler_chain(ins))
+    if any(handler in finals and handler not in label.chain for handler in chain):
+        raise IllegalGoto('goto .{} would leave a try block without running its finally clause'.format(
+            label.name))
+    handler = ins.handler
+    out = []
+    for pushed_by in reversed(stack[depth:]):
+        opcode = pushed_by and pushed_by.opcode
+        if opcode == _BEFORE_ASYNC_WITH:
+            raise IllegalGoto('goto .{} cannot leave an async with block'.format(label.name))
+        if opcode == _BEFORE_WITH:
+            handler = pushed_by.handler
+            none = asm.const(None)
+            block = [Instr(_LOAD_CONST, none), Instr(_LOAD_CONST, none), Instr(_LOAD_CONST, none)] + (
+                [Instr(_PRECALL, 2)] if _PRECALL else []) + [Instr(_CALL, 2), Instr(_POP_TOP)]
+        elif opcode == _PUSH_EXC_INFO:
+            cleanup = pushed_by.handler  # restores the exception if the clause raises
+            handler = cleanup.target.handler
+            block = [Instr(_POP_EXCEPT)]
+            for named in chain:
+                # 'except E as e' clears e in a handler of its own, inside cleanup:
+                # LOAD_CONST None, STORE e, DELETE e, RERAISE
+                if named.target.handler is cleanup and named.target.opcode == _LOAD_CONST:
+                    n = asm.instrs.index(named.target)
+                    block += [Instr(i.opcode, i.arg) for i in asm.instrs[n:n + 3]]
+        else:
+            block = [Instr(_POP_TOP)]
+        out += block
+    out.append(Instr(_JUMP_FORWARD, target=label.target))
+    for new in out:
+        new.positions = ins.positions
+        handlers[new] = handler
+    return out
+
+
+def remove_label_nops(asm, labels):
+    '''
+    Delete the NOPs left where labels were, so that control passing a label in
+    a loop dispatches nothing. Jumps to a label then land on the instruction
+    after it.
+    '''
+    redirect = asm.substitute({label.target: [] for label in labels.values() if label.target.opcode == _NOP})
+    for label in labels.values():
+        label.target = redirect.get(label.target, label.target)
+
+
+def thread_jumps(asm):
+    '''
+    Aim every jump that lands on an unconditional jump at the end of the chain,
+    and drop unconditional jumps to the next instruction. Return True if
+    anything changed.
+    '''
+    changed = False
+    for ins in asm.instrs:
+        if ins.opcode not in _FORWARD_JUMP:  # only jumps that can go either way
+            continue
+        target = ins.target
+        seen = set()
+        while target.opcode in _THREADABLE and target not in seen:  # goto loops are fine
+            seen.add(target)
+            target = target.target
+        if target is not ins.target:
+            ins.target = target
+            changed = True
+    following = dict(zip(asm.instrs, asm.instrs[1:]))
+    fall_through = {ins: [] for ins in asm.instrs
+                    if ins.opcode in _THREADABLE and following.get(ins) is ins.target}
+    if fall_through:
+        asm.substitute(fall_through)
+    return changed or bool(fall_through)
+
+
+def remove_unreachable(asm):
+    '''
+    Delete the blocks that no path from the entry point (or from the handler
+    of a reachable block) reaches. Return True if anything was deleted.
+    '''
+    cfg = CFG(asm)
+    live = cfg.reachable()
+    dead = {ins: [] for block in cfg.blocks if block not in live for ins in block.instrs}
+    if dead:
+        asm.substitute(dead)
+    return bool(dead)
+
+
+def optimize_jumps(asm):
+    '''
+    Thread goto chains (a goto landing on a label that does another goto), fold
+    jumps to the next instruction into fall-through, and drop labels and code
+    that cannot be reached.
+    '''
+    while thread_jumps(asm) | remove_unreachable(asm):
+        pass
+
+
+def check_unbound_locals(asm):
+    '''
+    On 3.12+ LOAD_FAST does not check that the local is bound: the compiler
+    only uses it where every path assigns the local first, and LOAD_FAST_CHECK
+    elsewhere. A goto can skip the assignment, so find the locals each
+    instruction may see unbound, following every path as it is now, and make
+    their LOAD_FASTs LOAD_FAST_CHECKs, which raise UnboundLocalError instead.
+    The values that LOAD_FAST_AND_CLEAR saves around an inlined comprehension
+    (and that are stored back after it) are followed on the value stack.
+    '''
+    code = asm.code
+    nlocals = len(code.co_varnames) + len(set(code.co_cellvars) - set(code.co_varnames)) + len(code.co_freevars)
+    nargs = code.co_argcount + code.co_kwonlyargcount + bool(code.co_flags & inspect.CO_VARARGS) + bool(
+        code.co_flags & inspect.CO_VARKEYWORDS)
+    cfg = CFG(asm)
+    states = {cfg.blocks[0]: ((1 << nargs) - 1, ())}  # Block -> (bound locals as a bitmask, stack)
+    todo = [cfg.blocks[0]]
+    unbound = {}  # Instr -> the locals it reads that may be unbound
+
+    def visit(block, state):
+        old = states.get(block)
+        if old is not None:
+            state = old[0] & state[0], tuple(a and b for a, b in zip(old[1], state[1]))
+            if state == old:
+                return
+        states[block] = state
+        todo.append(block)
+
+    def effect(stack, ins, jump):
+        arg = ins.arg if ins.opcode >= dis.HAVE_ARGUMENT else None
+        n = dis.stack_effect(ins.opcode, arg, jump=jump)
+        return stack[:max(len(stack) + n, 0)] if n < 0 else stack + (True,) * n
+
+    def load(ins, bound, local):
+        if not bound >> local & 1:
+            unbound.setdefault(ins, set()).add(local)
+        return bound | 1 << local
+
+    while todo:
+        block = todo.pop()
+        bound, stack = states[block]
+        handler = block.handler
+        low, low_stack = bound, stack
+        for ins in block.instrs:
+            op = ins.opcode
+            low &= bound
+            low_stack = tuple(a and b for a, b in zip(low_stack, stack))
+            if ins.target is not None:
+                visit(block.jump, (bound, effect(stack, ins, True)))
+            if op in _UNCONDITIONAL_JUMPS or op in _SCOPE_EXITS:
+                break
+            after = effect(stack, ins, False)
+            if op == _LOAD_FAST or op == _LOAD_FAST_CHECK:
+                bound = load(ins, bound, ins.arg)
+            elif op == _LOAD_FAST_LOAD_FAST:
+                bound = load(ins, load(ins, bound, ins.arg >> 4), ins.arg & 15)
+            elif op == _STORE_FAST:
+                bound = bound | 1 << ins.arg if stack[-1] else bound & ~(1 << ins.arg)
+            elif op == _STORE_FAST_LOAD_FAST:
+                bound = load(ins, bound | 1 << (ins.arg >> 4), ins.arg & 15)
+            elif op == _STORE_FAST_STORE_FAST:
+                bound |= 1 << (ins.arg >> 4) | 1 << (ins.arg & 15)
+            elif op == _DELETE_FAST:
+                bound &= ~(1 << ins.arg)
+            elif op == _LOAD_FAST_AND_CLEAR:
+                after = stack + (bool(bound >> ins.arg & 1),)
+                bound &= ~(1 << ins.arg)
+            elif op == _MAKE_CELL:
+                bound |= 1 << ins.arg
+            elif op == _COPY_FREE_VARS:
+                bound |= ((1 << ins.arg) - 1) << (nlocals - ins.arg)
+            elif op == _SWAP:
+                after = list(stack)
+                after[-1], after[-ins.arg] = after[-ins.arg], after[-1]
+                after = tuple(after)
+            elif op == _COPY:
+                after = stack + (stack[-ins.arg],)
+            stack = after
+        else:
+            if block.next is not None:
+                visit(block.next, (bound, stack))
+        if handler is not None:
+            visit(cfg.block_of[handler.target],
+                  (low & bound, low_stack[:handler.depth] + (True,) * (2 if handler.lasti else 1)))
+
+    replacements = {}
+    for ins, locals_ in unbound.items():
+        if ins.opcode == _LOAD_FAST:
+            ins.opcode = _LOAD_FAST_CHECK
+        elif ins.opcode == _LOAD_FAST_LOAD_FAST:
+            replacements[ins] = [Instr(_LOAD_FAST_CHECK if local in locals_ else _LOAD_FAST, local)
+                                 for local in (ins.arg >> 4, ins.arg & 15)]
+        elif ins.opcode == _STORE_FAST_LOAD_FAST:
+            replacements[ins] = [Instr(_STORE_FAST, ins.arg >> 4), Instr(_LOAD_FAST_CHECK, ins.arg & 15)]
+    if replacements:
+        asm.substitute(replacements)
+
+
+def add_computed_goto(asm, load_global, stacks, labels, replacements, handlers, finals):
+    '''
+    Compile the computed goto, goto[expr], that starts with the LOAD_GLOBAL
+    load_global. stacks is the CFG's stacks(); expr must evaluate to the
+    name of a label. handlers and finals are as for jump_out().
+
+    Bytecode has no indirect jump, so the subscript becomes a balanced binary
+    search over the names of the labels the goto may reach, built here at
+    decoration time: about log2(n) compares for n labels, not a constant-time
+    table, finished by an equality check and a jump. An unknown name raises
+    KeyError.
+    '''
+    stack = stacks[load_global]
+    targets = {}  # label name -> the jump there
+    for label in labels.values():
+        try:
+            targets[label.name] = jump_out(asm, load_global, stack, label, handlers, finals)
+        except (GotoNotWithinLabelBlock, IllegalGoto):
+            pass  # not a label this goto can reach
+    if not targets:
+        raise MissingLabelError('Computed goto has no labels it can reach')
+
+    # the subscript is the first BINARY_SUBSCR with just goto and expr above the stack
+    instrs = asm.instrs
+    n = instrs.index(load_global) + 1
+    depth = len(stack) + 2
+    while instrs[n].opcode != _BINARY_SUBSCR or len(stacks.get(instrs[n], ())) != depth:
+        n += 1
+    subscript, pop = instrs[n], instrs[n + 1]
+
+    bad = [Instr(_BUILD_MAP, 0), Instr(_SWAP, 2), Instr(_BINARY_SUBSCR), Instr(_RAISE_VARARGS, 1)]
+    names = sorted(targets)
+
+    def search(lo, hi):
+        if hi - lo == 1:
+            return [Instr(_COPY, 1), Instr(_LOAD_CONST, asm.const(names[lo])),
+                    Instr(_COMPARE_OP, _compare_arg('==')), Instr(_POP_JUMP_IF_FALSE, target=bad[0]),
+                    Instr(_POP_TOP)] + targets[names[lo]]
+        mid = (lo + hi) // 2
+        high = search(mid, hi)
+        return [Instr(_COPY, 1), Instr(_LOAD_CONST, asm.const(names[mid])),
+                Instr(_COMPARE_OP, _compare_arg('<')), Instr(_POP_JUMP_IF_FALSE, target=high[0])
+                ] + search(lo, mid) + high
+
+    replacements[load_global] = []
+    replacements[subscript] = search(0, len(names)) + bad
+    replacements[pop] = []
+
+
+_compare_args = {}
+
+
+def _compare_arg(op):
+    '''
+    COMPARE_OP's arg for the comparison op ahead of a conditional jump, as the
+    compiler emits it. 3.12+ pack a mask for the specialized forms into the
+    low bits, and 3.13 a flag for a bool result.
+    '''
+    arg = _compare_args.get(op)
+    if arg is None:
+        code = compile('if a {} b: pass'.format(op), '<compare>', 'exec')
+        arg = _compare_args[op] = next(scan_code(code, frozenset((_COMPARE_OP,))))[2]
+    return arg
+
+
+# The block stack backend (3.8 - 3.10). Before 3.11 try, with and except
+# blocks are set up and torn down at run time by SETUP_* and POP_BLOCK
+# rather than described by an exception table, and jumps are relative
+# (forward only) or absolute, counted in bytes before 3.10 and in code units
+# in 3.10. Assembler3_8 reads and writes that form, block_stacks3_8 works out
+# the blocks and values at each instruction, and each goto pops what it
+# leaves before a JUMP_ABSOLUTE, with EXTENDED_ARGs once the target is past
+# the first 256 units.
+
+_JUMP_ABSOLUTE = dis.opmap.get('JUMP_ABSOLUTE')
+_ABSOLUTE_JUMPS = frozenset(op for op in dis.hasjabs if op < 256)
+_RELATIVE_JUMPS = frozenset(op for op in dis.hasjrel if op < 256)
+_JUMP_UNIT = 2 if sys.version_info >= (3, 10) else 1  # bytes per unit of a jump's arg
+_POP_BLOCK = dis.opmap.get('POP_BLOCK')
+_DUP_TOP = dis.opmap.get('DUP_TOP')
+_CALL_FUNCTION = dis.opmap.get('CALL_FUNCTION')
+_GET_AWAITABLE = dis.opmap['GET_AWAITABLE']
+_YIELD_FROM = dis.opmap.get('YIELD_FROM')
+_GET_AITER = dis.opmap['GET_AITER']
+_GEN_START = dis.opmap.get('GEN_START')  # 3.10 only
+_END_ASYNC_FOR = dis.opmap.get('END_ASYNC_FOR')
+_RERAISE = dis.opmap.get('RERAISE')
+_SETUP_FINALLY = dis.opmap.get('SETUP_FINALLY')
+_SETUP_BLOCKS = {dis.opmap[name]: kind for name, kind in (
+    ('SETUP_FINALLY', 'try'), ('SETUP_WITH', 'with'), ('SETUP_ASYNC_WITH', 'async with')) if name in dis.opmap}
+# 3.8 runs finally clauses as subroutines
+_BEGIN_FINALLY = dis.opmap.get('BEGIN_FINALLY')
+_CALL_FINALLY = dis.opmap.get('CALL_FINALLY')
+_POP_FINALLY = dis.opmap.get('POP_FINALLY')
+_END_FINALLY = dis.opmap.get('END_FINALLY')
+_WITH_CLEANUP_START = dis.opmap.get('WITH_CLEANUP_START')
+_WITH_CLEANUP_FINISH = dis.opmap.get('WITH_CLEANUP_FINISH')
+_LEGACY_EXITS = frozenset(dis.opmap[name] for name in (
+    'RETURN_VALUE', 'RAISE_VARARGS', 'RERAISE', 'JUMP_ABSOLUTE', 'JUMP_FORWARD') if name in dis.opmap)
 
-                ilist[index + 2] = dis.opmap['JUMP_FORWARD']
-                ilist[index + 3] = diff & 255
 
-    fn.__code__ = fn.__code__.replace(co_code=bytes(ilist))
+class Assembler3_8(Assembler):
+    '''
+    As Assembler, for the code objects of 3.8 - 3.10. There is no exception
+    table, so every Instr's handler is None, and positions only has a line
+    number: (lineno, lineno, None, None).
+    '''
+
+    def __init__(self, code):
+        self.code = code
+        self.consts = code.co_consts
+        self.instrs = []
+        self.by_offset = {}
+        raw = code.co_code
+        if sys.version_info >= (3, 10):
+            lines = [None] * (len(raw) // 2)
+            for start, end, line in code.co_lines():
+                lines[start // 2:end // 2] = [line] * ((end - start) // 2)
+        else:
+            lines = []
+            line = code.co_firstlineno
+            starts = dict(dis.findlinestarts(code))
+            for offset in range(0, len(raw), 2):
+                line = starts.get(offset, line)
+                lines.append(line)
+        starts = {}
+        jumps = []
+        i = 0
+        start = 0
+        arg = 0
+        while i < len(raw):
+            op = raw[i]
+            arg |= raw[i + 1]
+            if op == _EXTENDED_ARG:
+                arg <<= 8
+                i += 2
+                continue
+            line = lines[start // 2]
+            ins = Instr(op, arg if op >= dis.HAVE_ARGUMENT else 0, positions=(line, line, None, None))
+            self.instrs.append(ins)
+            self.by_offset[i] = starts[start] = ins
+            end = i + 2
+            if op in _RELATIVE_JUMPS:
+                jumps.append((ins, end + arg * _JUMP_UNIT))
+            elif op in _ABSOLUTE_JUMPS:
+                jumps.append((ins, arg * _JUMP_UNIT))
+            i = start = end
+            arg = 0
+        for ins, target in jumps:
+            ins.target = starts[target]
+
+    def assemble(self, **changes):
+        '''Lay the instructions out and return the new code object.'''
+        instrs = self.instrs
+        index = {ins: n for n, ins in enumerate(instrs)}
+        for ins in instrs:
+            if ins.target is not None and ins.target not in index:
+                raise ValueError('{!r} jumps to an instruction that was removed'.format(ins))
+        # as Assembler.assemble: iterate until the EXTENDED_ARGs stop growing
+        sizes = [_instr_size(ins.opcode, 0 if ins.target is not None else ins.arg) for ins in instrs]
+        while True:
+            offsets = []
+            offset = 0
+            for size in sizes:
+                offsets.append(offset)
+                offset += size
+            changed = False
+            for n, ins in enumerate(instrs):
+                if ins.target is None:
+                    continue
+                target = offsets[index[ins.target]]
+                if ins.opcode in _RELATIVE_JUMPS:
+                    target -= offsets[n] + sizes[n]
+                    if target < 0:
+                        raise ValueError('{!r} cannot jump backwards'.format(ins))
+                ins.arg = target * 2 // _JUMP_UNIT
+                size = _instr_size(ins.opcode, ins.arg)
+                if size > sizes[n]:
+                    sizes[n] = size
+                    changed = True
+            if not changed:
+                break
+
+        code = bytearray()
+        for ins, size in zip(instrs, sizes):
+            for shift in range(8 * (size - 1), 0, -8):
+                code += bytes((_EXTENDED_ARG, (ins.arg >> shift) & 0xFF))
+            code += bytes((ins.opcode, ins.arg & 0xFF))
+
+        changes.setdefault('co_consts', self.consts)
+        firstlineno = changes.get('co_firstlineno', self.code.co_firstlineno)
+        sized_lines = [(ins.positions[0], size) for ins, size in zip(instrs, sizes)]
+        if sys.version_info >= (3, 10):
+            changes.setdefault('co_linetable', _encode_linetable3_10(sized_lines, firstlineno))
+        else:
+            changes.setdefault('co_lnotab', _encode_lnotab(sized_lines, firstlineno))
+        return self.code.replace(co_code=bytes(code), **changes)
+
+
+def _encode_lnotab(sized_lines, firstlineno):
+    '''Encode [(lineno, code units)] as a 3.8 or 3.9 co_lnotab.'''
+    out = bytearray()
+    offset = prev_offset = 0
+    prev_line = firstlineno
+    for line, size in sized_lines:
+        if line != prev_line:
+            delta = offset - prev_offset
+            while delta > 255:
+                out += bytes((255, 0))
+                delta -= 255
+            step = line - prev_line
+            while step > 127:
+                out += bytes((delta, 127))
+                delta = 0
+                step -= 127
+            while step < -128:
+                out += bytes((delta, 128))
+                delta = 0
+                step += 128
+            out += bytes((delta, step & 0xFF))
+            prev_offset = offset
+            prev_line = line
+        offset += 2 * size
+    return bytes(out)
+
+
+def _encode_linetable3_10(sized_lines, firstlineno):
+    '''Encode [(lineno or None, code units)] as a 3.10 co_linetable.'''
+    merged = []
+    for line, size in sized_lines:
+        if merged and merged[-1][0] == line:
+            merged[-1][1] += 2 * size
+        else:
+            merged.append([line, 2 * size])
+    out = bytearray()
+    prev_line = firstlineno
+    for line, length in merged:
+        if line is None:
+            step = -128
+        else:
+            step = line - prev_line
+            prev_line = line
+            while step > 127:
+                out += bytes((0, 127))
+                step -= 127
+            while step < -127:
+                out += bytes((0, -127 & 0xFF))
+                step += 127
+        while length > 254:
+            out += bytes((254, step & 0xFF))
+            step = -128 if line is None else 0
+            length -= 254
+        out += bytes((length, step & 0xFF))
+    return bytes(out)
+
+
+def block_stacks3_8(asm):
+    '''
+    Follow every path through asm's instructions, and return {Instr: set of
+    (blocks, stack)} for the states it can start in. blocks is a tuple of
+    (kind, setup, level) for the blocks set up, innermost last: kind is
+    'try', 'with' or 'async with' for the body of its SETUP_* instruction
+    setup, and 'except' while handling an exception that setup caught, and
+    level the stack depth to unwind to. stack is a tuple standing for the
+    value stack, with (kind, Instr) for the values a goto must know about:
+    'iter' for a loop's iterator (from GET_ITER or GET_AITER), 'exit' for a
+    with block's __exit__, 'exc' for the six values of a caught exception
+    and, on 3.8, 'null' (BEGIN_FINALLY) and 'ret' (CALL_FINALLY, with the
+    Instr the finally clause returns to) in a finally clause. Other values
+    are None.
+
+    Paths are followed separately, so code such as a 3.8 finally clause,
+    which starts with different stacks, has more than one state.
+    '''
+    instrs = asm.instrs
+    following = dict(zip(instrs, instrs[1:]))
+    states = collections.defaultdict(set)
+    # a 3.10 generator starts with the value its first send() passed in
+    todo = [(instrs[0], ((), (None,) if instrs[0].opcode == _GEN_START else ()))]
+    while todo:
+        ins, state = todo.pop()
+        if state in states[ins]:
+            continue
+        states[ins].add(state)
+        after = following.get(ins)
+        for successor in _successors3_8(ins, state, after):
+            if successor[0] is not None:
+                todo.append(successor)
+    return states
+
+
+def _successors3_8(ins, state, after):
+    '''Yield (Instr, state) for each instruction control can pass to from ins.'''
+    blocks, stack = state
+    op = ins.opcode
+
+    def effect(jump):
+        n = dis.stack_effect(op, ins.arg if op >= dis.HAVE_ARGUMENT else None, jump=jump)
+        return stack[:len(stack) + n] if n < 0 else stack + (None,) * n
+
+    if op in _SETUP_BLOCKS:
+        body = effect(False)
+        level = len(body) - (op != _SETUP_FINALLY)  # a with's __enter__() result goes above its block
+        if op != _SETUP_FINALLY:
+            body = body[:level - 1] + (('exit', ins),) + body[level:]
+        yield after, (blocks + ((_SETUP_BLOCKS[op], ins, level),), body)
+        yield ins.target, (blocks + (('except', ins, level),), body[:level] + (('exc', ins),) * 6)
+    elif op == _POP_BLOCK:
+        yield after, (blocks[:-1], stack)
+    elif op == _POP_EXCEPT or op == _END_ASYNC_FOR:
+        yield after, (blocks[:-1], effect(False))
+    elif op == _BEGIN_FINALLY:
+        yield after, (blocks, stack + (('null', ins),))
+    elif op == _CALL_FINALLY:
+        yield ins.target, (blocks, stack + (('ret', after),))
+    elif op == _END_FINALLY:
+        kind, where = stack[-1] or (None, after)
+        if kind != 'exc':  # which END_FINALLY re-raises
+            yield (where if kind == 'ret' else after), (blocks, stack[:-1])
+    elif op == _POP_FINALLY:
+        top = stack[-1:] if ins.arg else ()
+        below = stack[:len(stack) - len(top)]
+        if below[-1] and below[-1][0] == 'exc':
+            yield after, (blocks[:-1], below[:-6] + top)
+        else:
+            yield after, (blocks, below[:-1] + top)
+    elif op == _WITH_CLEANUP_START:
+        if stack[-1] and stack[-1][0] == 'exc':
+            yield after, (blocks, stack[:-7] + stack[-6:] + (None, None))
+        else:
+            yield after, (blocks, stack[:-2] + stack[-1:] + (None, None))
+    elif op == _WITH_CLEANUP_FINISH:
+        yield after, (blocks, stack[:-2])
+    else:
+        if ins.target is not None:
+            yield ins.target, (blocks, effect(True))
+        if op not in _LEGACY_EXITS:
+            stack = effect(False)
+            if op == _GET_ITER or op == _GET_AITER:
+                stack = stack[:-1] + (('iter', ins),)
+            yield after, (blocks, stack)
+
+
+def find_labels_and_gotos3_8(code):
+    '''
+    As find_labels_and_gotos3_11, for 3.8 - 3.10. A label statement that
+    appears again on the same line is the compiler's copy of it: 3.9 and
+    3.10 lay finally clauses out twice, once for each way in.
+    '''
+    labels = {}
+    gotos = {}
+    copies = {}
+    names = code.co_names
+    raw = code.co_code
+    lines = dict(dis.findlinestarts(code))
+    line_starts = sorted(lines)
+    global_name = None
+
+    def line_of(offset):
+        n = bisect.bisect_right(line_starts, offset)
+        return lines[line_starts[n - 1]] if n else code.co_firstlineno
+
+    for offset, op, arg in scan_code(code, _SCAN3_11):
+        if op == _LOAD_GLOBAL:
+            global_name = names[arg]
+            index = offset
+        elif op == _LOAD_ATTR and global_name is not None:
+            start = offset
+            while start > index + 2 and raw[start - 2] == _EXTENDED_ARG:
+                start -= 2
+            if start != index + 2:
+                global_name = None
+                continue
+            label = names[arg]
+            if global_name.lower() == 'label':
+                if label not in labels:
+                    labels[label] = index, offset
+                elif line_of(labels[label][0]) == line_of(index):
+                    copies.setdefault(label, []).append((index, offset))
+                else:
+                    raise DuplicateLabelError('Label "{}" appears more than once'.format(label))
+            elif global_name.lower() == 'goto':
+                gotos.setdefault(label, []).append((index, offset))
+
+    return _label_objects(labels, gotos, copies)
+
+
+def goto3_8(fn):
+    '''
+    A function decorator to add the goto command for a function (Python 3.8
+    - 3.10).
+    '''
+    fn.__code__ = _rewrite(fn.__code__, rewrite_code3_8)
     return fn
 
 
-if sys.version_info >= (3, 11):
+def rewrite_code3_8(c):
+    '''Return a copy of code object c with its labels and gotos compiled to jumps.'''
+    labels = find_labels_and_gotos3_8(c)
+    asm = Assembler3_8(c)
+    at = asm.by_offset
+    following = dict(zip(asm.instrs, asm.instrs[1:]))
+    states = block_stacks3_8(asm)
+    kinds = _try_kinds3_8(asm)
+    replacements = {}
+    stacksize = c.co_stacksize
+
+    def state_of(ins, what):
+        found = states.get(ins) or {((), ())}
+        if len(found) > 1:
+            raise IllegalGoto('{} is in a finally clause, which 3.8 enters with different blocks set up'.format(
+                what))
+        return next(iter(found))
+
+    # The label statements go, so gotos land on what follows them
+    for label in labels.values():
+        label.target = at[label.load_global_idx]
+        label.stack = state_of(label.target, 'label .' + label.name)
+        for load_global, load_attr in [(label.load_global_idx, label.load_attr_idx)] + label.copies:
+            load_attr = at[load_attr]
+            replacements[at[load_global]] = replacements[load_attr] = replacements[following[load_attr]] = []
+
+    for label in labels.values():
+        for load_global, load_attr in label.gotos:
+            load_global, load_attr = at[load_global], at[load_attr]
+            state = state_of(load_global, 'goto .' + label.name)
+            out, depth = leave_blocks3_8(asm, state, label, kinds)
+            stacksize = max(stacksize, depth)
+            replacements[load_global] = out
+            replacements[load_attr] = replacements[following[load_attr]] = []
+
+    asm.substitute(replacements)
+    return asm.assemble(co_consts=asm.consts + (REWRITTEN_MARKER,), co_stacksize=stacksize)
+
+
+def _try_kinds3_8(asm):
+    '''
+    Return {SETUP_FINALLY Instr: what leaving its body takes}: 'except' for a
+    try with except clauses (or an async for's await), the three Instrs
+    that clear the name of an 'except E as e' clause, or 'finally' for a try
+    with a finally clause, which a goto may not leave.
+    '''
+    index = {ins: n for n, ins in enumerate(asm.instrs)}
+    kinds = {}
+    for ins in asm.instrs:
+        if ins.opcode != _SETUP_FINALLY:
+            continue
+        n = index[ins.target]
+        handler = asm.instrs[n:n + 4]
+        if handler[0].opcode in (_DUP_TOP, _POP_TOP, _END_ASYNC_FOR):
+            kinds[ins] = 'except'
+        elif (len(handler) == 4 and handler[0].opcode == _LOAD_CONST and asm.consts[handler[0].arg] is None
+              and handler[1].opname.startswith('STORE_') and handler[2].opname.startswith('DELETE_')
+              and handler[3].opcode in (_RERAISE, _END_FINALLY)):
+            kinds[ins] = handler[:3]
+        else:
+            kinds[ins] = 'finally'
+    return kinds
+
+
+def leave_blocks3_8(asm, state, label, kinds):
+    '''
+    Return the instructions for a goto that starts in state (see
+    block_stacks3_8) to label, and the stack depth they reach: the clean up
+    for each block it leaves, innermost first, then the jump. Leaving a loop
+    pops its iterator, a with block calls its __exit__(None, None, None)
+    (and awaits it for async with) and an except clause restores the
+    exception it replaced (and deletes its 'as' name). kinds is the
+    _try_kinds3_8(asm).
+    '''
+    blocks, stack = state
+    label_blocks, label_stack = label.stack
+    if blocks[:len(label_blocks)] != label_blocks:
+        raise GotoNotWithinLabelBlock('goto .{} is not within the block of its label'.format(label.name))
+    stack = list(stack)
+    depth = len(stack)
+    out = []
+
+    def pop_to(level):
+        while len(stack) > level:
+            value = stack.pop()
+            if value and value[0] in ('null', 'ret'):
+                raise IllegalGoto('goto .{} cannot leave a finally clause'.format(label.name))
+            out.append(Instr(_POP_TOP))
+
+    none = asm.const(None)
+    for kind, setup, level in reversed(blocks[len(label_blocks):]):
+        if kind == 'except':
+            pop_to(level + 3)
+            out.append(Instr(_POP_EXCEPT))
+            del stack[-3:]
+            continue
+        pop_to(level)
+        out.append(Instr(_POP_BLOCK))
+        if kind == 'try':
+            leave = kinds[setup]
+            if leave == 'finally':
+                raise IllegalGoto('goto .{} would leave a try block without running its finally clause'.format(
+                    label.name))
+            if leave != 'except':
+                out += [Instr(ins.opcode, ins.arg) for ins in leave]
+        else:
+            out += [Instr(_LOAD_CONST, none), Instr(_DUP_TOP), Instr(_DUP_TOP), Instr(_CALL_FUNCTION, 3)]
+            depth = max(depth, len(stack) + 3)
+            if kind == 'async with':
+                out += [Instr(_GET_AWAITABLE), Instr(_LOAD_CONST, none), Instr(_YIELD_FROM)]
+            out.append(Instr(_POP_TOP))
+            stack.pop()
+    if stack[:len(label_stack)] != list(label_stack):
+        raise GotoNotWithinLabelBlock('goto .{} is not within the block of its label'.format(label.name))
+    pop_to(len(label_stack))
+    out.append(Instr(_JUMP_ABSOLUTE, target=label.target))
+    return out, depth
+
+
+# Recognisers generated straight from a DFA. Each state is a label: a
+# FOR_ITER for the next character, a membership test per character class
+# jumping to the next state's label, and a reject. The code object is
+# assembled directly, so there is no source to compile.
+
+def _dfa_template(s):
+    pass
+
+
+def dfa_code(transitions, start, accepting, name='dfa'):
+    '''
+    Return a code object for a function name(s) that returns True if the
+    string s takes the DFA from start to one of the accepting states.
+
+    transitions maps each state to {character class: next state}, where a
+    character class is a string (or other iterable) of characters. A None
+    character class stands for every character the state's other classes
+    leave out. States that only appear as targets have no transitions.
+
+    A state that can no longer change the result, because every character
+    keeps it where it is or it has no transitions and rejects, returns at
+    once without reading the rest of the string. Needs Python 3.11 or later.
+    '''
+    _require_3_11('generated recognisers')
+    states = [start] + [state for state in transitions if state != start]
+    for moves in transitions.values():
+        for state in moves.values():
+            if state not in states:
+                states.append(state)
+    accepting = frozenset(accepting)
+    final = {state for state in states
+             if transitions.get(state, {}) == {None: state}
+             or not transitions.get(state) and state not in accepting}
+
+    asm = Assembler(_dfa_template.__code__)
+    asm.consts = (None,)
+    false, true = asm.const(False), asm.const(True)
+
+    def instr(opcode, arg=0, target=None):
+        return Instr(opcode, arg, target, positions=_NO_POSITION)
+
+    heads = {state: instr(_POP_TOP if state in final else _FOR_ITER) for state in states}
+
+    resume = asm.instrs[0]
+    instrs = [instr(resume.opcode, resume.arg), instr(_LOAD_FAST, 0), instr(_GET_ITER)]
+    order = {state: n for n, state in enumerate(states)}
+    for state in states:
+        if state in final:
+            instrs += [heads[state], instr(_LOAD_CONST, true if state in accepting else false),
+                       instr(_RETURN_VALUE)]
+            continue
+        moves = dict(transitions.get(state, {}))
+        default = moves.pop(None, None)
+        exhausted = [instr(op) for op in _FOR_ITER_SKIPS] + [
+            instr(_LOAD_CONST, true if state in accepting else false), instr(_RETURN_VALUE)]
+        heads[state].target = exhausted[0]
+        instrs.append(heads[state])
+        seen = set()
+        skip = None  # jumps over a backward jump, to the next test
+        if moves:
+            instrs.append(instr(_STORE_FAST, 1))
+        for chars, target in moves.items():
+            chars = frozenset(chars)
+            if chars & seen:
+                raise ValueError('State {!r} has more than one transition for {!r}'.format(
+                    state, ''.join(sorted(chars & seen))))
+            seen |= chars
+            if len(chars) == 1:
+                test = [instr(_LOAD_CONST, asm.const(next(iter(chars)))), instr(_COMPARE_OP, _compare_arg('=='))]
+            else:
+                test = [instr(_LOAD_CONST, asm.const(chars)), instr(_CONTAINS_OP, 0)]
+            load = instr(_LOAD_FAST, 1)
+            if skip is not None:
+                skip.target = load
+            instrs += [load] + test
+            if order[target] <= order[state] and _POP_JUMP_IF_TRUE not in _BACKWARD_JUMP:
+                # 3.12+ only jump forwards on a condition
+                skip = instr(_POP_JUMP_IF_FALSE)
+                instrs += [skip, instr(_JUMP_FORWARD, target=heads[target])]
+            else:
+                skip = None
+                instrs.append(instr(_POP_JUMP_IF_TRUE, target=heads[target]))
+        if default is not None:
+            reject = [instr(_JUMP_FORWARD, target=heads[default])]
+        else:
+            # no transition for the character: pop it and the iterator and reject
+            reject = [instr(_POP_TOP), instr(_LOAD_CONST, false), instr(_RETURN_VALUE)]
+        if not moves:
+            reject.insert(0, instr(_POP_TOP))
+        if skip is not None:
+            skip.target = reject[0]
+        instrs += reject + exhausted
+    asm.instrs = instrs
+    return asm.assemble(co_varnames=('s', 'c'), co_nlocals=2, co_stacksize=3, co_name=name,
+                        co_qualname=name, co_filename='<dfa>', co_firstlineno=1)
+
+
+def dfa_function(transitions, start, accepting, name='dfa'):
+    '''As dfa_code, but return the function.'''
+    return types.FunctionType(dfa_code(transitions, start, accepting, name), {}, name)
+
+
+# Regular expressions compiled to recognisers: the pattern is parsed into a
+# Thompson NFA, whose states are lists of (characters, negated, next state)
+# moves and of moves that read nothing, and the subset construction turns
+# that into a DFA for dfa_code. The classes are re.ASCII's.
+
+_REGEX_CLASSES = {
+    'd': '0123456789',
+    'w': '0123456789_abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ',
+    's': ' \t\n\r\f\v',
+}
+_REGEX_ESCAPES = {'a': '\a', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+
+class _RegexParser:
+
+    def __init__(self, pattern, start, end):
+        self.pattern = pattern
+        self.pos = start
+        self.end = end
+        self.moves = []
+        self.empty = []
+        self.depth = 0  # of groups open
+
+    def error(self, message):
+        raise ValueError('{} at position {} of {!r}'.format(message, self.pos, self.pattern))
+
+    def peek(self):
+        return self.pattern[self.pos] if self.pos < self.end else None
+
+    def state(self):
+        self.moves.append([])
+        self.empty.append([])
+        return len(self.moves) - 1
+
+    def alternation(self):
+        start, end = self.state(), self.state()
+        while True:
+            first, last = self.sequence()
+            self.empty[start].append(first)
+            self.empty[last].append(end)
+            if self.peek() != '|':
+                return start, end
+            self.pos += 1
+
+    def at_dollar(self):
+        # $ ending a top-level alternative, which regex_dfa reads
+        return self.depth == 0 and self.peek() == '$' and self.pattern[self.pos + 1:self.pos + 2] in ('', '|')
+
+    def sequence(self):
+        start = end = self.state()
+        while self.peek() not in (None, '|', ')') and not self.at_dollar():
+            first, last = self.repeat()
+            self.empty[end].append(first)
+            end = last
+        return start, end
+
+    def repeat(self):
+        first, last = self.atom()
+        op = self.peek()
+        if op is None or op not in '*+?':
+            return first, last
+        self.pos += 1
+        if self.peek() == '?':
+            self.pos += 1  # lazy, which matches the same strings
+        if self.peek() is not None and self.peek() in '*+?{':
+            self.error('multiple repeat')
+        start, end = self.state(), self.state()
+        self.empty[start].append(first)
+        self.empty[last].append(end)
+        if op != '+':
+            self.empty[start].append(end)
+        if op != '?':
+            self.empty[last].append(first)
+        return start, end
+
+    def atom(self):
+        c = self.peek()
+        self.pos += 1
+        if c == '(':
+            if self.peek() == '?':
+                if not self.pattern.startswith('?:', self.pos):
+                    self.error('unsupported group')
+                self.pos += 2
+            self.depth += 1
+            start, end = self.alternation()
+            if self.peek() != ')':
+                self.error('missing )')
+            self.pos += 1
+            self.depth -= 1
+            return start, end
+        if c in '*+?':
+            self.error('nothing to repeat')
+        if c == '{':
+            self.error('counted repeats are not supported')
+        if c in '^$':
+            self.error('anchors are only supported at the start and end of top-level alternatives')
+        if c == '.':
+            chars, negated = frozenset('\n'), True
+        elif c == '[':
+            chars, negated = self.char_set()
+        elif c == '\\':
+            chars, negated = self.escape()
+        else:
+            chars, negated = frozenset(c), False
+        start, end = self.state(), self.state()
+        self.moves[start].append((chars, negated, end))
+        return start, end
+
+    def escape(self):
+        c = self.peek()
+        if c is None:
+            self.error('bad escape (end of pattern)')
+        self.pos += 1
+        if c.lower() in _REGEX_CLASSES:
+            return frozenset(_REGEX_CLASSES[c.lower()]), c.isupper()
+        if c in _REGEX_ESCAPES:
+            return frozenset(_REGEX_ESCAPES[c]), False
+        if c in _REGEX_CLASSES['w'] and c != '_':
+            self.error('unsupported escape \\' + c)
+        return frozenset(c), False
+
+    def char(self):
+        # one character of a set, for either end of a range
+        c = self.peek()
+        self.pos += 1
+        if c != '\\':
+            return frozenset(c)
+        chars, negated = self.escape()
+        if negated:
+            self.error('negated classes inside a set are not supported')
+        return chars
+
+    def char_set(self):
+        negated = self.peek() == '^'
+        if negated:
+            self.pos += 1
+        chars = set()
+        first = True
+        while True:
+            c = self.peek()
+            if c is None:
+                self.error('unterminated character set')
+            if c == ']' and not first:
+                self.pos += 1
+                return frozenset(chars), negated
+            first = False
+            low = self.char()
+            if (len(low) == 1 and self.peek() == '-' and self.pos + 1 < self.end
+                    and self.pattern[self.pos + 1] != ']'):
+                self.pos += 1
+                high = self.char()
+                if len(high) != 1 or min(high) < min(low):
+                    self.error('bad character range')
+                chars.update(map(chr, range(ord(min(low)), ord(min(high)) + 1)))
+            else:
+                chars |= low
+
+
+def regex_dfa(pattern):
+    r'''
+    Return (transitions, start, accepting) for dfa_code, for a DFA that
+    accepts the strings re.search(pattern, s, re.ASCII) finds a match in.
+
+    The pattern may use characters, ., sets such as [a-z_] and [^,], the
+    escapes \d \w \s \D \W \S, groups, |, ?, * and +, and ^ at the start and
+    $ at the end of the pattern or of any of its top-level alternatives.
+    Anything else raises ValueError.
+    '''
+    parser = _RegexParser(pattern, 0, len(pattern))
+    moves, empty = parser.moves, parser.empty
+    # start is the beginning of the string; anywhere, which reads any
+    # character, starts the alternatives without ^. Reaching final is a
+    # match whatever follows; reaching end, an alternative's $, is only a
+    # match at the end of the string, or before a newline there.
+    start, anywhere, final, end = parser.state(), parser.state(), parser.state(), parser.state()
+    moves[anywhere].append((frozenset(), True, anywhere))
+    newline = parser.state()
+    moves[end].append((frozenset('\n'), False, newline))
+    while True:
+        begin = parser.peek() == '^'
+        if begin:
+            parser.pos += 1
+        first, last = parser.sequence()
+        if parser.at_dollar():
+            parser.pos += 1
+            empty[last].append(end)
+        else:
+            empty[last].append(final)
+        if begin:
+            empty[start].append(first)
+        else:
+            if anywhere not in empty[start]:
+                empty[start].append(anywhere)
+            empty[anywhere].append(first)
+        if parser.peek() != '|':
+            break
+        parser.pos += 1
+    if parser.pos != len(pattern):
+        parser.error('unbalanced parenthesis')
+
+    closures = {}
+
+    def closure(states):
+        states = frozenset(states)
+        if states in closures:
+            return closures[states]
+        seen = set(states)
+        todo = list(states)
+        while todo:
+            for state in empty[todo.pop()]:
+                if state not in seen:
+                    seen.add(state)
+                    todo.append(state)
+        if final in seen:
+            # a match was found, whatever follows
+            seen = (final,)
+        closures[states] = frozenset(seen)
+        return closures[states]
+
+    ids = {}
+    todo = []
+
+    def state_id(states):
+        if states not in ids:
+            ids[states] = len(ids)
+            todo.append(states)
+        return ids[states]
+
+    # start itself has no moves and is left out, so that the DFA state for
+    # the beginning is the one that anywhere's loop comes back to
+    state_id(closure(empty[start]))
+    transitions = {}
+    accepting = set()
+    while todo:
+        states = todo.pop()
+        n = ids[states]
+        if final in states:
+            accepting.add(n)
+            transitions[n] = {None: n}
+            continue
+        if end in states or newline in states:
+            accepting.add(n)
+        edges = [move for state in states for move in moves[state]]
+        others = [target for chars, negated, target in edges if negated]
+        default = state_id(closure(others)) if others else None
+        classes = {}
+        for c in sorted(set().union(*(chars for chars, negated, target in edges))):
+            target = closure([target for chars, negated, target in edges if (c in chars) != negated])
+            if target or default is not None:
+                target = state_id(target)
+                if target != default:
+                    classes.setdefault(target, []).append(c)
+        # test the biggest classes, the likeliest to match, first
+        transitions[n] = {''.join(chars): target
+                          for target, chars in sorted(classes.items(), key=lambda item: -len(item[1]))}
+        if default is not None:
+            transitions[n][None] = default
+    return transitions, 0, accepting
+
+
+def regex_function(pattern, name='regex'):
+    '''
+    Return a function name(s) that returns True if re.search(pattern, s,
+    re.ASCII) would find a match, as a recogniser built by dfa_function.
+    See regex_dfa for the patterns supported. Needs Python 3.11 or later.
+    '''
+    return dfa_function(*regex_dfa(pattern), name=name)
+
+
+# Opt-in on-disk cache of rewritten code objects, keyed by a hash of the
+# original code object, the interpreter and this module's source.
+_cache_dir = os.environ.get('GOTO_CACHE_DIR') or None
+_cache_salt = None
+
+
+def set_cache_dir(path):
+    """
+    Store rewritten code objects under path and reuse them in later processes.
+    Pass None to disable the cache (the default unless GOTO_CACHE_DIR is set).
+    """
+    global _cache_dir
+    _cache_dir = None if path is None else os.fspath(path)
+
+
+def _cache_key(code):
+    global _cache_salt
+    if _cache_salt is None:
+        h = hashlib.sha256(importlib.util.MAGIC_NUMBER + sys.version.encode())
+        try:
+            with open(__file__, 'rb') as f:  # a changed rewriter invalidates every entry
+                h.update(f.read())
+        except OSError:
+            pass
+        _cache_salt = h.digest()
+    return hashlib.sha256(_cache_salt + marshal.dumps(code)).hexdigest()
+
+
+def _cache_load(path, key):
+    try:
+        with open(path, 'rb') as f:
+            entry = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    # Anything but our own (key, digest, marshalled code) is stale or corrupt
+    # and gets rebuilt. The digest is checked before the code is unmarshalled,
+    # so a damaged entry never runs.
+    if (not isinstance(entry, tuple) or len(entry) != 3 or entry[0] != key
+            or not isinstance(entry[2], bytes) or hashlib.sha256(entry[2]).hexdigest() != entry[1]):
+        return None
+    try:
+        code = marshal.loads(entry[2])
+    except (EOFError, ValueError, TypeError):
+        return None
+    return code if isinstance(code, types.CodeType) else None
+
+
+def _cache_store(path, key, code):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    data = marshal.dumps(code)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            marshal.dump((key, hashlib.sha256(data).hexdigest(), data), f)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+
+# Every rewritten code object ends its co_consts with this marker, so that
+# decorating an already rewritten function (or one loaded from a .pyc that
+# was rewritten at compile time) is a cheap no-op.
+REWRITTEN_MARKER = '__goto_rewritten__'
+
+# In-process memo of original code object -> rewritten code object. Nested
+# @goto functions get a fresh function object, but the same code object,
+# every time the enclosing function runs.
+_memo = weakref.WeakKeyDictionary()
+_memo_hits = 0
+_memo_misses = 0
+
+MemoInfo = collections.namedtuple('MemoInfo', 'hits misses currsize')
+
+
+def memo_info():
+    """Return a MemoInfo(hits, misses, currsize) for the in-process rewrite memo."""
+    return MemoInfo(_memo_hits, _memo_misses, len(_memo))
+
+
+def memo_clear():
+    """Empty the in-process rewrite memo and reset its counters."""
+    global _memo_hits, _memo_misses
+    _memo.clear()
+    _memo_hits = _memo_misses = 0
+
+
+def is_rewritten(code):
+    """Return True if code has already been through a goto rewriter."""
+    consts = code.co_consts
+    return bool(consts) and consts[-1] == REWRITTEN_MARKER
+
+
+def _rewrite(code, rewriter):
+    """Apply rewriter to code, going through the memo and the on-disk cache."""
+    global _memo_hits, _memo_misses
+    if is_rewritten(code):
+        _memo_hits += 1
+        return code
+    newcode = _memo.get(code)
+    # code objects compare equal across files, so check we have the right one
+    if newcode is not None and newcode.co_filename == code.co_filename:
+        _memo_hits += 1
+        return newcode
+    _memo_misses += 1
+    if _cache_dir is None:
+        newcode = rewriter(code)
+    else:
+        key = _cache_key(code)
+        path = os.path.join(_cache_dir, key + '.gotoc')
+        newcode = _cache_load(path, key)
+        if newcode is None:
+            newcode = rewriter(code)
+            _cache_store(path, key, newcode)
+    _memo[code] = newcode
+    return newcode
+
+
+# The specializing interpreter (3.11+) keeps its inline caches in the code
+# units after each adaptive instruction. The assembler lays them out zeroed,
+# exactly as the compiler does, so rewritten functions quicken like any other.
+
+Specialization = collections.namedtuple('Specialization', 'offset lineno opname specialized')
+
+
+def specialization_report(fn):
+    """
+    Return a Specialization(offset, lineno, opname, specialized) for every
+    instruction of fn (a function or code object) that the interpreter can
+    specialize. specialized is the specialized opname, or None if the
+    instruction is still generic. Call fn enough to warm it up first.
+    Before 3.11 there is nothing to report and the list is empty.
+    """
+    code = getattr(fn, '__code__', fn)
+    if sys.version_info < (3, 11):
+        return []
+    generic = {instr.offset: instr.opname for instr in dis.get_instructions(code)}
+    report = []
+    for instr in dis.get_instructions(code, adaptive=True):
+        opname = generic[instr.offset]
+        if not _CACHE_ENTRIES[dis.opmap[opname]]:
+            continue
+        specialized = instr.opname
+        if specialized == opname or specialized.endswith('_ADAPTIVE'):
+            specialized = None
+        report.append(Specialization(instr.offset, instr.positions.lineno, opname, specialized))
+    return report
+
+
+if sys.version_info >= (3, 12):
+    goto = goto3_12
+    rewrite_code = rewrite_code3_12
+    find_labels_and_gotos = find_labels_and_gotos3_12
+elif sys.version_info >= (3, 11):
     goto = goto3_11
+    rewrite_code = rewrite_code3_11
+    find_labels_and_gotos = find_labels_and_gotos3_11
+elif sys.version_info >= (3, 8):
+    goto = goto3_8
+    rewrite_code = rewrite_code3_8
+    find_labels_and_gotos = find_labels_and_gotos3_8
 else:
     goto = goto_pre311
+    rewrite_code = rewrite_code_pre311
+    find_labels_and_gotos = find_labels_and_gotos_pre311
+
+
+# Lazy rewriting. lazy_goto gives the function a trampoline with the same
+# signature, whose only constant that matters is a _LazyRewrite. The first
+# call rewrites the original code, installs it as __code__ and calls the
+# function again with the same arguments, so later calls pay nothing.
+# Generators and coroutines delegate to that call through yield from and
+# await, so they stay generators and coroutines until then.
+
+def _lazy_function():
+    return _lazy_call()
+
+
+def _lazy_generator():
+    return (yield from _lazy_call())
+
+
+async def _lazy_coroutine():
+    return await _lazy_call()
+
+
+_CO_GENERATORS = (inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE
+                  | inspect.CO_ASYNC_GENERATOR)
+_PROLOGUE = frozenset(dis.opmap[name] for name in ('COPY_FREE_VARS', 'MAKE_CELL') if name in dis.opmap)
+
+# lazy_goto functions not called yet -> their _LazyRewrite, in decoration order
+_lazy_pending = weakref.WeakKeyDictionary()
+
+
+class _LazyRewrite:
+    '''The trampoline's constant: rewrites and installs fn's code, then calls it.'''
+    __slots__ = ('fn', 'code', 'rewriter')
+
+    def __init__(self, fn, code, rewriter):
+        self.fn = weakref.ref(fn)  # fn's code refers to us
+        self.code = code
+        self.rewriter = rewriter
+
+    def install(self):
+        fn = self.fn()
+        if fn is None:
+            return None
+        # someone may have assigned __code__ since
+        if fn.__code__.co_consts[-1] is self:
+            fn.__code__ = _rewrite(self.code, self.rewriter)
+        _lazy_pending.pop(fn, None)
+        return fn
+
+    def __call__(self):
+        code = self.code
+        names = code.co_varnames
+        values = sys._getframe(1).f_locals  # the trampoline's, holding the arguments
+        n = code.co_argcount
+        k = n + code.co_kwonlyargcount
+        args = [values[name] for name in names[:n]]
+        kwargs = {name: values[name] for name in names[n:k]}
+        if code.co_flags & inspect.CO_VARARGS:
+            args.extend(values[names[k]])
+            k += 1
+        if code.co_flags & inspect.CO_VARKEYWORDS:
+            kwargs.update(values[names[k]])
+        del values
+        return self.install()(*args, **kwargs)
+
+
+def _trampoline(code, lazy):
+    '''Return a code object with code's signature that returns lazy().'''
+    if code.co_flags & inspect.CO_GENERATOR:
+        template = _lazy_generator.__code__
+    elif code.co_flags & (inspect.CO_COROUTINE | inspect.CO_ITERABLE_COROUTINE):
+        template = _lazy_coroutine.__code__
+    else:
+        template = _lazy_function.__code__
+    asm = Assembler(template)
+    asm.consts += (lazy,)
+    load = Instr(_LOAD_CONST, len(asm.consts) - 1)
+    call = [Instr(_PUSH_NULL), load] if sys.version_info < (3, 13) else [load, Instr(_PUSH_NULL)]
+    asm.substitute({ins: call for ins in asm.instrs if ins.opcode == _LOAD_GLOBAL})
+    # cells and free variables are set up as usual, so f_locals sees the arguments
+    prologue = [Instr(ins.opcode, ins.arg) for ins in Assembler(code).instrs if ins.opcode in _PROLOGUE]
+    asm.instrs[:0] = prologue
+    positions = (code.co_firstlineno, code.co_firstlineno, None, None)
+    for ins in asm.instrs:
+        ins.positions = positions
+    return asm.assemble(
+        co_argcount=code.co_argcount, co_posonlyargcount=code.co_posonlyargcount,
+        co_kwonlyargcount=code.co_kwonlyargcount, co_nlocals=code.co_nlocals,
+        co_varnames=code.co_varnames, co_cellvars=code.co_cellvars, co_freevars=code.co_freevars,
+        co_flags=template.co_flags & _CO_GENERATORS | code.co_flags & ~_CO_GENERATORS,
+        co_name=code.co_name, co_qualname=code.co_qualname, co_filename=code.co_filename,
+        co_firstlineno=code.co_firstlineno)
+
+
+def lazy_goto(fn):
+    '''
+    As goto, but the rewriting happens on fn's first call rather than now.
+    Until then errors such as MissingLabelError go unnoticed: call validate()
+    to rewrite and check every lazy_goto function eagerly. Async generators,
+    and everything before Python 3.11, are rewritten at once.
+    '''
+    code = fn.__code__
+    if (sys.version_info < (3, 11) or code.co_flags & inspect.CO_ASYNC_GENERATOR or is_rewritten(code)
+            or code in _memo):
+        return goto(fn)
+    lazy = _LazyRewrite(fn, code, rewrite_code)
+    fn.__code__ = _trampoline(code, lazy)
+    _lazy_pending[fn] = lazy
+    return fn
+
+
+def validate(*fns):
+    '''
+    Rewrite the given lazy_goto functions now, or with no arguments every
+    one that has not been called yet. Run it from a test or a build step to
+    keep import and first calls cheap while still catching a missing label
+    before it ships. Every function is tried; the first rewriting error is
+    then raised, with a note naming each of the others.
+    '''
+    errors = []
+    for fn in fns or list(_lazy_pending):
+        lazy = fn.__code__.co_consts[-1]
+        if isinstance(lazy, _LazyRewrite):
+            try:
+                lazy.install()
+            except Exception as e:
+                errors.append((fn, e))
+    if errors:
+        error = errors[0][1]
+        for fn, e in errors[1:]:
+            error.add_note('also {}: {}: {}'.format(fn.__qualname__, type(e).__name__, e))
+        raise error
+
+
+# Batch rewriting. Code objects cannot be pickled, so they travel to the
+# worker processes marshalled, and come back the same way to be installed.
+
+RewriteTiming = collections.namedtuple('RewriteTiming', 'qualname seconds')
+
+
+def _rewrite_marshalled(data, cache_dir):
+    '''Worker side of rewrite_module: return the marshalled rewrite and its time.'''
+    global _cache_dir
+    _cache_dir = cache_dir
+    code = marshal.loads(data)
+    start = time.perf_counter()
+    newcode = _rewrite(code, rewrite_code)
+    return marshal.dumps(newcode), time.perf_counter() - start
+
+
+def rewrite_module(module, max_workers=None):
+    '''
+    Rewrite every lazy_goto function of module that has not been called yet
+    in a pool of max_workers processes (default: one per CPU), and install
+    the results. Returns a RewriteTiming(qualname, seconds) for each code
+    object rewritten, in decoration order. The first rewriting error is
+    raised, after the functions rewritten without error are installed.
+    '''
+    namespace = vars(module)
+    pending = {}  # code -> [_LazyRewrite]; nested functions share their code
+    for fn, lazy in list(_lazy_pending.items()):
+        if fn.__globals__ is namespace:
+            pending.setdefault(lazy.code, []).append(lazy)
+    if not pending:
+        return []
+    timings = []
+    error = None
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+        futures = [(code, pool.submit(_rewrite_marshalled, marshal.dumps(code), _cache_dir))
+                   for code in pending]
+        for code, future in futures:
+            try:
+                data, seconds = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            _memo[code] = marshal.loads(data)
+            for lazy in pending[code]:
+                lazy.install()
+            timings.append(RewriteTiming(code.co_qualname, seconds))
+    if error is not None:
+        raise error
+    return timings
+
+
+# Instrumentation (3.11+). counted_goto and traced_goto rewrite with a probe
+# that inlines a small template function at every label and goto, with the
+# template's arguments turned into constants. Plain goto never passes a probe
+# and its code is unchanged.
+
+def _inline(asm, template, *values):
+    """
+    Return Instrs for asm that run the body of the function template, each
+    argument being the matching one of values, held as a constant of asm.
+    """
+    args = [asm.const(value) for value in values]
+    body = Assembler(template.__code__)
+    out = []
+    for ins in body.instrs[1:]:  # after RESUME
+        name = ins.opname
+        if name == 'LOAD_FAST':
+            out.append(Instr(_LOAD_CONST, args[ins.arg]))
+        elif name == 'LOAD_FAST_LOAD_FAST':  # 3.13+
+            out += [Instr(_LOAD_CONST, args[ins.arg >> 4]), Instr(_LOAD_CONST, args[ins.arg & 15])]
+        elif name == 'LOAD_CONST':
+            out.append(Instr(_LOAD_CONST, asm.const(body.consts[ins.arg])))
+        elif name == 'RETURN_VALUE':
+            out.pop()  # the LOAD_CONST None before it
+            break
+        elif name == 'RETURN_CONST':
+            break
+        else:
+            out.append(Instr(ins.opcode, ins.arg))
+    return out
+
+
+def _instrument(fn, name, probe):
+    _require_3_11(name)
+    if is_rewritten(fn.__code__):
+        raise ValueError('{} is already rewritten'.format(fn.__qualname__))
+    fn.__code__ = rewrite_code(fn.__code__, probe=probe)
+
+
+# Hit counters. The counters are an array of unsigned 64-bit ints in
+# co_consts, so an increment is counts[n] += 1 on a constant, eight bytes a
+# site. The array hashes and compares by identity, so the code object stays
+# hashable, and the counts do not make it equal to another.
+
+Site = collections.namedtuple('Site', 'kind label lineno')
+
+
+class _Counters(array.array):
+    __hash__ = object.__hash__
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+
+
+def _count_template(counts, n):
+    counts[n] += 1
+
+
+def counted_goto(fn):
+    '''
+    As goto, with a hit counter at every label and every goto. Read them with
+    hit_counts(fn) and zero them with reset_hit_counts(fn). The rewrite is
+    neither memoized nor cached, so each decorated function has counters of
+    its own. The counters live in fn.__code__.co_consts. Needs Python 3.11+.
+    '''
+    sites = []
+    counts = _Counters('Q')
+
+    def probe(asm, kind, name, ins):
+        if kind == 'entry':
+            return []
+        sites.append(Site(kind, name, ins.positions[0]))
+        counts.append(0)
+        return _inline(asm, _count_template, counts, len(counts) - 1)
+
+    _instrument(fn, 'counted_goto', probe)
+    fn.__goto_counts__ = (sites, counts)
+    return fn
+
+
+def hit_counts(fn):
+    '''
+    Return {Site(kind, label, lineno): hits} for a counted_goto function. kind
+    is 'label', counting each time control passed the label, or 'goto'. label
+    is the label's name, or None for a computed goto.
+    '''
+    sites, counts = fn.__goto_counts__
+    hits = {}
+    for site, count in zip(sites, counts):
+        hits[site] = hits.get(site, 0) + count
+    return hits
+
+
+def reset_hit_counts(fn):
+    '''Set every counter of a counted_goto function back to zero.'''
+    sites, counts = fn.__goto_counts__
+    counts[:] = array.array('Q', [0]) * len(counts)  # the code refers to this array
+
+
+# Transition traces. Each call appends None, and each label passed appends
+# its name, to a deque with a maxlen: a fixed-size ring buffer in C. The
+# constant is the deque's bound append, which hashes and compares by the
+# deque's identity, so the code object stays hashable and its constants keep
+# their value as the buffer fills. The interpreter specializes the call.
+
+def _trace_template(append, name):
+    append(name)
+
+
+def traced_goto(fn=None, *, size=256):
+    '''
+    As goto, recording the path through the labels in a ring buffer of the
+    last size labels passed. trace(fn) reads it, at any time, including after
+    an exception, and clear_trace(fn) empties it. Use as @traced_goto or
+    @traced_goto(size=...). Needs Python 3.11+.
+    '''
+    if fn is None:
+        return lambda fn: traced_goto(fn, size=size)
+    buffer = collections.deque(maxlen=size)
+
+    def probe(asm, kind, name, ins):
+        if kind == 'goto':
+            return []
+        return _inline(asm, _trace_template, buffer.append, name)
+
+    _instrument(fn, 'traced_goto', probe)
+    fn.__goto_trace__ = buffer
+    return fn
+
+
+def trace(fn):
+    '''
+    Return the transitions recorded for a traced_goto function, oldest first,
+    as (from_label, to_label) pairs. from_label is None for the first label
+    of a call.
+    '''
+    pairs = []
+    previous = start = object()  # the oldest entry's predecessor has been overwritten
+    for name in list(fn.__goto_trace__):
+        if name is not None and previous is not start:
+            pairs.append((previous, name))
+        previous = name
+    return pairs
+
+
+def clear_trace(fn):
+    '''Empty the trace of a traced_goto function.'''
+    fn.__goto_trace__.clear()
+
+
+# Fusing. Several functions are laid out one after another in a single code
+# object, each headed by a label statement named after it, with their locals
+# merged by name. A tail call from one to another becomes stores into the
+# callee's parameters and a goto to its label, and the result is rewritten
+# like any other goto function.
+
+_HASCONST = frozenset(op for op in dis.hasconst if op < 256)
+_HASNAME = frozenset(op for op in dis.hasname if op < 256)
+_HASLOCAL = frozenset(op for op in dis.haslocal if op < 256)
+_NAME_SHIFTS = {_LOAD_GLOBAL: 1}  # bits below the name index in the arg, 3.11+
+if sys.version_info >= (3, 12):
+    _NAME_SHIFTS[_LOAD_ATTR] = 1
+    _NAME_SHIFTS[dis.opmap['LOAD_SUPER_ATTR']] = 2
+_LOCAL_PAIRS = {op: (first, second) for op, first, second in (
+    (_LOAD_FAST_LOAD_FAST, _LOAD_FAST, _LOAD_FAST),
+    (_STORE_FAST_LOAD_FAST, _STORE_FAST, _LOAD_FAST),
+    (_STORE_FAST_STORE_FAST, _STORE_FAST, _STORE_FAST)) if op is not None}
+_KW_NAMES = dis.opmap.get('KW_NAMES')  # 3.11 and 3.12
+_CALL_KW = dis.opmap.get('CALL_KW')  # 3.13+
+
+
+def _relocate(asm, consts, names, varnames):
+    '''
+    Renumber the args of asm's instructions for a code object whose co_consts
+    is consts, with asm's own constants appended, and whose co_names and
+    co_varnames are the keys of the dicts names and varnames ({name: index}),
+    adding asm's names to them. Superinstructions whose two locals no longer
+    fit in four bits each are split.
+    '''
+    code = asm.code
+    base = len(consts)
+    consts.extend(code.co_consts)
+    new_names = [names.setdefault(name, len(names)) for name in code.co_names]
+    new_locals = [varnames.setdefault(name, len(varnames)) for name in code.co_varnames]
+    replacements = {}
+    for ins in asm.instrs:
+        op = ins.opcode
+        if op in _HASCONST:
+            ins.arg += base
+        elif op in _HASNAME:
+            shift = _NAME_SHIFTS.get(op, 0)
+            ins.arg = new_names[ins.arg >> shift] << shift | ins.arg & ((1 << shift) - 1)
+        elif op in _LOCAL_PAIRS:
+            first, second = new_locals[ins.arg >> 4], new_locals[ins.arg & 15]
+            if first < 16 and second < 16:
+                ins.arg = first << 4 | second
+            else:
+                replacements[ins] = [Instr(_LOCAL_PAIRS[op][0], first), Instr(_LOCAL_PAIRS[op][1], second)]
+        elif op in _HASLOCAL:
+            ins.arg = new_locals[ins.arg]
+    asm.substitute(replacements)
+
+
+def _statement(names, keyword, name):
+    '''Instrs for the statement 'label .name' or 'goto .name', as the compiler writes it.'''
+    attr = names.setdefault(name, len(names)) << _NAME_SHIFTS.get(_LOAD_ATTR, 0)
+    return [Instr(_LOAD_GLOBAL, names.setdefault(keyword, len(names)) << 1), Instr(_LOAD_ATTR, attr), Instr(_POP_TOP)]
+
+
+def _tail_calls(asm, names, consts):
+    '''
+    Yield (load_global, call, dropped, name, keywords) for each call in asm of
+    a global name whose result is returned straight away, perhaps after
+    leaving loops and except clauses. load_global is the LOAD_GLOBAL that
+    pushes the function (and a NULL), dropped the instructions between the
+    arguments and call that pass the keywords (and PRECALL), and keywords
+    the names of the last arguments. names and consts are asm's co_names
+    and co_consts. Calls with * or ** arguments are not included, nor calls
+    inside a try or with block, whose handler must see what the callee raises.
+    '''
+    instrs = asm.instrs
+    stacks = CFG(asm).stacks()
+    # the handlers of except clauses, which only restore the exception they
+    # replaced (and clear their 'as' name), as leaving the clause does anyway
+    cleanups = {ins.handler for ins in instrs if ins.opcode == _PUSH_EXC_INFO and ins.handler is not None}
+    cleanups |= {ins.handler for ins in instrs if ins.handler is not None
+                 and ins.handler.target.opcode == _LOAD_CONST and ins.handler.target.handler in cleanups}
+    for n, call in enumerate(instrs):
+        if (call.opcode != _CALL and call.opcode != _CALL_KW) or call not in stacks:
+            continue
+        after = n + 1
+        while True:
+            op = instrs[after].opcode
+            if op == _NOP:
+                after += 1
+            elif op == _SWAP and instrs[after].arg == 2 and instrs[after + 1].opcode in (_POP_TOP, _POP_EXCEPT):
+                after += 2
+            else:
+                break
+        if op != _RETURN_VALUE:
+            continue
+        first = n
+        keywords = ()
+        if call.opcode == _CALL_KW:  # 3.13+, the names are pushed last
+            first -= 1
+            if instrs[first].opcode != _LOAD_CONST:
+                continue
+            keywords = consts[instrs[first].arg]
+        else:
+            if instrs[first - 1].opcode == _PRECALL:
+                first -= 1
+            if instrs[first - 1].opcode == _KW_NAMES:
+                first -= 1
+                keywords = consts[instrs[first].arg]
+        depth = len(stacks[instrs[first]]) - call.arg - 2  # below the function, its NULL and the arguments
+        m = first - 1
+        while m > 0 and (instrs[m] not in stacks or len(stacks[instrs[m]]) > depth):
+            m -= 1
+        load_global = instrs[m]
+        if (load_global.opcode != _LOAD_GLOBAL or not load_global.arg & 1
+                or len(stacks[load_global]) != depth):
+            continue
+        # a handler inside the arguments would count the function and NULL in its depth
+        if any(ins.handler is not load_global.handler for ins in instrs[m:n + 1]):
+            continue
+        if any(handler not in cleanups for handler in _handler_chain(call)):
+            continue
+        yield load_global, call, instrs[first:n], names[load_global.arg >> 1], keywords
+
+
+def _bind(fn, nargs, keywords, varnames, consts):
+    '''
+    Return the Instrs that pop the nargs arguments of a call of fn, the last
+    of them passed by the names keywords, into fn's parameters, and store
+    fn's defaults in the parameters not passed. varnames maps local names to
+    their index, and the defaults are appended to the list consts. Return
+    None if the call would raise TypeError, or fn takes *args or **kwargs.
+    '''
+    code = fn.__code__
+    if code.co_flags & (inspect.CO_VARARGS | inspect.CO_VARKEYWORDS):
+        return None
+    params = code.co_varnames[:code.co_argcount + code.co_kwonlyargcount]
+    positional = nargs - len(keywords)
+    passed = params[:positional] + tuple(keywords)
+    if (positional > code.co_argcount or len(set(passed)) != len(passed)
+            or not set(keywords) <= set(params[code.co_posonlyargcount:])):
+        return None
+    defaults = dict(zip(params[code.co_argcount - len(fn.__defaults__ or ()):], fn.__defaults__ or ()))
+    defaults.update(fn.__kwdefaults__ or {})
+    missing = [param for param in params if param not in passed]
+    if not defaults.keys() >= set(missing):
+        return None
+    out = [Instr(_STORE_FAST, varnames[param]) for param in reversed(passed)]
+    for param in missing:
+        consts.append(defaults[param])
+        out += [Instr(_LOAD_CONST, len(consts) - 1), Instr(_STORE_FAST, varnames[param])]
+    return out
+
+
+def _fuse(fns, targets):
+    '''
+    Return the code object fusing the functions fns, the first being the
+    entry point, as described for fuse. Tail calls of a name in the dict
+    targets, {name: function}, become jumps to that function's region.
+    '''
+    _require_3_11('fusing')
+    entry = fns[0]
+    members = {}
+    for fn in fns:
+        code = fn.__code__
+        if is_rewritten(code):
+            raise ValueError('{} is already rewritten; pass the undecorated function'.format(fn.__qualname__))
+        if code.co_flags & _CO_GENERATORS or code.co_cellvars or code.co_freevars:
+            raise ValueError('{} is a generator, coroutine or closure, which cannot be fused'.format(
+                fn.__qualname__))
+        if fn.__globals__ is not entry.__globals__:
+            raise ValueError('{} is from another module'.format(fn.__qualname__))
+        if members.setdefault(fn.__name__, fn) is not fn:
+            raise ValueError('two functions are named {}'.format(fn.__name__))
+
+    consts = []
+    names = {}
+    varnames = {}  # entry's arguments first, and a tail call may store into a later function's
+    for fn in fns:
+        for name in fn.__code__.co_varnames:
+            varnames.setdefault(name, len(varnames))
+    instrs = []
+    for fn in fns:
+        asm = Assembler(fn.__code__)
+        _relocate(asm, consts, names, varnames)
+        resume = asm.instrs[0]
+        head = _statement(names, 'label', fn.__name__)
+        for ins in head:
+            ins.positions = resume.positions
+        replacements = {resume: ([resume] if fn is entry else []) + head}
+        for load_global, call, dropped, name, keywords in _tail_calls(asm, list(names), consts):
+            callee = targets.get(name)
+            stores = callee and _bind(callee, call.arg, keywords, varnames, consts)
+            if stores is None:
+                continue
+            for ins in [load_global] + dropped:
+                replacements[ins] = []
+            replacements[call] = stores + _statement(names, 'goto', name)
+        asm.substitute(replacements)
+        instrs += asm.instrs
+
+    asm = Assembler(entry.__code__)
+    asm.instrs = instrs
+    asm.consts = tuple(consts)
+    code = asm.assemble(co_names=tuple(names), co_varnames=tuple(varnames), co_nlocals=len(varnames),
+                        co_stacksize=max(fn.__code__.co_stacksize for fn in fns))
+    computed = []
+    labels = find_labels_and_gotos(code, computed=computed)
+    # the other functions' regions are only reached through gotos
+    return patch_code3_11(code, labels, computed, entries=[labels[fn.__name__].load_global_idx for fn in fns[1:]])
+
+
+def fuse(entry, *others):
+    '''
+    Return a function with entry's signature that runs entry, fused with the
+    functions others into one goto function, so that control passes between
+    them without a call. Each function's code is a region of the new code
+    object headed by 'label .name', where name is the function's __name__,
+    and the functions share one set of locals: a local keeps its value
+    from region to region.
+
+    'return name(args)' of a fused function becomes a jump to its region,
+    with args stored in its parameters (and its defaults in the rest), when
+    name is a global bound to the function. Other calls, calls with * or **
+    arguments and calls in a try body or with block, whose handler must see
+    what the callee raises, stay calls. A goto in any region may jump to any label
+    in the others, and labels must be unique across all of them. Generators,
+    coroutines and closures cannot be fused. Pass the functions undecorated.
+    Needs Python 3.11+.
+    '''
+    fns = (entry,) + others
+    targets = {fn.__name__: fn for fn in fns if entry.__globals__.get(fn.__name__) is fn}
+    fused = types.FunctionType(_fuse(fns, targets), entry.__globals__, entry.__name__,
+                               entry.__defaults__, entry.__closure__)
+    fused.__kwdefaults__ = entry.__kwdefaults__
+    fused.__qualname__ = entry.__qualname__
+    fused.__doc__ = entry.__doc__
+    fused.__dict__.update(entry.__dict__)
+    return fused
+
+
+def tail_goto(fn):
+    '''
+    As goto, and each self-recursive tail call, 'return fn(args)' where fn is
+    the function's global name, stores args in the parameters (and the
+    defaults in the rest) and jumps back to the start of the function, so
+    the recursion runs in one frame, however deep. Other locals keep their
+    values from the previous round. Calls with * or ** arguments, and calls
+    in a try body or with block, stay calls. Generators, coroutines and closures cannot be decorated. Needs
+    Python 3.11+.
+    '''
+    fn.__code__ = _fuse((fn,), {fn.__name__: fn})
+    return fn
+
+
+# Resumable functions. 'suspend .name' is compiled to a goto to a block at the
+# end of the function that returns Suspended(fn, 'name', locals()). Resuming
+# runs one of a second set of code objects, one per suspend label, made from
+# the same code: their only argument is the dict of locals, which a prologue
+# stores back before it does 'goto .name'.
+
+class Suspended:
+    '''
+    What a resumable function returns at 'suspend .label': the function, the
+    label to resume at and the dict of its locals, all of which it keeps.
+    It can be copied or pickled, to resume the same state more than once.
+    '''
+    __slots__ = ('fn', 'label', 'locals')
+
+    def __init__(self, fn, label, locals):
+        self.fn = fn
+        self.label = label
+        self.locals = locals
+
+    def resume(self, **changes):
+        '''
+        Run the function on from the label, with its locals as they were
+        but for changes, and return its result: perhaps another Suspended.
+        '''
+        return self.fn.__goto_resume__[self.label](dict(self.locals, **changes))
+
+    def __repr__(self):
+        return '<Suspended {} at {}>'.format(self.fn.__qualname__, self.label)
+
+
+def _suspend_template(suspended, fn, label, locals_):
+    suspended(fn, label, locals_())
+
+
+def _resumable_code(fn, code, resume_at=None):
+    '''
+    Return code, which is fn's, rewritten with its suspend statements, and
+    the labels they suspend at. With resume_at, the code object instead
+    takes a dict of locals, stores them and continues at the label
+    resume_at.
+    '''
+    asm = Assembler(code)
+    consts = []
+    names = {}
+    varnames = {'.locals': 0} if resume_at else {}
+    _relocate(asm, consts, names, varnames)
+    asm.consts = tuple(consts)
+    co_names = list(names)
+    instrs = asm.instrs
+    replacements = {}
+    ends = {}  # suspend label -> the code returning the Suspended
+    for load_global, load_attr, pop_top in zip(instrs, instrs[1:], instrs[2:]):
+        if (load_global.opcode != _LOAD_GLOBAL or co_names[load_global.arg >> 1] != 'suspend'
+                or load_attr.opcode != _LOAD_ATTR or pop_top.opcode != _POP_TOP):
+            continue
+        label = co_names[load_attr.arg >> _NAME_SHIFTS.get(_LOAD_ATTR, 0)]
+        end = '<suspend {}>'.format(label)
+        if label not in ends:
+            ends[label] = _statement(names, 'label', end) + _inline(
+                asm, _suspend_template, Suspended, fn, label, locals)[:-1] + [Instr(_RETURN_VALUE)]
+            for ins in ends[label]:
+                ins.positions = load_global.positions
+        replacements[load_global] = _statement(names, 'goto', end)
+        replacements[load_attr] = replacements[pop_top] = []
+
+    if resume_at:
+        prologue = []
+        for name, local in list(varnames.items())[1:]:
+            prologue += [Instr(_LOAD_CONST, asm.const(name)), Instr(_LOAD_FAST, 0), Instr(_CONTAINS_OP, 0),
+                         Instr(_POP_JUMP_IF_FALSE), Instr(_LOAD_FAST, 0), Instr(_LOAD_CONST, asm.const(name)),
+                         Instr(_BINARY_SUBSCR), Instr(_STORE_FAST, local)]
+        prologue += [Instr(_DELETE_FAST, 0)] + _statement(names, 'goto', resume_at)
+        for n, ins in enumerate(prologue):
+            if ins.opcode == _POP_JUMP_IF_FALSE:
+                ins.target = prologue[n + 5]
+        replacements[instrs[0]] = [instrs[0]] + prologue
+    asm.substitute(replacements)
+    for label in ends:
+        asm.instrs += ends[label]
+
+    changes = {}
+    if resume_at:
+        changes = dict(co_argcount=1, co_posonlyargcount=0, co_kwonlyargcount=0,
+                       co_flags=code.co_flags & ~(inspect.CO_VARARGS | inspect.CO_VARKEYWORDS))
+    stacksize = max(code.co_stacksize, _suspend_template.__code__.co_stacksize)
+    code = asm.assemble(co_names=tuple(names), co_varnames=tuple(varnames), co_nlocals=len(varnames),
+                        co_stacksize=stacksize, **changes)
+    computed = []
+    labels = find_labels_and_gotos(code, computed=computed)
+    entries = [labels['<suspend {}>'.format(label)].load_global_idx for label in ends]
+    return patch_code3_11(code, labels, computed, entries=entries), list(ends)
+
+
+def resumable(fn):
+    '''
+    As goto, and the statement 'suspend .name' returns a Suspended holding
+    fn's locals, whose resume(**changes) method runs fn on from the label
+    name, with the locals restored and changes made to them. A parser can
+    suspend itself when it runs out of input, and be resumed with the next
+    chunk. The labels suspended at must be outside loops, with and try
+    blocks; 'suspend' may be anywhere a goto may. Generators, coroutines
+    and closures cannot be decorated. Needs Python 3.11+.
+    '''
+    _require_3_11('resumable')
+    code = fn.__code__
+    if is_rewritten(code):
+        raise ValueError('{} is already rewritten; pass the undecorated function'.format(fn.__qualname__))
+    if code.co_flags & _CO_GENERATORS or code.co_cellvars or code.co_freevars:
+        raise ValueError('{} is a generator, coroutine or closure, which cannot be resumable'.format(
+            fn.__qualname__))
+    new_code, labels = _resumable_code(fn, code)
+    fn.__goto_resume__ = {label: types.FunctionType(_resumable_code(fn, code, label)[0], fn.__globals__,
+                                                    fn.__name__) for label in labels}
+    fn.__code__ = new_code
+    return fn
+
+
+# Compile-time rewriting. The decorator is found in the AST, and the matching
+# code objects are rewritten before the module code is written to __pycache__.
+# At import the decorator then sees already rewritten code and does nothing.
+_DECORATOR_NAMES = frozenset(('goto', 'goto3_12', 'goto3_11', 'goto3_8', 'goto_pre311', 'lazy_goto'))
+
+
+def _goto_function_keys(tree):
+    """Return {(name, firstlineno)} of the @goto-decorated functions in tree."""
+    keys = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        for dec in node.decorator_list:
+            name = dec.attr if isinstance(dec, ast.Attribute) else getattr(dec, 'id', None)
+            if name in _DECORATOR_NAMES:
+                # co_firstlineno of a decorated function is its first decorator's line
+                keys.add((node.name, min(d.lineno for d in node.decorator_list)))
+                break
+    return keys
+
+
+def _rewrite_marked(code, keys):
+    consts = tuple(_rewrite_marked(const, keys) if isinstance(const, types.CodeType) else const
+                   for const in code.co_consts)
+    if consts != code.co_consts:
+        code = code.replace(co_consts=consts)
+    if (code.co_name, code.co_firstlineno) in keys:
+        code = rewrite_code(code)
+    return code
+
+
+def compile_source(source, path, optimize=-1):
+    """
+    Compile module source like compile(), with every @goto function in it
+    already rewritten.
+    """
+    if b'goto' not in (source if isinstance(source, bytes) else source.encode()):
+        return compile(source, path, 'exec', dont_inherit=True, optimize=optimize)
+    tree = ast.parse(source, path)
+    code = compile(tree, path, 'exec', dont_inherit=True, optimize=optimize)
+    keys = _goto_function_keys(tree)
+    return _rewrite_marked(code, keys) if keys else code
+
+
+class GotoLoader(importlib.machinery.SourceFileLoader):
+    """Source loader whose bytecode (and so its .pyc) has gotos already compiled."""
+
+    def source_to_code(self, data, path, *, _optimize=-1):
+        return compile_source(data, path, _optimize)
+
+
+class GotoFinder:
+    """sys.meta_path finder that hands source modules to GotoLoader."""
+
+    @classmethod
+    def find_spec(cls, fullname, path=None, target=None):
+        spec = importlib.machinery.PathFinder.find_spec(fullname, path, target)
+        if spec is not None and type(spec.loader) is importlib.machinery.SourceFileLoader:
+            spec.loader = GotoLoader(spec.loader.name, spec.loader.path)
+        return spec
+
+
+def install_import_hook():
+    """
+    Rewrite @goto functions when modules are compiled rather than when they are
+    imported. Only affects modules without an up-to-date .pyc; use
+    'python -m goto compile' to (re)build those.
+    """
+    if GotoFinder not in sys.meta_path:
+        sys.meta_path.insert(0, GotoFinder)
+
+
+def uninstall_import_hook():
+    if GotoFinder in sys.meta_path:
+        sys.meta_path.remove(GotoFinder)
+
+
+def compile_file(path, optimize=-1):
+    """Write the .pyc for the source file at path, with gotos already rewritten."""
+    with open(path, 'rb') as f:
+        source = f.read()
+    code = compile_source(source, path, optimize)
+    st = os.stat(path)
+    # the same private helper py_compile uses to build a timestamp-based .pyc
+    data = importlib._bootstrap_external._code_to_timestamp_pyc(code, st.st_mtime, st.st_size)
+    cfile = importlib.util.cache_from_source(
+        path, optimization='' if optimize < 1 else optimize)
+    os.makedirs(os.path.dirname(cfile), exist_ok=True)
+    importlib._bootstrap_external._write_atomic(cfile, data, importlib._bootstrap_external._calc_mode(path))
+    return cfile
+
+
+def compile_dir(directory, quiet=False):
+    """
+    Run compile_file on every .py file under directory. A file that fails is
+    reported on stderr and skipped, as compileall does. Return True if all
+    succeeded.
+    """
+    ok = True
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for name in sorted(files):
+            if not name.endswith('.py'):
+                continue
+            path = os.path.join(root, name)
+            if not quiet:
+                print('Compiling {!r}...'.format(path))
+            try:
+                compile_file(path)
+            except Exception as e:
+                print('{}: {}: {}'.format(path, type(e).__name__, e), file=sys.stderr)
+                ok = False
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m goto')
+    commands = parser.add_subparsers(dest='command', required=True)
+    compile_parser = commands.add_parser(
+        'compile', help='write __pycache__ bytecode with @goto functions already rewritten')
+    compile_parser.add_argument('dirs', nargs='+', metavar='dir')
+    compile_parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args(argv)
+    ok = all([compile_dir(d, args.quiet) for d in args.dirs])
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,24 @@
+import argparse
+import ast
+import dis
+import functools
+import inspect
+import json
+import math
+import platform
 import re
 import random
+import statistics
+import sys
+import textwrap
+import time
 import timeit
+import types
 from enum import Enum
 
 from statemachine import StateMachine, State
 
+import goto as goto_module
 from goto import goto
 
 
@@ -229,6 +243,20 @@ def run_re(s):
     m = fpsum_re.match(s)
     assert(m.endpos == len(s))
 
+DIGITS = '0123456789'
+FPSUM_DFA = {
+    'start': {DIGITS: 'digits1'},
+    'digits1': {DIGITS: 'digits1', '+': 'start', '.': 'dot', 'e': 'exp', '$': 'done'},
+    'dot': {DIGITS: 'digits2'},
+    'digits2': {DIGITS: 'digits2', '+': 'start', 'e': 'exp', '$': 'done'},
+    'exp': {'+-': 'expsign'},
+    'expsign': {DIGITS: 'expdigits'},
+    'expdigits': {DIGITS: 'expdigits', '+': 'start', '$': 'done'},
+}
+# dfa_function assembles 3.11+ bytecode
+run_dfa = goto_module.dfa_function(FPSUM_DFA, 'start', {'done'}, 'run_dfa') if sys.version_info >= (3, 11) else None
+
+
 def generate_str(n: int, seed: int = None) -> str:
     if seed is not None:
         random.seed(seed)
@@ -255,15 +283,485 @@ def generate_str(n: int, seed: int = None) -> str:
 def run_dummy(s):
     return s
 
-if __name__ == '__main__':
+
+def make_goto_source(n_states: int) -> str:
+    '''
+    Source for a machine-generated style goto function: n_states labels in a
+    ring, each doing a little work and jumping to the next one.
+    '''
+    lines = ['def generated(n):', '    i = 0']
+    for state in range(n_states):
+        lines += ['    label .s{}'.format(state),
+                  '    i += 1',
+                  '    if i > n:',
+                  '        return i',
+                  '    goto .s{}'.format((state + 1) % n_states)]
+    return '\n'.join(lines) + '\n'
+
+
+def dis_scan(code, wanted):
+    '''The dis.get_instructions() equivalent of goto.scan_code, for comparison.'''
+    for ins in dis.get_instructions(code):
+        if ins.opcode in wanted:
+            yield ins.offset, ins.opcode, ins.arg
+
+
+def bench_decoration(n_states: int = 1000, number: int = 10):
+    ns = {}
+    exec(make_goto_source(n_states), ns)
+    code = ns['generated'].__code__
+    print('Instructions:', len(code.co_code) // 2)
+    d = timeit.timeit(lambda: goto_module.find_labels_and_gotos(code, scan=dis_scan), number=number)
+    print('label discovery (dis):', d / number)
+    d = timeit.timeit(lambda: goto_module.find_labels_and_gotos(code), number=number)
+    print('label discovery (scan_code):', d / number)
+    d = timeit.timeit(lambda: goto_module.rewrite_code(code), number=number)
+    print('full rewrite:', d / number)
+
+def undecorated(fn):
+    '''Recompile fn from its source without its decorators.'''
+    tree = ast.parse(textwrap.dedent(inspect.getsource(fn)))
+    tree.body[0].decorator_list = []
+    ns = {}
+    exec(compile(tree, inspect.getsourcefile(fn), 'exec'), fn.__globals__, ns)
+    return ns[fn.__name__]
+
+
+def nop_sled(code, width):
+    '''Widen every NOP in code to width NOPs.'''
+    asm = goto_module.Assembler(code)
+    nop = dis.opmap['NOP']
+    asm.substitute({ins: [ins] + [goto_module.Instr(nop) for _ in range(width - 1)]
+                    for ins in asm.instrs if ins.opcode == nop})
+    return asm.assemble()
+
+
+def bench_label_dispatch(s: str, number: int = 1000):
+    '''
+    Time run_goto with the labels compacted away, with one NOP per label, and
+    with the 12 NOP sled per label that patching the bytecode in place used to
+    leave (LOAD_GLOBAL, LOAD_ATTR, their caches and the POP_TOP).
+    '''
+    code = undecorated(run_goto).__code__
+    variants = [
+        ('NOP sled', nop_sled(goto_module.rewrite_code(code, compact=False), 12)),
+        ('one NOP', goto_module.rewrite_code(code, compact=False)),
+        ('compacted', goto_module.rewrite_code(code)),
+    ]
+    for name, variant in variants:
+        fn = types.FunctionType(variant, run_goto.__globals__)
+        assert fn(s)
+        d = timeit.timeit(lambda: fn(s), number=number)
+        print('goto labels, {}: {} per run, {} ns per character'.format(
+            name, d / number, d / number / len(s) * 1e9))
+
+
+def make_dispatch_source(n_states: int, computed: bool) -> str:
+    '''
+    Source for a goto state machine that steps round a ring of n_states states,
+    picking each next state with goto[state] or with an if/elif chain.
+    '''
+    lines = ['def dispatch(steps):',
+             '    state = "s0"',
+             '    label .loop',
+             '    steps -= 1',
+             '    if steps < 0:',
+             '        return state']
+    if computed:
+        lines.append('    goto[state]')
+    else:
+        for k in range(n_states):
+            lines += ['    {} state == "s{}":'.format('if' if k == 0 else 'elif', k),
+                      '        goto .s{}'.format(k)]
+    for k in range(n_states):
+        lines += ['    label .s{}'.format(k),
+                  '    state = "s{}"'.format((k + 1) % n_states),
+                  '    goto .loop']
+    return '\n'.join(lines) + '\n'
+
+
+def bench_computed_goto(sizes=(4, 16, 64, 256, 1024), steps: int = 100000):
+    for n_states in sizes:
+        times = []
+        for computed in (True, False):
+            ns = {}
+            exec(make_dispatch_source(n_states, computed), ns)
+            fn = goto(ns['dispatch'])
+            times.append(min(timeit.repeat(lambda: fn(steps), number=1, repeat=3)) / steps)
+        print('{} states: goto[state] {:.1f} ns, if/elif {:.1f} ns per transition'.format(
+            n_states, times[0] * 1e9, times[1] * 1e9))
+
+
+def bench_dfa(sizes=(20, 200, 2000), number: int = 200):
+    '''Compare the generated DFA recogniser with the hand-written ones.'''
+    for n in sizes:
+        s = generate_str(n, seed=1236)
+        assert run_dfa(s) and run_goto(s)
+        results = []
+        for name, fn in (('dfa', run_dfa), ('goto', run_goto), ('re', run_re), ('match', run_match)):
+            d = min(timeit.repeat(lambda: fn(s), number=number, repeat=3)) / number
+            results.append('{} {:.1f} ns'.format(name, d / len(s) * 1e9))
+        print('{} numbers ({} chars), per character: {}'.format(n, len(s), ', '.join(results)))
+    d = timeit.timeit(lambda: goto_module.dfa_function(FPSUM_DFA, 'start', {'done'}), number=1000)
+    print('building the FPSum recogniser: {:.1f} us'.format(d / 1000 * 1e6))
+
+
+FPSUM_PATTERN = r'^\d+(\.\d+)?(e[+-]\d+)?(\+\d+(\.\d+)?(e[+-]\d+)?)*\$$'
+EMAIL_PATTERN = r'[a-z]+@[a-z]+\.(com|org)'
+
+
+def bench_regex(sizes=(200, 2000, 20000), number: int = 100):
+    '''Compare recognisers compiled by regex_function with re.search.'''
+    random.seed(1236)
+    for pattern in (FPSUM_PATTERN, EMAIL_PATTERN):
+        fn = goto_module.regex_function(pattern)
+        rx = re.compile(pattern, re.ASCII)
+        for n in sizes:
+            if pattern is FPSUM_PATTERN:
+                s = generate_str(n // 10)
+            else:
+                # words but no address, so both read it all
+                s = ' '.join(''.join(random.choice('abcdefghij.@') for _ in range(6)) for _ in range(n // 7))
+            assert fn(s) == bool(rx.search(s))
+            results = []
+            for name, f in (('goto', fn), ('re', rx.search)):
+                d = min(timeit.repeat(lambda: f(s), number=number, repeat=3)) / number
+                results.append('{} {:.1f} ns'.format(name, d / len(s) * 1e9))
+            print('{!r}, {} chars, per character: {}'.format(pattern, len(s), ', '.join(results)))
+        regex = timeit.timeit(lambda: goto_module.regex_function(pattern), number=100) / 100
+
+        def compile_re():
+            re.purge()
+            re.compile(pattern, re.ASCII)
+
+        d = timeit.timeit(compile_re, number=100) / 100
+        print('compiling {!r}: goto {:.1f} us, re {:.1f} us'.format(pattern, regex * 1e6, d * 1e6))
+
+
+def mod3_r0(s, i=0):
+    if i == len(s):
+        return True
+    if s[i] == '1':
+        return mod3_r1(s, i + 1)
+    return mod3_r0(s, i + 1)
+
+
+def mod3_r1(s, i):
+    if i == len(s):
+        return False
+    if s[i] == '1':
+        return mod3_r0(s, i + 1)
+    return mod3_r2(s, i + 1)
+
+
+def mod3_r2(s, i):
+    if i == len(s):
+        return False
+    if s[i] == '1':
+        return mod3_r2(s, i + 1)
+    return mod3_r1(s, i + 1)
+
+
+def bench_fuse(n: int = 500, number: int = 200):
+    '''
+    Compare a binary multiple-of-three recogniser written as three functions
+    that tail call each other, one call per transition, with the same
+    functions fused into one. n stays under the recursion limit.
+    '''
+    fused = goto_module.fuse(mod3_r0, mod3_r1, mod3_r2)
+    s = format(3 * random.Random(1236).getrandbits(n - 2), 'b').zfill(n)
+    assert fused(s) and mod3_r0(s)
+    results = []
+    for name, fn in (('calls', mod3_r0), ('fused', fused)):
+        d = min(timeit.repeat(lambda: fn(s, 0), number=number, repeat=3)) / number
+        results.append('{} {:.1f} ns'.format(name, d / n * 1e9))
+    print('state machine split over functions, per transition: {}'.format(', '.join(results)))
+
+
+def triangle(n, acc=0):
+    if n == 0:
+        return acc
+    return triangle(n - 1, acc + n)
+
+
+def bench_tail_goto(sizes=(10, 100, 900), number: int = 200):
+    '''
+    Compare a self-recursive tail call with tail_goto's jump, per call or
+    jump. The sizes stay under the recursion limit.
+    '''
+    looped = goto_module.tail_goto(undecorated(triangle))
+    for n in sizes:
+        assert looped(n) == triangle(n)
+        results = []
+        for name, fn in (('recursive', triangle), ('tail_goto', looped)):
+            d = min(timeit.repeat(lambda: fn(n), number=number, repeat=3)) / number
+            results.append('{} {:.1f} ns'.format(name, d / n * 1e9))
+        print('tail recursion {} deep, per call: {}'.format(n, ', '.join(results)))
+
+
+def sum_ints(data):
+    total = 0
+    value = None
+    label .more
+    for c in data:
+        if c in DIGITS:
+            value = (value or 0) * 10 + ord(c) - 48
+        elif value is not None:
+            total += value
+            value = None
+    if data:
+        suspend .more
+    if value is not None:
+        total += value
+    return total
+
+
+def sum_chunks(parse, chunks):
+    state = parse(next(chunks))
+    for chunk in chunks:
+        state = state.resume(data=chunk)
+    return state.resume(data='')
+
+
+def bench_resumable(n: int = 100000, chunk_sizes=(16, 256, 4096), number: int = 10):
+    '''
+    Time a resumable parser fed its input whole and in chunks, which it
+    suspends and is resumed between, per character.
+    '''
+    parse = goto_module.resumable(undecorated(sum_ints))
+    s = ' '.join(str(k) for k in range(n))
+    expected = n * (n - 1) // 2
+    assert parse(s).resume(data='') == expected
+    d = min(timeit.repeat(lambda: parse(s).resume(data=''), number=number, repeat=3)) / number
+    results = ['whole {:.1f} ns'.format(d / len(s) * 1e9)]
+    for size in chunk_sizes:
+        chunks = [s[i:i + size] for i in range(0, len(s), size)]
+        assert sum_chunks(parse, iter(chunks)) == expected
+        d = min(timeit.repeat(lambda: sum_chunks(parse, iter(chunks)), number=number, repeat=3)) / number
+        results.append('{}-char chunks {:.1f} ns'.format(size, d / len(s) * 1e9))
+    print('resumable parser, per character: {}'.format(', '.join(results)))
+
+
+def make_synthetic_source(labels: int = 100, gotos: int = 100, filler: int = 4, depth: int = 0) -> str:
+    '''
+    Source for a synthetic goto function: labels label blocks, each with filler
+    statements, and gotos gotos spread over the blocks, each one inside depth
+    nested for loops that it jumps out of.
+    '''
+    lines = ['def synthetic(n, r):', '    i = 0']
+    for k in range(labels):
+        lines.append('    label .l{}'.format(k))
+        lines += ['    i += {}'.format(f + 1) for f in range(filler)]
+        for g in range(k * gotos // labels, (k + 1) * gotos // labels):
+            indent = '    '
+            for d in range(depth):
+                lines.append('{}for _{} in r:'.format(indent, d))
+                indent += '    '
+            lines += ['{}if i == {}:'.format(indent, g),
+                      '{}    goto .l{}'.format(indent, (g * 7 + 3) % labels)]
+    lines.append('    return i')
+    return '\n'.join(lines) + '\n'
+
+
+SCALING_BASE = {'labels': 100, 'gotos': 100, 'filler': 4, 'depth': 0}
+SCALING_GRID = {
+    'labels': [100, 200, 400, 800, 1600, 3200],
+    'gotos': [100, 200, 400, 800, 1600, 3200],
+    'filler': [4, 8, 16, 32, 64, 128],
+    'depth': [1, 2, 4, 8, 12, 16],  # Python allows 20 nested blocks
+}
+
+
+def time_decoration(code, runs: int = 5) -> dict:
+    '''Best-of-runs seconds for label discovery and for patching code.'''
+    find = patch = float('inf')
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        computed = []
+        labels = goto_module.find_labels_and_gotos(code, computed=computed)
+        t1 = time.perf_counter()
+        goto_module.patch_code3_11(code, labels, computed)
+        t2 = time.perf_counter()
+        find = min(find, t1 - t0)
+        patch = min(patch, t2 - t1)
+    return {'find': find, 'patch': patch}
+
+
+def growth_exponent(xs, ys) -> float:
+    '''Least squares slope of log(y) against log(x): 1 is linear, 2 quadratic.'''
+    lx = [math.log(x) for x in xs]
+    ly = [math.log(y) for y in ys]
+    mx = statistics.fmean(lx)
+    my = statistics.fmean(ly)
+    return sum((a - mx) * (b - my) for a, b in zip(lx, ly)) / sum((a - mx) ** 2 for a in lx)
+
+
+def bench_decoration_scaling(grid=None, runs: int = 5, limit: float = 1.3, log=print) -> dict:
+    '''
+    Vary one parameter of make_synthetic_source at a time and time both phases
+    of decoration. Report how each phase grows with the function's size in
+    instructions; an exponent above limit is flagged as super-linear.
+    '''
+    report = {}
+    for param, values in (grid or SCALING_GRID).items():
+        rows = []
+        for value in values:
+            ns = {}
+            exec(make_synthetic_source(**dict(SCALING_BASE, **{param: value})), ns)
+            code = ns['synthetic'].__code__
+            row = time_decoration(code, runs)
+            row.update(value=value, instructions=sum(1 for _ in dis.get_instructions(code)))  # not cache slots
+            rows.append(row)
+            log('{:>7} = {:>5}: {:>7} instructions, find {:.2e} s, patch {:.2e} s'.format(
+                param, value, row['instructions'], row['find'], row['patch']))
+        sizes = [row['instructions'] for row in rows]
+        exponents = {phase: growth_exponent(sizes, [row[phase] for row in rows]) for phase in ('find', 'patch')}
+        for phase, exponent in exponents.items():
+            log('{:>7}: {} grows as instructions^{:.2f}{}'.format(
+                param, phase, exponent, '  SUPER-LINEAR' if exponent > limit else ''))
+        report[param] = {'rows': rows, 'exponents': exponents}
+    return report
+
+
+ENGINES = {
+    'python-statemachine': run_import_statemachine,
+    'match': run_match,
+    're': run_re,
+    'goto': run_goto,
+}
+if run_dfa is not None:
+    ENGINES['dfa'] = run_dfa
+
+
+def measure(fn, s: str, runs: int = 7, warmup: int = 3, min_time: float = 0.05) -> dict:
+    '''
+    Time fn(s): warm up (which also lets the interpreter specialise), pick a
+    loop count so that one run takes at least min_time, then take runs samples.
+    Times are seconds per call.
+    '''
+    for _ in range(warmup):
+        fn(s)
+    timer = timeit.Timer(lambda: fn(s))
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    samples = sorted(t / number for t in timer.repeat(repeat=runs, number=number))
+    q1, median, q3 = statistics.quantiles(samples, n=4, method='inclusive')
+    return {'median': median, 'q1': q1, 'q3': q3, 'min': samples[0], 'max': samples[-1],
+            'number': number, 'samples': samples}
+
+
+def run_suite(sizes=(20, 200, 2000), seed: int = 1236, engines=None, runs: int = 7, warmup: int = 3,
+              min_time: float = 0.05, log=print) -> dict:
+    '''Measure every engine on a generate_str input of each size.'''
+    results = []
+    for n in sizes:
+        s = generate_str(n, seed=seed)
+        for name in engines or ENGINES:
+            result = measure(ENGINES[name], s, runs, warmup, min_time)
+            result.update(engine=name, size=n, chars=len(s))
+            results.append(result)
+            log('{:>20} {:>6} numbers: median {:.3e} s  IQR {:.1%}'.format(
+                name, n, result['median'], (result['q3'] - result['q1']) / result['median']))
+    return {
+        'meta': {
+            'python': sys.version,
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'seed': seed,
+            'runs': runs,
+            'warmup': warmup,
+        },
+        'results': results,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float = 0.05, log=print) -> list:
+    '''
+    Compare two run_suite results engine by engine and size by size. A slowdown
+    counts as a regression when the new median is more than threshold slower and
+    the two interquartile ranges do not overlap. Return the regressions.
+    '''
+    before = {(r['engine'], r['size']): r for r in old['results']}
+    regressions = []
+    for r in new['results']:
+        o = before.get((r['engine'], r['size']))
+        if o is None:
+            continue
+        ratio = r['median'] / o['median']
+        regressed = ratio > 1 + threshold and r['q1'] > o['q3']
+        improved = ratio < 1 - threshold and r['q3'] < o['q1']
+        if regressed:
+            regressions.append((r['engine'], r['size'], ratio))
+        log('{:>20} {:>6} numbers: {:.3e} -> {:.3e} s  x{:.3f}{}'.format(
+            r['engine'], r['size'], o['median'], r['median'], ratio,
+            '  REGRESSION' if regressed else '  faster' if improved else ''))
+    return regressions
+
+
+def run_extras():
     s = generate_str(2002, seed=1236)
-    print('Length:', len(s))
-    # open('rmthis','w').write(s)
-    d = timeit.timeit(lambda: run_import_statemachine(s), number=10)
-    print('python-statemachine:', d / 10)
-    d = timeit.timeit(lambda: run_match(s), number=100)
-    print('for loop + match:', d / 100)
-    d = timeit.timeit(lambda: run_re(s), number=1000)
-    print('re:', d / 1000)
-    d = timeit.timeit(lambda: run_goto(s), number=1000)
-    print('goto:', d / 1000)
+    bench_label_dispatch(s)
+    bench_computed_goto()
+    bench_dfa()
+    bench_regex()
+    bench_fuse()
+    bench_tail_goto()
+    bench_resumable()
+    bench_decoration()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='goto state machine benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='measure every engine and write the results as JSON')
+    run.add_argument('-o', '--output', help='JSON file to write (default: stdout)')
+    run.add_argument('--sizes', type=int, nargs='+', default=[20, 200, 2000],
+                     help='numbers in each generate_str input')
+    run.add_argument('--seed', type=int, default=1236)
+    run.add_argument('--engines', nargs='+', choices=list(ENGINES))
+    run.add_argument('--runs', type=int, default=7)
+    run.add_argument('--warmup', type=int, default=3)
+    run.add_argument('--min-time', type=float, default=0.05, help='seconds per timed run')
+    cmp = commands.add_parser('compare', help='flag regressions between two result files')
+    cmp.add_argument('old')
+    cmp.add_argument('new')
+    cmp.add_argument('--threshold', type=float, default=0.05, help='relative slowdown to flag')
+    commands.add_parser('extras', help='goto-specific benchmarks (labels, computed goto, DFA, decoration)')
+    scaling = commands.add_parser('scaling', help='how decoration time grows with function size, labels, '
+                                                  'gotos and loop depth')
+    scaling.add_argument('-o', '--output', help='JSON file to write the curves to')
+    scaling.add_argument('--runs', type=int, default=5)
+    scaling.add_argument('--limit', type=float, default=1.3, help='growth exponent to flag as super-linear')
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        log = functools.partial(print, file=sys.stderr)
+        results = run_suite(args.sizes, args.seed, args.engines, args.runs, args.warmup, args.min_time, log)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=1)
+        else:
+            json.dump(results, sys.stdout, indent=1)
+    elif args.command == 'compare':
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        if compare(old, new, args.threshold):
+            return 1
+    elif args.command == 'scaling':
+        report = bench_decoration_scaling(runs=args.runs, limit=args.limit)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=1)
+        if any(exponent > args.limit for curve in report.values() for exponent in curve['exponents'].values()):
+            return 1
+    else:
+        run_extras()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,23 @@
+import asyncio
+import dis
+import importlib
+import inspect
+import io
+import itertools
+import marshal
+import os
+import pickle
+import re
+import sys
+import tempfile
+import textwrap
+import types
 import unittest
+from unittest import mock
 
+import goto as goto_module
 from goto import goto
-from goto import DuplicateLabelError, GotoNotWithinLabelBlock, GotoNestedTooDeeply, MissingLabelError
+from goto import DuplicateLabelError, GotoNotWithinLabelBlock, IllegalGoto, MissingLabelError
 
 
 class MyTestCase(unittest.TestCase):
@@ -105,11 +121,10 @@ class MyTestCase(unittest.TestCase):
 
         self.assertTrue(deep_nest())
 
-    def test_too_deep_nest(self):
-        got_exception = False
-        try:
-            @goto
-            def deep_nest():
+    def test_very_deep_nest(self):
+        @goto
+        def deep_nest():
+            for _ in [1]:
                 for _ in [1]:
                     for _ in [1]:
                         for _ in [1]:
@@ -121,14 +136,12 @@ class MyTestCase(unittest.TestCase):
                                                 for _ in [1]:
                                                     for _ in [1]:
                                                         for _ in [1]:
-                                                            for _ in [1]:
-                                                                goto .here
-                if __name__: return False
-                label .here
-                return True
-        except GotoNestedTooDeeply:
-            got_exception = True
-        self.assertTrue(got_exception)
+                                                            goto .here
+            if __name__: return False
+            label .here
+            return True
+
+        self.assertTrue(deep_nest())
 
     def test_not_in_same_block(self):
         got_exception = False
@@ -320,5 +333,1573 @@ class MyTestCase(unittest.TestCase):
             return True
         self.assertTrue(ext_arg_forward())
 
+    def test_scan_matches_dis(self):
+        # enough globals that LOAD_GLOBAL and LOAD_ATTR need EXTENDED_ARG
+        src = 'def f(n):\n' + ''.join('    g{}\n'.format(i) for i in range(300)) + textwrap.dedent('''
+            label .top
+            for i in n:
+                n.x
+                goto .top
+        ''').replace('\n', '\n    ')
+        ns = {}
+        exec(src, ns)
+        code = ns['f'].__code__
+        wanted = goto_module._SCAN3_11
+        expected = [(ins.offset, ins.opcode, ins.arg) for ins in dis.get_instructions(code)
+                    if ins.opcode in wanted]
+        self.assertEqual(expected, list(goto_module.scan_code(code, wanted)))
+        labels = goto_module.find_labels_and_gotos(code)
+        self.assertEqual(['top'], list(labels))
+        self.assertEqual(1, len(labels['top'].gotos))
+
+    def test_attribute_after_label(self):
+        @goto
+        def attribute_after_label(z):
+            label .start
+            z = z.real + 1
+            if z < 3:
+                goto .start
+            return z
+
+        self.assertEqual(3, attribute_after_label(0))
+
+    def test_very_far_jumps(self):
+        # more than 65535 code units each way, so the jumps need two EXTENDED_ARGs
+        src = textwrap.dedent('''
+            def very_far(n):
+                goto .end
+                label .start
+                n += 1
+            ''') + '    n.real\n' * 10000 + textwrap.dedent('''
+                if n == 2:
+                    return n
+                label .end
+                goto .start
+            ''').replace('\n', '\n    ')
+        ns = {}
+        exec(src, ns)
+        very_far = goto(ns['very_far'])
+        self.assertGreater(len(very_far.__code__.co_code) // 2, 65536)
+        self.assertEqual(2, very_far(0))
+
+    def test_goto_in_try(self):
+        @goto
+        def goto_in_try(n):
+            try:
+                label .again
+                n += 1
+                if n < 3:
+                    goto .again
+                1 / 0
+            except ZeroDivisionError:
+                return n
+
+        self.assertEqual(3, goto_in_try(0))
+
+    def test_line_numbers_kept(self):
+        def lines(n):
+            label .top
+            n += 1
+            if n < 3:
+                goto .top
+            return 1 / 0
+
+        def positions(code):
+            return [(ins.opname, ins.positions) for ins in dis.get_instructions(code)]
+
+        def line_runs(code):
+            return [line for line, _ in itertools.groupby(line for _, _, line in code.co_lines())]
+
+        first = lines.__code__.co_firstlineno
+        label_line, goto_line = first + 1, first + 4
+        before = lines.__code__
+        goto(lines)
+        after = lines.__code__
+        # everything but the label and goto keeps its positions, in order
+        self.assertEqual([p for p in positions(before) if p[1].lineno not in (label_line, goto_line)],
+                         [p for p in positions(after) if p[1].lineno not in (label_line, goto_line)])
+        # the jump keeps the goto's position, and the label's line is gone
+        jumps = [pos for _, pos in positions(after) if pos.lineno == goto_line]
+        self.assertEqual(1, len(jumps))
+        self.assertEqual(next(pos for _, pos in positions(before) if pos.lineno == goto_line)[:3],
+                         jumps[0][:3])
+        self.assertEqual([line for line in line_runs(before) if line != label_line], line_runs(after))
+        try:
+            lines(0)
+        except ZeroDivisionError as e:
+            self.assertEqual(first + 5, e.__traceback__.tb_next.tb_lineno)
+
+    def test_goto_past_assignment(self):
+        # 3.12+ reads locals the compiler proved bound without checking
+        @goto
+        def skip(n, xs):
+            if n:
+                goto .read
+            y = 1
+            x = [y for y in xs]
+            label .read
+            return x, y
+
+        self.assertEqual(([2], 1), skip(0, [2]))
+        for _ in range(2):
+            with self.assertRaises(UnboundLocalError):
+                skip(1, [2])
+
+    def test_labels_leave_no_nops(self):
+        @goto
+        def no_nops(n):
+            label .top
+            label .also_top
+            n -= 1
+            if n > 5:
+                goto .top
+            if n > 0:
+                goto .also_top
+            return n
+
+        self.assertEqual(0, no_nops(10))
+        self.assertNotIn('NOP', [ins.opname for ins in dis.get_instructions(no_nops)])
+
+    def test_goto_chains_are_threaded(self):
+        @goto
+        def chain(n):
+            if n:
+                goto .first
+            n = 5
+            label .first
+            goto .second
+            label .unused
+            expensive()
+            label .second
+            goto .third
+            label .third
+            return n
+
+        self.assertEqual(1, chain(1))
+        self.assertEqual(5, chain(0))
+        instructions = list(dis.get_instructions(chain))
+        at = {ins.offset: ins for ins in instructions}
+        for ins in instructions:
+            if ins.opcode in dis.hasjrel:
+                self.assertFalse(at[ins.argval].opname.startswith('JUMP'), ins)
+        self.assertNotIn('expensive', [ins.argval for ins in instructions])
+
+
+class AssemblerTestCase(unittest.TestCase):
+
+    def test_roundtrip(self):
+        def sample(a, b):
+            try:
+                with open(a) as f:
+                    for line in f:
+                        if line and b:
+                            continue
+            except OSError as e:
+                return [x for x in b if x is not None]
+            finally:
+                a = None
+            return a
+
+        for code in (sample.__code__, unittest.TestCase.assertEqual.__code__,
+                     dis.get_instructions.__code__, textwrap.dedent.__code__):
+            new = goto_module.Assembler(code).assemble()
+            self.assertEqual(code.co_code, new.co_code)
+            self.assertEqual(code.co_linetable, new.co_linetable)
+            self.assertEqual(code.co_exceptiontable, new.co_exceptiontable)
+
+    def test_insert_moves_jumps(self):
+        def sample(n):
+            while n:
+                n -= 1
+            return n
+
+        asm = goto_module.Assembler(sample.__code__)
+        nop = dis.opmap['NOP']
+        asm.substitute({ins: [goto_module.Instr(nop) for _ in range(300)] + [ins]
+                        for ins in asm.instrs if 'BACKWARD' in ins.opname})
+        new = asm.assemble()
+        self.assertIn('EXTENDED_ARG', [ins.opname for ins in dis.get_instructions(new)])
+        self.assertEqual(0, types.FunctionType(new, {})(5))
+
+
+class ComputedGotoTestCase(unittest.TestCase):
+
+    def test_computed_goto(self):
+        @goto
+        def machine(states):
+            trace = []
+            for state in states:
+                goto[state]
+                label .alpha
+                trace.append('a')
+                goto .next
+                label .beta
+                trace.append('b')
+                goto .next
+                label .gamma
+                trace.append('c')
+                label .next
+            return trace
+
+        self.assertEqual(list('cabba'), machine(['gamma', 'alpha', 'beta', 'beta', 'alpha']))
+        with self.assertRaises(KeyError):
+            machine(['delta'])
+
+    def test_computed_goto_out_of_loops(self):
+        @goto
+        def find(matrix, n):
+            for row in matrix:
+                for value in row:
+                    goto[('small', 'big')[value >= n]]
+                    label .small
+            if __name__: return 'none'
+            label .big
+            return value
+
+        self.assertEqual(7, find([[1, 2], [7, 9]], 5))
+        self.assertEqual('none', find([[1, 2]], 5))
+
+    def test_many_labels(self):
+        names = ['s{}'.format(n) for n in range(200)]
+        src = 'def many(state):\n    goto[state]\n' + ''.join(
+            '    label .{0}\n    if __name__: return "{0}"\n'.format(name) for name in names)
+        ns = {}
+        exec(src, ns)
+        many = goto(ns['many'])
+        for name in names:
+            self.assertEqual(name, many(name))
+        with self.assertRaises(KeyError):
+            many('s200')
+
+
+class DfaTestCase(unittest.TestCase):
+
+    def test_binary_multiple_of_three(self):
+        # states are the remainder so far
+        table = {0: {'0': 0, '1': 1}, 1: {'0': 2, '1': 0}, 2: {'0': 1, '1': 2}}
+        mod3 = goto_module.dfa_function(table, 0, {0}, 'mod3')
+        for n in range(100):
+            self.assertEqual(n % 3 == 0, mod3(format(n, 'b')), n)
+        self.assertFalse(mod3('102'))
+        self.assertEqual('mod3', mod3.__code__.co_name)
+
+    def test_character_classes(self):
+        digits = '0123456789'
+        table = {'start': {digits: 'int', '+-': 'sign'}, 'sign': {digits: 'int'}, 'int': {digits: 'int'}}
+        integer = goto_module.dfa_function(table, 'start', {'int'})
+        self.assertTrue(integer('-42'))
+        self.assertTrue(integer('7'))
+        self.assertFalse(integer('-'))
+        self.assertFalse(integer('4-2'))
+        self.assertFalse(integer(''))
+
+    def test_overlapping_classes(self):
+        with self.assertRaises(ValueError):
+            goto_module.dfa_code({'a': {'xy': 'a', 'yz': 'b'}}, 'a', {'b'})
+
+    def test_default_transition(self):
+        # a comma-separated list of non-empty fields; 'done' reads no further
+        table = {'start': {',': 'bad', None: 'field'}, 'field': {',': 'start', '!': 'done', None: 'field'},
+                 'done': {None: 'done'}}
+        fields = goto_module.dfa_function(table, 'start', {'field', 'done'})
+        self.assertTrue(fields('a,bc,d'))
+        self.assertFalse(fields('a,,b'))
+        self.assertFalse(fields('a,'))
+        self.assertTrue(fields('a!,,'))
+
+
+class RegexTestCase(unittest.TestCase):
+
+    def assertSameAsRe(self, pattern, strings):
+        fn = goto_module.regex_function(pattern)
+        rx = re.compile(pattern, re.ASCII)
+        for s in strings:
+            self.assertEqual(bool(rx.search(s)), fn(s), (pattern, s))
+
+    def test_against_re(self):
+        strings = [''.join(t) for n in range(5) for t in itertools.product('ab1.\n', repeat=n)]
+        for pattern in ('', 'a', 'ab|ba', '(a|b)*abb', '^(a|b)*abb$', '^a', 'a$', '^$', r'\d+(\.\d+)?',
+                        r'^[ab]?1+$', '[^a]b', 'a.b', '^.*$', 'a*?1', r'^(?:ab)+\.?$', r'\D\W', r'\s'):
+            self.assertSameAsRe(pattern, strings)
+
+    def test_anchored_alternatives(self):
+        # each top-level alternative has anchors of its own
+        strings = [''.join(t) for n in range(5) for t in itertools.product('abcdx\n', repeat=n)]
+        for pattern in ('^a|b', 'a|b$', '^ab|cd$', 'a|^b', '^a$|b', '^(a|b)$|^c|d$'):
+            self.assertSameAsRe(pattern, strings)
+
+    def test_float_sum(self):
+        fpsum = goto_module.regex_function(r'^\d+(\.\d+)?(e[+-]\d+)?(\+\d+(\.\d+)?(e[+-]\d+)?)*\$$', 'fpsum')
+        self.assertTrue(fpsum('1.5e+3+2$'))
+        self.assertFalse(fpsum('1.5e3+2$'))
+        self.assertFalse(fpsum('1+$'))
+        self.assertEqual('fpsum', fpsum.__code__.co_name)
+
+    def test_sets_and_escapes(self):
+        self.assertSameAsRe(r'[]a-c\-]x', ['ax', ']x', '-x', 'bx', 'dx', 'x', ''])
+        self.assertSameAsRe(r'a\.\$\\', ['a.$\\', 'ab$\\', 'a.$'])
+        self.assertSameAsRe(r'^\w+@\w+\.(com|org)$', ['me@x.org', 'me@x.net', '@x.com', 'me@x.com\n'])
+
+    def test_search_stops_at_match(self):
+        # the accepting state reads no further, so this is quick however long s is
+        self.assertTrue(goto_module.regex_function('ab')('ab' + 'x' * 10 ** 6))
+
+    def test_unsupported(self):
+        for pattern in ('(a', 'a)', '*a', 'a**', 'a{2}', 'a^b', '(a|^b)', 'a$|$b', '(a$)', '[a', r'\b', r'\1', '(?=a)', '[z-a]'):
+            with self.assertRaises(ValueError, msg=pattern):
+                goto_module.regex_dfa(pattern)
+
+
+class GeneratorTestCase(unittest.TestCase):
+
+    def test_goto_around_yield(self):
+        @goto
+        def countdown(n):
+            label .top
+            if n:
+                yield n
+                n -= 1
+                goto .top
+
+        self.assertEqual([3, 2, 1], list(countdown(3)))
+
+    def test_goto_out_of_loop_in_generator(self):
+        @goto
+        def runs(n):
+            i = 0
+            label .again
+            for x in (1, 2):
+                yield x
+                if i < n:
+                    i += 1
+                    goto .again
+
+        self.assertEqual([1] * 10000 + [1, 2], list(runs(10000)))
+
+    def test_send_and_throw(self):
+        @goto
+        def accumulate():
+            total = 0
+            label .next
+            try:
+                value = yield total
+            except ValueError:
+                value = -total
+            total += value
+            goto .next
+
+        gen = accumulate()
+        next(gen)
+        self.assertEqual(5, gen.send(5))
+        self.assertEqual(7, gen.send(2))
+        self.assertEqual(0, gen.throw(ValueError))
+        gen.close()
+
+    def test_coroutine(self):
+        @goto
+        async def ticks(n):
+            count = 0
+            label .tick
+            await asyncio.sleep(0)
+            count += 1
+            if count < n:
+                goto .tick
+            return count
+
+        self.assertEqual(5, asyncio.run(ticks(5)))
+
+    def test_goto_out_of_async_for(self):
+        async def pair():
+            yield 1
+            yield 2
+
+        @goto
+        async def restarts(n):
+            i = 0
+            label .again
+            async for x in pair():
+                if i < n:
+                    i += 1
+                    goto .again
+            return i
+
+        # the async iterator must be popped each time, or the stack overflows
+        self.assertEqual(10000, asyncio.run(restarts(10000)))
+
+    def test_async_generator(self):
+        @goto
+        async def states(text):
+            for ch in text:
+                if ch == '!':
+                    goto .shout
+                yield ch
+            if __name__:
+                return
+            label .shout
+            yield 'BANG'
+
+        async def collect(text):
+            return [x async for x in states(text)]
+
+        self.assertEqual(['a', 'b', 'BANG'], asyncio.run(collect('ab!c')))
+        self.assertEqual(['a', 'b'], asyncio.run(collect('ab')))
+
+    def test_computed_goto_in_coroutine(self):
+        @goto
+        async def machine(script):
+            out = []
+            for state in script:
+                await asyncio.sleep(0)
+                goto[state]
+                label .ping
+                out.append('ping')
+                goto .next
+                label .pong
+                out.append('pong')
+                label .next
+            return out
+
+        self.assertEqual(['pong', 'ping'], asyncio.run(machine(['pong', 'ping'])))
+
+
+class Recorder:
+    """A context manager that logs its __exit__ calls, and can fail in them."""
+
+    def __init__(self, log, name, fail=False):
+        self.log = log
+        self.name = name
+        self.fail = fail
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.log.append((self.name, exc_info))
+        if self.fail:
+            raise KeyError(self.name)
+
+
+class TryWithTestCase(unittest.TestCase):
+
+    def test_goto_out_of_with(self):
+        log = []
+
+        @goto
+        def restart(n):
+            i = 0
+            label .top
+            i += 1
+            with Recorder(log, 'outer'):
+                for x in range(3):
+                    with Recorder(log, 'inner'):
+                        if i < n:
+                            goto .top
+            return i
+
+        self.assertEqual(2, restart(2))
+        self.assertEqual(['inner', 'outer', 'inner', 'inner', 'inner', 'outer'], [name for name, exc_info in log])
+        self.assertEqual({(None, None, None)}, {exc_info for name, exc_info in log})
+        self.assertEqual(10000, restart(10000))  # nothing is left on the stack
+
+    def test_exit_error_is_caught_outside_with(self):
+        log = []
+
+        @goto
+        def failing_exit():
+            try:
+                with Recorder(log, 'cm', fail=True):
+                    goto .out
+            except KeyError as e:
+                return e.args[0]
+            label .out
+            return None
+
+        self.assertEqual('cm', failing_exit())
+        self.assertEqual([('cm', (None, None, None))], log)  # __exit__ ran once
+
+    def test_goto_out_of_except(self):
+        @goto
+        def retry(items):
+            done = []
+            for x in items:
+                tries = 0
+                label .again
+                try:
+                    tries += 1
+                    if tries < 3:
+                        raise ValueError(x)
+                    done.append((x, tries))
+                except ValueError as e:
+                    goto .again
+            return done
+
+        for _ in range(3000):
+            self.assertEqual([(1, 3), (2, 3)], retry([1, 2]))
+        self.assertEqual((None, None, None), sys.exc_info())
+
+    def test_except_name_is_deleted(self):
+        @goto
+        def leave():
+            try:
+                1 / 0
+            except ZeroDivisionError as err:
+                goto .after
+            label .after
+            return 'err' in locals()
+
+        self.assertFalse(leave())
+
+    def test_nested_except(self):
+        @goto
+        def nested():
+            try:
+                raise KeyError
+            except KeyError:
+                try:
+                    raise ValueError
+                except ValueError:
+                    goto .done
+            label .done
+            return sys.exc_info()
+
+        self.assertEqual((None, None, None), nested())
+
+    def test_try_no_longer_catches_after_goto(self):
+        @goto
+        def escape():
+            try:
+                goto .out
+            except ZeroDivisionError:
+                return 'caught'
+            label .out
+            return 1 / 0
+
+        self.assertRaises(ZeroDivisionError, escape)
+
+    def test_finally_is_refused(self):
+        def leave_finally():
+            try:
+                goto .out
+            finally:
+                pass
+            label .out
+
+        self.assertRaises(IllegalGoto, goto, leave_finally)
+
+    def test_goto_within_finally_block(self):
+        @goto
+        def within():
+            n = 0
+            try:
+                label .again
+                n += 1
+                if n < 3:
+                    goto .again
+            finally:
+                n *= 10
+            return n
+
+        self.assertEqual(30, within())
+
+    def test_goto_in_finally_of_empty_try(self):
+        # the compiler keeps a copy of the finally body no path reaches
+        @goto
+        def loop():
+            try:
+                pass
+            finally:
+                n = 0
+                label .again
+                n += 1
+                if n < 3:
+                    goto .again
+            return n
+
+        @goto
+        def pick(state):
+            try:
+                pass
+            finally:
+                goto[state]
+            label .a
+            picked = 'a'
+            goto .out
+            label .b
+            picked = 'b'
+            label .out
+            return picked
+
+        self.assertEqual(3, loop())
+        self.assertEqual(['a', 'b'], [pick('a'), pick('b')])
+
+    def test_async_with_is_refused(self):
+        async def leave_async_with(cm):
+            async with cm:
+                goto .out
+            label .out
+            done = True
+            return done
+
+        self.assertRaises(IllegalGoto, goto, leave_async_with)
+
+    def test_computed_goto_out_of_with(self):
+        log = []
+
+        @goto
+        def machine(state):
+            count = 0
+            label .again
+            count += 1
+            with Recorder(log, count):
+                if count < 3:
+                    goto[state]
+            return count
+
+        self.assertEqual(3, machine('again'))
+        self.assertEqual([1, 2, 3], [name for name, exc_info in log])
+
+
+class ControlFlowTestCase(unittest.TestCase):
+
+    def test_match_dispatch_loop(self):
+        @goto
+        def machine(events):
+            state = 'idle'
+            log = []
+            for event in events:
+                match (state, event):
+                    case ('idle', 'go'):
+                        state = 'run'
+                    case ('run', 'stop'):
+                        state = 'idle'
+                    case ('run', 'crash'):
+                        goto .failed
+                    case (_, 'skip'):
+                        goto .next
+                log.append(state)
+                label .next
+            if __name__:
+                return log
+            label .failed
+            return log + ['failed']
+
+        for _ in range(100):
+            self.assertEqual(['run', 'idle', 'run', 'failed'], machine(['go', 'skip', 'stop', 'go', 'crash', 'go']))
+            self.assertEqual(['run', 'idle'], machine(['go', 'stop']))
+
+    def test_goto_out_of_match_patterns(self):
+        @goto
+        def classify(x):
+            match x:
+                case [1, _, *rest]:
+                    goto .sequence
+                case {'k': value}:
+                    result = value
+                    goto .done
+                case str() as s:
+                    result = s.upper()
+                    goto .done
+            result = None
+            goto .done
+            label .sequence
+            result = 'sequence'
+            label .done
+            return result
+
+        self.assertEqual(['sequence', 5, 'S', None], [classify(v) for v in ([1, 2, 3], {'k': 5}, 's', 7)])
+
+    def test_while_loop(self):
+        @goto
+        def total(n, limit):
+            result = 0
+            while n:
+                n -= 1
+                if n == 3:
+                    goto .skip
+                result += n
+                label .skip
+                if result > limit:
+                    goto .over
+            if __name__:
+                return result
+            label .over
+            return -result
+
+        self.assertEqual(7, total(5, 100))
+        self.assertEqual(-99 - 98, total(100, 100))
+
+    def test_comprehensions(self):
+        @goto
+        def positive_sum(xs):
+            ys = [x for x in xs if x > 0]
+            if not ys:
+                goto .empty
+            total = sum(y for y in ys)
+            label .again
+            if total > 10:
+                total = {y: y for y in ys}.get(min(ys))
+                goto .again
+            if __name__:
+                return total
+            label .empty
+            return None
+
+        self.assertEqual(3, positive_sum([0, 1, 2]))
+        self.assertEqual(1, positive_sum([1, 20]))
+        self.assertIsNone(positive_sum([0, -1]))
+
+    def test_label_before_short_exit(self):
+        # 3.12+ lays out short blocks that end the function once per path
+        # into them, the label statement included
+        @goto
+        def leave(xs, seen):
+            for x in xs:
+                if x < 0:
+                    break
+                seen.append(x)
+                if x == 0:
+                    goto .done
+            label .done
+            return
+
+        for xs, expected in (([1, 0, 2], [1, 0]), ([1, -1, 2], [1]), ([], [])):
+            seen = []
+            leave(xs, seen)
+            self.assertEqual(expected, seen)
+
+    def test_cfg(self):
+        def fn(xs):
+            for x in xs:
+                if x:
+                    return x
+            return None
+
+        asm = goto_module.Assembler(fn.__code__)
+        cfg = goto_module.CFG(asm)
+        self.assertEqual(asm.instrs, [ins for block in cfg.blocks for ins in block.instrs])
+        self.assertEqual(set(cfg.blocks), cfg.reachable())
+        stacks = cfg.stacks()
+        for block in cfg.blocks:
+            self.assertEqual(block.stack, stacks[block.instrs[0]])
+            last = block.instrs[-1]
+            if last.target is not None:
+                self.assertIs(last.target, block.jump.instrs[0])
+        loop = [ins for ins in asm.instrs if ins.opcode == dis.opmap['FOR_ITER']][0]
+        self.assertEqual((loop, None), stacks[asm.instrs[asm.instrs.index(loop) + 1]])
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        goto_module.set_cache_dir(self.tmp.name)
+        goto_module.memo_clear()
+
+    def tearDown(self):
+        goto_module.set_cache_dir(None)
+        self.tmp.cleanup()
+
+    def make_fn(self):
+        def fn(n):
+            label .again
+            n -= 1
+            if n > 0:
+                goto .again
+            return n
+        return fn
+
+    def test_cache_hit_skips_rewrite(self):
+        self.assertEqual(0, goto(self.make_fn())(3))
+        self.assertEqual(1, len(os.listdir(self.tmp.name)))
+        goto_module.memo_clear()
+        with mock.patch.object(goto_module, 'find_labels_and_gotos3_11', side_effect=AssertionError):
+            self.assertEqual(0, goto(self.make_fn())(3))
+
+    def test_corrupt_entry_is_rebuilt(self):
+        goto(self.make_fn())
+        entry = os.path.join(self.tmp.name, os.listdir(self.tmp.name)[0])
+        with open(entry, 'wb') as f:
+            f.write(b'not marshal data')
+        goto_module.memo_clear()
+        self.assertEqual(0, goto(self.make_fn())(3))
+        goto_module.memo_clear()
+        with mock.patch.object(goto_module, 'find_labels_and_gotos3_11', side_effect=AssertionError):
+            self.assertEqual(0, goto(self.make_fn())(3))
+
+    def test_altered_code_is_rebuilt(self):
+        goto(self.make_fn())
+        entry = os.path.join(self.tmp.name, os.listdir(self.tmp.name)[0])
+        with open(entry, 'rb') as f:
+            key, digest, data = marshal.load(f)
+        code = marshal.loads(data)
+        altered = code.replace(co_code=code.co_code[:-2] + bytes([dis.opmap['NOP'], 0]))
+        with open(entry, 'wb') as f:
+            marshal.dump((key, digest, marshal.dumps(altered)), f)
+        goto_module.memo_clear()
+        fn = goto(self.make_fn())
+        self.assertEqual(code.co_code, fn.__code__.co_code)
+        self.assertEqual(0, fn(3))
+
+
+class MemoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        goto_module.memo_clear()
+
+    def make_fn(self):
+        @goto
+        def fn(n):
+            label .again
+            n -= 1
+            if n > 0:
+                goto .again
+            return n
+        return fn
+
+    def test_nested_definition_reuses_rewrite(self):
+        first = self.make_fn()
+        with mock.patch.object(goto_module, 'find_labels_and_gotos3_11', side_effect=AssertionError):
+            second = self.make_fn()
+        self.assertIsNot(first, second)
+        self.assertIs(first.__code__, second.__code__)
+        self.assertEqual(0, second(3))
+        self.assertEqual((1, 1), goto_module.memo_info()[:2])
+
+    def test_redecorate_is_skipped(self):
+        fn = self.make_fn()
+        code = fn.__code__
+        self.assertTrue(goto_module.is_rewritten(code))
+        self.assertIs(code, goto(fn).__code__)
+        self.assertEqual(goto_module.MemoInfo(1, 1, 1), goto_module.memo_info())
+
+
+class LazyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        goto_module.memo_clear()
+
+    def test_rewritten_on_first_call(self):
+        @goto_module.lazy_goto
+        def fn(n):
+            label .again
+            n -= 1
+            if n > 0:
+                goto .again
+            return n
+
+        self.assertFalse(goto_module.is_rewritten(fn.__code__))
+        self.assertEqual(0, goto_module.memo_info().misses)
+        self.assertEqual(0, fn(3))
+        code = fn.__code__
+        self.assertTrue(goto_module.is_rewritten(code))
+        self.assertEqual(0, fn(5))
+        self.assertIs(code, fn.__code__)
+        self.assertEqual(1, goto_module.memo_info().misses)
+
+    def test_arguments_are_passed_on(self):
+        @goto_module.lazy_goto
+        def fn(a, b=2, /, c=3, *rest, d, e=5, **kw):
+            goto .done
+            a = None
+            label .done
+            return a, b, c, rest, d, e, kw
+
+        self.assertEqual('(a, b=2, /, c=3, *rest, d, e=5, **kw)', str(inspect.signature(fn)))
+        self.assertEqual((1, 7, 8, (9,), 4, 5, {'b': 0}), fn(1, 7, 8, 9, d=4, b=0))
+        self.assertEqual((1, 2, 3, (), 4, 6, {}), fn(1, d=4, e=6))
+
+    def test_closure(self):
+        def make(n):
+            @goto_module.lazy_goto
+            def add(m):
+                total = lambda: m + n
+                goto .done
+                m = 0
+                label .done
+                return total()
+            return add
+
+        self.assertEqual(3, make(1)(2))
+        self.assertEqual(7, make(3)(4))
+
+    def test_generator_and_coroutine(self):
+        @goto_module.lazy_goto
+        def gen(n):
+            i = 0
+            label .again
+            sent = yield i
+            i += sent or 1
+            if i < n:
+                goto .again
+            return 'done'
+
+        @goto_module.lazy_goto
+        async def co(x):
+            await asyncio.sleep(0)
+            goto .done
+            x = None
+            label .done
+            return x
+
+        self.assertTrue(inspect.isgeneratorfunction(gen))
+        self.assertTrue(inspect.iscoroutinefunction(co))
+        g = gen(5)
+        self.assertEqual([0, 2, 3], [next(g), g.send(2), g.send(1)])
+        with self.assertRaises(StopIteration) as cm:
+            g.send(2)
+        self.assertEqual('done', cm.exception.value)
+        self.assertEqual([0, 1, 2], list(gen(3)))
+        self.assertEqual(5, asyncio.run(co(5)))
+        self.assertTrue(goto_module.is_rewritten(gen.__code__))
+        self.assertTrue(goto_module.is_rewritten(co.__code__))
+
+    def test_validate(self):
+        @goto_module.lazy_goto
+        def good():
+            goto .done
+            label .done
+
+        @goto_module.lazy_goto
+        def bad():
+            goto .nowhere
+
+        goto_module.validate(good)
+        self.assertTrue(goto_module.is_rewritten(good.__code__))
+        with self.assertRaises(MissingLabelError):
+            goto_module.validate()
+        with self.assertRaises(MissingLabelError):
+            bad()
+
+    def test_validate_reports_every_failure(self):
+        @goto_module.lazy_goto
+        def bad():
+            goto .nowhere
+
+        @goto_module.lazy_goto
+        def worse():
+            label .twice
+            label .twice
+
+        @goto_module.lazy_goto
+        def good():
+            goto .done
+            label .done
+
+        with self.assertRaises(MissingLabelError) as cm:
+            goto_module.validate(bad, worse, good)
+        self.assertEqual(1, len(cm.exception.__notes__))
+        self.assertIn('worse: DuplicateLabelError', cm.exception.__notes__[0])
+        self.assertTrue(goto_module.is_rewritten(good.__code__))
+
+    def test_already_rewritten_is_not_deferred(self):
+        fn = MemoTestCase.make_fn(self)
+        self.assertIs(fn.__code__, goto_module.lazy_goto(fn).__code__)
+
+
+BATCH_MODULE = '''
+from goto import lazy_goto
+
+@lazy_goto
+def countdown(n):
+    label .again
+    n -= 1
+    if n > 0:
+        goto .again
+    return n
+
+def make_adder(k):
+    @lazy_goto
+    def add(n):
+        goto .done
+        n = None
+        label .done
+        return n + k
+    return add
+
+class Box:
+    @lazy_goto
+    def get(self, x):
+        goto .done
+        x = None
+        label .done
+        return x
+
+add1, add2 = make_adder(1), make_adder(2)
+'''
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        goto_module.memo_clear()
+
+    def make_module(self, source):
+        mod = types.ModuleType('goto_batch_mod')
+        exec(source, mod.__dict__)
+        return mod
+
+    def test_rewrite_module(self):
+        mod = self.make_module(BATCH_MODULE)
+        timings = goto_module.rewrite_module(mod, max_workers=2)
+        self.assertEqual(['countdown', 'Box.get', 'make_adder.<locals>.add'], [t.qualname for t in timings])
+        self.assertTrue(all(t.seconds >= 0 for t in timings))
+        for fn in (mod.countdown, mod.add1, mod.add2, mod.Box.get):
+            self.assertTrue(goto_module.is_rewritten(fn.__code__))
+        self.assertIs(mod.add1.__code__, mod.add2.__code__)
+        self.assertEqual((0, 4, 5, 6), (mod.countdown(3), mod.add1(3), mod.add2(3), mod.Box().get(6)))
+        self.assertEqual([], goto_module.rewrite_module(mod))
+
+    def test_error_is_raised_after_installing_the_rest(self):
+        mod = self.make_module(BATCH_MODULE + textwrap.dedent('''
+            @lazy_goto
+            def broken():
+                goto .nowhere
+        '''))
+        with self.assertRaises(MissingLabelError):
+            goto_module.rewrite_module(mod, max_workers=2)
+        self.assertTrue(goto_module.is_rewritten(mod.countdown.__code__))
+        self.assertFalse(goto_module.is_rewritten(mod.broken.__code__))
+
+
+class HitCountTestCase(unittest.TestCase):
+
+    def test_counts(self):
+        @goto_module.counted_goto
+        def machine(events):
+            for event in events:
+                goto[event]
+                label .a
+                if __name__:
+                    continue
+                label .b
+                if event == 'b':
+                    goto .a
+            label .end
+            return 'done'
+
+        self.assertEqual('done', machine('abab'))
+        line = machine.__code__.co_firstlineno  # the decorator's line
+        Site = goto_module.Site
+        self.assertEqual({Site('goto', None, line + 3): 4,
+                          Site('label', 'a', line + 4): 4,
+                          Site('label', 'b', line + 7): 2,
+                          Site('goto', 'a', line + 9): 2,
+                          Site('label', 'end', line + 10): 1}, goto_module.hit_counts(machine))
+        goto_module.reset_hit_counts(machine)
+        self.assertEqual({0}, set(goto_module.hit_counts(machine).values()))
+        machine('b')
+        self.assertEqual({1}, set(goto_module.hit_counts(machine).values()))
+
+    def test_counters_are_per_function(self):
+        def make():
+            @goto_module.counted_goto
+            def spin(n):
+                label .top
+                n -= 1
+                if n:
+                    goto .top
+                return n
+            return spin
+
+        first, second = make(), make()
+        first(5)
+        self.assertEqual([5, 4], sorted(goto_module.hit_counts(first).values(), reverse=True))
+        self.assertEqual({0}, set(goto_module.hit_counts(second).values()))
+
+    def test_code_stays_hashable(self):
+        def make():
+            @goto_module.counted_goto
+            def spin(n):
+                label .top
+                n -= 1
+                if n:
+                    goto .top
+                return n
+            return spin
+
+        spin = make()
+        code = spin.__code__
+        before = hash(code)
+        spin(3)
+        self.assertEqual(before, hash(code))
+        self.assertEqual(code, spin.__code__.replace())
+        self.assertNotEqual(code, make().__code__)  # each has counters of its own
+
+    def test_plain_goto_is_unchanged(self):
+        def spin(n):
+            label .top
+            n -= 1
+            if n:
+                goto .top
+            return n
+
+        plain = goto_module.rewrite_code(spin.__code__)
+        counted = goto_module.counted_goto(spin).__code__
+        self.assertNotEqual(plain.co_code, counted.co_code)
+        self.assertFalse(any(isinstance(const, goto_module._Counters) for const in plain.co_consts))
+        with self.assertRaises(ValueError):
+            goto_module.counted_goto(goto(lambda: None))
+
+
+class TraceTestCase(unittest.TestCase):
+
+    def make_parser(self, size):
+        @goto_module.traced_goto(size=size)
+        def parse(text):
+            pos = 0
+            label .start
+            if pos == len(text):
+                goto .end
+            c = text[pos]
+            pos += 1
+            if c == '(':
+                goto .open
+            if c == '!':
+                raise ValueError(pos)
+            goto .start
+            label .open
+            goto .start
+            label .end
+            return pos
+        return parse
+
+    def test_transitions(self):
+        parse = self.make_parser(100)
+        self.assertEqual(2, parse('a('))
+        self.assertEqual([(None, 'start'), ('start', 'start'), ('start', 'open'), ('open', 'start'),
+                          ('start', 'end')], goto_module.trace(parse))
+        parse('')
+        self.assertEqual([(None, 'start'), ('start', 'end')], goto_module.trace(parse)[-2:])
+        goto_module.clear_trace(parse)
+        self.assertEqual([], goto_module.trace(parse))
+
+    def test_ring_buffer_keeps_the_latest(self):
+        parse = self.make_parser(4)
+        parse('((((')
+        # the last four labels passed were start, open, start, end
+        self.assertEqual([('start', 'open'), ('open', 'start'), ('start', 'end')], goto_module.trace(parse))
+
+    def test_readable_after_exception(self):
+        parse = self.make_parser(100)
+        with self.assertRaises(ValueError):
+            parse('(!')
+        self.assertEqual(('open', 'start'), goto_module.trace(parse)[-1])
+
+    def test_code_stays_hashable(self):
+        parse = self.make_parser(100)
+        code = parse.__code__
+        before = hash(code)
+        parse('a(')
+        self.assertEqual(before, hash(code))
+        self.assertEqual(code, parse.__code__.replace())
+        self.assertNotEqual(code, self.make_parser(100).__code__)  # each has a buffer of its own
+
+    def test_generator(self):
+        @goto_module.traced_goto
+        def countdown(n):
+            label .top
+            yield n
+            n -= 1
+            if n:
+                goto .top
+
+        self.assertEqual([2, 1], list(countdown(2)))
+        self.assertEqual([(None, 'top'), ('top', 'top')], goto_module.trace(countdown))
+
+
+FUSE_MODULE = '''
+def even(s, i=0):
+    if i == len(s):
+        return True
+    if s[i] == '1':
+        return odd(s, i + 1)
+    return even(s, i + 1)
+
+def odd(s, i):
+    if i == len(s):
+        return False
+    if s[i] == '1':
+        return even(s, i + 1)
+    return odd(s, i + 1)
+
+def total(xs, acc=0):
+    for x in xs:
+        if x < 0:
+            return scaled(xs, acc)
+        acc += x
+    return acc
+
+def scaled(xs, acc, scale=10):
+    for x in xs:
+        try:
+            1 / x
+        except ZeroDivisionError:
+            return done(acc * scale)
+    result = -acc
+    goto .finish
+
+def done(result):
+    label .finish
+    return result
+'''
+
+
+class FuseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ns = {}
+        exec(FUSE_MODULE, self.ns)
+
+    def test_tail_calls_become_jumps(self):
+        parity = goto_module.fuse(self.ns['even'], self.ns['odd'])
+        self.assertEqual([False, True, True], [parity('1101'), parity('11011'), parity('10' * 10000)])
+        self.assertEqual(['len', 'len'], [ins.argval for ins in dis.get_instructions(parity)
+                                          if ins.opname == 'LOAD_GLOBAL'])
+        self.assertEqual(inspect.signature(self.ns['even']), inspect.signature(parity))
+        with self.assertRaises(RecursionError):
+            self.ns['even']('10' * 10000)
+
+    def test_gotos_between_functions(self):
+        # tail calls out of loops and except clauses, defaults, and a goto
+        # to another function's label
+        fn = goto_module.fuse(self.ns['total'], self.ns['scaled'], self.ns['done'])
+        self.assertEqual(6, fn([1, 2, 3]))
+        self.assertEqual(10, fn([1, -2, 0]))
+        self.assertEqual(-1, fn([1, -1]))
+
+    def test_many_locals(self):
+        # 3.13 packs two locals in one instruction, four bits each
+        ns = {}
+        exec(textwrap.dedent('''
+            def first(n):
+                a = b = c = d = e = f = g = h = i = j = k = l = m = o = p = q = 1
+                return second(n, a + q)
+
+            def second(x, y):
+                y, x = x, y
+                return x + y
+        '''), ns)
+        fn = goto_module.fuse(ns['first'], ns['second'])
+        self.assertEqual(5, fn(3))
+
+    def test_tail_call_in_try_is_kept(self):
+        # the handler must still catch what the callee raises
+        ns = {}
+        exec(textwrap.dedent('''
+            from contextlib import suppress
+
+            def a(n):
+                try:
+                    return b(n)
+                except ValueError:
+                    return 'caught in a'
+
+            def b(n):
+                raise ValueError(n)
+
+            def c(n):
+                try:
+                    raise KeyError(n)
+                except KeyError:
+                    try:
+                        return b(n)
+                    except ValueError:
+                        return 'caught in c'
+
+            def d(n):
+                with suppress(ValueError):
+                    return b(n)
+                return 'suppressed in d'
+        '''), ns)
+        fn = goto_module.fuse(ns['a'], ns['b'])
+        self.assertEqual('caught in a', fn(1))
+        self.assertIn('b', [ins.argval for ins in dis.get_instructions(fn) if ins.opname == 'LOAD_GLOBAL'])
+        self.assertEqual('caught in c', goto_module.fuse(ns['c'], ns['b'])(1))
+        self.assertEqual('suppressed in d', goto_module.fuse(ns['d'], ns['b'])(1))
+
+    def test_refused(self):
+        def gen():
+            yield
+
+        with self.assertRaises(ValueError):
+            goto_module.fuse(self.ns['even'], gen)
+        with self.assertRaises(ValueError):
+            goto_module.fuse(goto(self.ns['odd']))
+        ns = {}
+        exec(textwrap.dedent('''
+            def one():
+                label .x
+                return two()
+
+            def two():
+                label .x
+        '''), ns)
+        with self.assertRaises(DuplicateLabelError):
+            goto_module.fuse(ns['one'], ns['two'])
+
+
+TAIL_MODULE = '''
+from goto import tail_goto
+
+@tail_goto
+def total(n, acc=0):
+    if n == 0:
+        return acc
+    return total(n - 1, acc=acc + n)
+
+@tail_goto
+def find(xs, x, lo=0, hi=None):
+    if hi is None:
+        hi = len(xs)
+    if lo >= hi:
+        return -1
+    mid = (lo + hi) // 2
+    if xs[mid] < x:
+        return find(xs, x, mid + 1, hi)
+    if xs[mid] > x:
+        return find(xs, x, hi=mid)
+    return mid
+
+@tail_goto
+def depth(n):
+    if n:
+        return depth(n - 1) + 1
+    return 0
+
+@tail_goto
+def guarded(n):
+    if n == 0:
+        raise ValueError
+    try:
+        return guarded(n - 1)
+    except ValueError:
+        return n
+'''
+
+
+class TailGotoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ns = {}
+        exec(TAIL_MODULE, self.ns)
+
+    def test_tail_calls_become_jumps(self):
+        total = self.ns['total']
+        self.assertEqual(5000050000, total(100000))
+        self.assertFalse([ins for ins in dis.get_instructions(total) if ins.opname.startswith('CALL')])
+
+    def test_parameters_and_defaults(self):
+        find = self.ns['find']
+        xs = list(range(0, 200, 2))
+        self.assertEqual([0, 18, 99, -1, -1], [find(xs, x) for x in (0, 36, 198, 37, 500)])
+
+    def test_other_calls_are_kept(self):
+        self.assertEqual(50, self.ns['depth'](50))
+        with self.assertRaises(RecursionError):
+            self.ns['depth'](100000)
+
+    def test_tail_call_in_try_is_kept(self):
+        # the innermost call's handler catches the ValueError
+        self.assertEqual(1, self.ns['guarded'](5))
+        self.assertTrue([ins for ins in dis.get_instructions(self.ns['guarded']) if ins.opname.startswith('CALL')])
+
+    def test_closure_is_refused(self):
+        with self.assertRaises(ValueError):
+            @goto_module.tail_goto
+            def countdown(n):
+                return countdown(n - 1) if n else 0
+
+
+RESUMABLE_MODULE = '''
+from goto import resumable
+
+@resumable
+def sum_ints(data):
+    total = 0
+    value = None
+    label .more
+    for c in data:
+        if c.isdigit():
+            value = (value or 0) * 10 + int(c)
+        elif value is not None:
+            total += value
+            value = None
+    if data:
+        suspend .more
+    if value is not None:
+        total += value
+    return total
+
+@resumable
+def lines(data, done=()):
+    line = ''
+    label .more
+    for c in data:
+        if c == '\\n':
+            done += (line,)
+            line = ''
+        elif c == '!':
+            suspend .more
+        else:
+            line += c
+    return done, line
+'''
+
+
+class ResumableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.mod = types.ModuleType('goto_resumable_mod')
+        exec(RESUMABLE_MODULE, self.mod.__dict__)
+        sys.modules[self.mod.__name__] = self.mod
+        self.addCleanup(sys.modules.pop, self.mod.__name__)
+
+    def test_chunks(self):
+        state = self.mod.sum_ints('12 3')
+        self.assertIsInstance(state, goto_module.Suspended)
+        self.assertEqual('more', state.label)
+        self.assertEqual({'data': '12 3', 'total': 12, 'value': 3, 'c': '3'}, state.locals)
+        state = state.resume(data='4 5')
+        self.assertEqual(12 + 34 + 5, state.resume(data=''))
+        self.assertEqual(0, self.mod.sum_ints(''))
+
+    def test_suspend_inside_loop(self):
+        # the loop is left at 'suspend', and resuming starts the next chunk
+        state = self.mod.lines('ab\ncd!ignored')
+        self.assertEqual((('ab',), 'cd'), (state.locals['done'], state.locals['line']))
+        self.assertEqual((('ab', 'cde'), 'f'), state.resume(data='e\nf'))
+
+    def test_copy_and_pickle(self):
+        state = self.mod.sum_ints('7 8')
+        again = pickle.loads(pickle.dumps(state))
+        self.assertEqual(15, state.resume(data=''))
+        self.assertEqual(7 + 89, again.resume(data='9').resume(data=''))
+
+    def test_label_in_loop_is_refused(self):
+        with self.assertRaises(GotoNotWithinLabelBlock):
+            @goto_module.resumable
+            def fn(data):
+                for c in data:
+                    label .inside
+                    if c:
+                        suspend .inside
+
+
+class SpecializationTestCase(unittest.TestCase):
+
+    def test_caches_are_laid_out(self):
+        @goto
+        def fn(xs):
+            total = 0
+            label .top
+            if xs:
+                total += len(xs.pop())
+                goto .top
+            return total
+        code = fn.__code__.co_code
+        for instr in dis.get_instructions(fn):
+            cache_end = instr.offset + 2 + 2 * goto_module._CACHE_ENTRIES[instr.opcode]
+            self.assertFalse(any(code[instr.offset + 2:cache_end]), instr.opname)
+
+    def test_goto_loop_specializes_like_while_loop(self):
+        @goto
+        def goto_loop(n):
+            i = 0
+            label .top
+            i += 1
+            if i < n:
+                goto .top
+            return i
+
+        def while_loop(n):
+            i = 0
+            while True:
+                i += 1
+                if not i < n:
+                    break
+            return i
+
+        def specialized(fn):
+            for _ in range(10):
+                fn(100)
+            return sorted(s.specialized for s in goto_module.specialization_report(fn) if s.specialized)
+
+        self.assertTrue(specialized(goto_loop))
+        self.assertEqual(specialized(while_loop), specialized(goto_loop))
+
+    def test_cold_function_is_generic(self):
+        @goto
+        def fn(a, b):
+            goto .end
+            label .end
+            return a + b
+        report = goto_module.specialization_report(fn)
+        self.assertIn('BINARY_OP', [s.opname for s in report])
+        self.assertTrue(all(s.specialized is None for s in report))
+
+
+PRECOMPILED_MODULE = textwrap.dedent('''
+    from goto import goto
+
+    @goto
+    def countdown(n):
+        label .again
+        n -= 1
+        if n > 0:
+            goto .again
+        return n
+
+    def plain():
+        return 1
+''')
+
+
+class PrecompileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'goto_precompiled_mod.py')
+        with open(self.path, 'w') as f:
+            f.write(PRECOMPILED_MODULE)
+        sys.path.insert(0, self.tmp.name)
+        goto_module.memo_clear()
+
+    def tearDown(self):
+        goto_module.uninstall_import_hook()
+        sys.path.remove(self.tmp.name)
+        sys.modules.pop('goto_precompiled_mod', None)
+        self.tmp.cleanup()
+
+    def check_module(self):
+        mod = importlib.import_module('goto_precompiled_mod')
+        self.assertTrue(goto_module.is_rewritten(mod.countdown.__code__))
+        self.assertFalse(goto_module.is_rewritten(mod.plain.__code__))
+        self.assertEqual(0, mod.countdown(3))
+        self.assertEqual(0, goto_module.memo_info().misses)
+
+    def test_compile_command(self):
+        self.assertEqual(0, goto_module.main(['compile', '-q', self.tmp.name]))
+        with open(importlib.util.cache_from_source(self.path), 'rb') as f:
+            code = marshal.loads(f.read()[16:])
+        fn_code = [c for c in code.co_consts if getattr(c, 'co_name', None) == 'countdown'][0]
+        self.assertTrue(goto_module.is_rewritten(fn_code))
+        self.check_module()
+
+    def test_compile_command_reports_and_continues(self):
+        # a file that cannot be read is reported, and the rest still compiled
+        broken = os.path.join(self.tmp.name, 'a_broken.py')
+        os.symlink(os.path.join(self.tmp.name, 'missing'), broken)
+        with mock.patch.object(sys, 'stderr', io.StringIO()) as stderr:
+            self.assertEqual(1, goto_module.main(['compile', '-q', self.tmp.name]))
+        self.assertIn('a_broken.py: FileNotFoundError', stderr.getvalue())
+        self.assertTrue(os.path.exists(importlib.util.cache_from_source(self.path)))
+
+    @mock.patch.object(sys, 'dont_write_bytecode', False)
+    def test_import_hook(self):
+        goto_module.install_import_hook()
+        self.check_module()
+        self.assertTrue(os.path.exists(importlib.util.cache_from_source(self.path)))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,145 @@
+import dis
+import sys
+import textwrap
+import unittest
+
+import goto as goto_module
+from goto import goto
+
+if sys.version_info < (3, 12):
+    raise unittest.SkipTest('the 3.12+ backend needs Python 3.12 or later')
+
+
+class Goto312TestCase(unittest.TestCase):
+
+    def test_backend(self):
+        self.assertIs(goto_module.goto3_12, goto)
+        self.assertIs(goto_module.rewrite_code3_12, goto_module.rewrite_code)
+
+    def test_label_names(self):
+        # LOAD_ATTR's arg is the name index shifted left, with the method flag
+        @goto
+        def names(a):
+            a.strip()
+            goto .zzz
+            if __name__:
+                return 0
+            label .zzz
+            return a.upper()
+
+        self.assertEqual('X', names('x'))
+
+    def test_continue_before_goto(self):
+        # 'continue' is a JUMP_BACKWARD to the FOR_ITER; the loop only ends at END_FOR
+        @goto
+        def first_negative(rows):
+            for row in rows:
+                for x in row:
+                    if x >= 0:
+                        continue
+                    found = x
+                    goto .found
+            if __name__:
+                return None
+            label .found
+            return found
+
+        for _ in range(100):
+            self.assertEqual(-2, first_negative([[1, 2], [3, -2, -4]]))
+            self.assertIsNone(first_negative([[1], []]))
+
+    def test_goto_back_into_loop_head(self):
+        @goto
+        def count(n):
+            total = 0
+            label .again
+            for i in range(n):
+                total += i
+                if total > 100:
+                    n -= 1
+                    goto .again
+            return total
+
+        self.assertEqual(count(5), 10)
+        self.assertGreater(count(20), 100)
+
+    def test_labels_and_gotos_in_comprehension_scope(self):
+        # 3.12 inlines comprehensions, so their FOR_ITER is in the function
+        @goto
+        def squares(xs):
+            ys = [x * x for x in xs]
+            goto .done
+            ys = None
+            label .done
+            return ys
+
+        self.assertEqual([1, 4], squares([1, 2]))
+
+    def test_warm_computed_goto(self):
+        # COMPARE_OP carries the compiler's mask, which the specialized
+        # string compare relies on
+        @goto
+        def classify(state):
+            goto[state]
+            label .a
+            if __name__:
+                return 'a'
+            label .b
+            if __name__:
+                return 'b'
+            label .c
+            return 'c'
+
+        for _ in range(200):
+            self.assertEqual(['c', 'a', 'b'], [classify(s) for s in 'cab'])
+        with self.assertRaises(KeyError):
+            classify('d')
+
+    def test_dfa_loops(self):
+        # backward transitions go through a JUMP_BACKWARD, and an exhausted
+        # FOR_ITER skips the END_FOR at its target
+        ab_star = goto_module.dfa_function({'s': {'a': 't'}, 't': {'b': 's'}}, 's', {'s'})
+        for _ in range(100):
+            self.assertTrue(ab_star(''))
+            self.assertTrue(ab_star('abab'))
+            self.assertFalse(ab_star('aba'))
+            self.assertFalse(ab_star('abba'))
+
+    def test_roundtrip_merges_line_table(self):
+        src = textwrap.dedent('''
+            def f(a, b):
+                x = (a
+                     + b)
+                for i in range(a):
+                    try:
+                        x += i
+                    except TypeError:
+                        continue
+                return x
+        ''')
+        ns = {}
+        exec(src, ns)
+        code = ns['f'].__code__
+        new = goto_module.Assembler(code).assemble()
+        self.assertEqual(code.co_code, new.co_code)
+        self.assertEqual(code.co_linetable, new.co_linetable)
+        self.assertEqual(code.co_exceptiontable, new.co_exceptiontable)
+        self.assertEqual(list(code.co_positions()), list(new.co_positions()))
+
+    def test_conditional_jumps_stay_forward(self):
+        @goto
+        def spin(n):
+            label .top
+            n -= 1
+            if n:
+                goto .top
+            return n
+
+        self.assertEqual(0, spin(10))
+        for ins in dis.get_instructions(spin):
+            if ins.opname.startswith('POP_JUMP'):
+                self.assertGreater(ins.argval, ins.offset)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import asyncio
+import sys
+import traceback
+import unittest
+
+import goto as goto_module
+from goto import goto
+from goto import DuplicateLabelError, GotoNotWithinLabelBlock, IllegalGoto, MissingLabelError
+
+if not (3, 8) <= sys.version_info < (3, 11):
+    raise unittest.SkipTest('the block stack backend is for Python 3.8 - 3.10')
+
+
+class Recorder:
+
+    def __init__(self, log, name):
+        self.log = log
+        self.name = name
+
+    def __enter__(self):
+        self.log.append('enter ' + self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.log.append(('exit ' + self.name, exc))
+        return False
+
+
+class Goto38TestCase(unittest.TestCase):
+
+    def test_backend(self):
+        self.assertIs(goto_module.goto3_8, goto)
+        self.assertIs(goto_module.rewrite_code3_8, goto_module.rewrite_code)
+
+    def test_loop(self):
+        @goto
+        def total(n):
+            s = 0
+            label .top
+            if n <= 0:
+                return s
+            s += n
+            n -= 1
+            goto .top
+
+        self.assertEqual(55, total(10))
+
+    def test_out_of_nested_loops(self):
+        # each loop left pops its iterator, however many there are
+        @goto
+        def find(cube, x):
+            for plane in cube:
+                for row in plane:
+                    for line in row:
+                        for cell in line:
+                            for value in cell:
+                                if value == x:
+                                    found = 'found'
+                                    goto .done
+            found = 'missing'
+            label .done
+            return found
+
+        cube = [[[[[1, 2, 3]]]]]
+        for _ in range(100):
+            self.assertEqual('found', find(cube, 2))
+            self.assertEqual('missing', find(cube, 4))
+
+    def test_out_of_with(self):
+        @goto
+        def leave(log):
+            with Recorder(log, 'outer'):
+                for _ in range(3):
+                    with Recorder(log, 'inner'):
+                        goto .out
+            label .out
+            log.append('out')
+
+        log = []
+        leave(log)
+        self.assertEqual(['enter outer', 'enter inner', ('exit inner', (None, None, None)),
+                          ('exit outer', (None, None, None)), 'out'], log)
+
+    def test_out_of_async_with(self):
+        class Async:
+            async def __aenter__(self):
+                log.append('enter')
+
+            async def __aexit__(self, *exc):
+                log.append(('exit', exc))
+
+        @goto
+        async def leave():
+            async with Async():
+                goto .out
+            label .out
+            log.append('out')
+
+        log = []
+        asyncio.run(leave())
+        self.assertEqual(['enter', ('exit', (None, None, None)), 'out'], log)
+
+    def test_out_of_except(self):
+        # the exception being handled before is restored, and 'as' names cleared
+        @goto
+        def handled():
+            try:
+                raise KeyError('x')
+            except KeyError as e:
+                for _ in range(2):
+                    goto .out
+            label .out
+            return sys.exc_info(), 'e' in locals()
+
+        self.assertEqual(((None, None, None), False), handled())
+
+    def test_out_of_try(self):
+        @goto
+        def leave():
+            try:
+                goto .out
+            except ValueError:
+                return 'wrong'
+            label .out
+            try:
+                raise ValueError
+            except ValueError:
+                return 'caught'
+
+        self.assertEqual('caught', leave())
+
+    def test_generator(self):
+        @goto
+        def count(n):
+            i = 0
+            label .again
+            yield i
+            i += 1
+            if i < n:
+                goto .again
+
+        self.assertEqual([0, 1, 2], list(count(3)))
+
+    def test_far_jumps(self):
+        # the labels are well past where a one byte jump arg reaches
+        src = ('def far(n):\n    x = 0\n    label .start\n    goto .end\n' + '    x += n\n' * 20000
+               + '    label .end\n    for i in range(3):\n        if x < 3:\n            x += 1\n'
+               + '            goto .end\n    if x < 5:\n        x += 1\n        goto .start\n    return x\n')
+        ns = {}
+        exec(src, ns)
+        far = goto(ns['far'])
+        self.assertGreater(len(far.__code__.co_code), 1 << 16)
+        self.assertEqual(5, far(1))
+
+    def test_line_numbers(self):
+        @goto
+        def fail():
+            goto .raise_
+            label .raise_
+            raise ValueError
+
+        try:
+            fail()
+        except ValueError as e:
+            lineno = traceback.extract_tb(e.__traceback__)[-1].lineno
+        self.assertEqual(fail.__code__.co_firstlineno + 4, lineno)
+
+    def test_finally_refused(self):
+        with self.assertRaises(IllegalGoto):
+            @goto
+            def skip_finally():
+                try:
+                    goto .out
+                finally:
+                    pass
+                label .out
+
+    def test_into_block_refused(self):
+        with self.assertRaises(GotoNotWithinLabelBlock):
+            @goto
+            def into_loop():
+                goto .inner
+                for _ in range(2):
+                    label .inner
+
+        with self.assertRaises(GotoNotWithinLabelBlock):
+            @goto
+            def across_loops():
+                for _ in range(2):
+                    label .first
+                for _ in range(2):
+                    goto .first
+
+    def test_label_errors(self):
+        with self.assertRaises(DuplicateLabelError):
+            @goto
+            def twice():
+                label .x
+                label .x
+
+        with self.assertRaises(MissingLabelError):
+            @goto
+            def missing():
+                goto .nowhere
+
+    @unittest.skipIf(sys.version_info < (3, 9), '3.8 enters a finally clause with different blocks set up')
+    def test_label_in_finally(self):
+        # 3.9 and 3.10 lay the finally clause out twice
+        @goto
+        def cleanup(n):
+            try:
+                x = n
+            finally:
+                label .again
+                n -= 1
+                if n > 0:
+                    goto .again
+            return x, n
+
+        self.assertEqual((3, 0), cleanup(3))
+
+    def test_recognisers_refused(self):
+        # the DFA is built on any version, but not the bytecode
+        transitions, start, accepting = goto_module.regex_dfa('ab+')
+        with self.assertRaisesRegex(goto_module.UnsupportedVersion, 'needs Python 3.11 or later, not 3'):
+            goto_module.dfa_function(transitions, start, accepting)
+        with self.assertRaises(goto_module.UnsupportedVersion):
+            goto_module.regex_function('ab+')
+
+    def test_3_11_features_refused(self):
+        def fn():
+            pass
+
+        for feature in (goto_module.counted_goto, goto_module.traced_goto, goto_module.fuse,
+                        goto_module.tail_goto, goto_module.resumable):
+            with self.assertRaises(goto_module.UnsupportedVersion, msg=feature.__name__):
+                feature(fn)
+
+
+if __name__ == '__main__':
+    unittest.main()